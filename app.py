@@ -1,11 +1,24 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 import os
-import tempfile
 import shutil
-import subprocess
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from database import Database
-import re
+from vault_index import get_vault_index
+from vault_rules import ScanRules
+from vault_watcher import VaultWatcher
+from obsidian_markdown import (PROCESSOR_VERSION, parse_obsidian_markdown,
+                               render_obsidian_markdown, split_embed_target)
+from note_cache import get_note_cache
+from transclusion import TransclusionGraph, is_image_embed
+from chapter_cache import RENDER_VERSION, get_chapter_cache
+from epub_writer import build_epub
+from image_stager import ImageStager
+from image_optimizer import IMAGE_PROFILES, ImageOptimizer, pillow_available, prune_renditions
+from export_store import ExportDependencies, export_fingerprint, file_key, get_export_store
+from export_jobs import FINISHED_STATES, ExportError, get_export_jobs, run_process, sse_events
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
@@ -13,9 +26,29 @@ app.config['SECRET_KEY'] = 'your-secret-key-here'
 # Инициализация базы данных
 db = Database()
 
+# Сборщики EPUB и стили встроенного сборщика
+EPUB_BACKENDS = ('native', 'ebook-convert')
+EPUB_CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'epub-styles.css')
+# Таймаут ebook-convert по умолчанию, секунд
+DEFAULT_CONVERT_TIMEOUT = 600
+# Сколько дней хранятся неиспользуемые готовые книги по умолчанию
+DEFAULT_EXPORT_RETENTION_DAYS = 7
+# Потоков перекодирования изображений по умолчанию (экспорт без пула процессов)
+DEFAULT_IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+
 # Глобальные переменные для кэширования
 current_project = None
 folder_tree_cache = None
+vault_watcher = None
+# Пул процессов для параллельной обработки заметок и изображений:
+# (число процессов, пул); пулы в работе → сколько экспортов их держат
+export_pool = None
+export_pool_users = {}
+export_pool_lock = threading.Lock()
+# Пул потоков перекодирования изображений, когда пула процессов нет:
+# (число потоков, пул)
+image_executor = None
+image_executor_lock = threading.Lock()
 
 
 @app.route('/')
@@ -69,6 +102,7 @@ def set_project():
         global current_project, folder_tree_cache
         current_project = project
         folder_tree_cache = None  # Сбрасываем кэш
+        sync_vault_watcher()
         
         return jsonify({'success': True, 'project': project})
         
@@ -83,6 +117,8 @@ def get_current_project():
         global current_project
         if not current_project:
             current_project = db.get_active_project()
+            if current_project:
+                sync_vault_watcher()
         
         return jsonify({'success': True, 'project': current_project})
         
@@ -92,13 +128,21 @@ def get_current_project():
 
 @app.route('/api/folder-tree')
 def get_folder_tree():
-    """Получение дерева папок с состояниями"""
+    """Получение дерева папок с состояниями.
+    
+    Параметры: path - папка, с которой начинается поддерево (по умолчанию
+    корень проекта), depth - число возвращаемых уровней подпапок
+    (по умолчанию все).
+    """
     try:
         global current_project
         
         if not current_project:
             return jsonify({'success': False, 'error': 'Проект не выбран'})
         
+        path = request.args.get('path', '')
+        depth = request.args.get('depth', type=int)
+        
         # Получаем состояния папок из базы данных
         folder_states = {}
         if current_project:
@@ -108,8 +152,19 @@ def get_folder_tree():
                 for state in states
             }
         
-        # Строим дерево папок
-        tree = build_folder_tree(current_project['path'], folder_states)
+        # Перечитываются только папки, изменившиеся с прошлого снимка
+        index = refresh_project_index(current_project)
+        if not index.has_dir(path):
+            return jsonify({'success': False, 'error': f'Папка не найдена: {path}'})
+        
+        # Дерево пересобирается только при изменении снимка или состояний
+        global folder_tree_cache
+        cache_key = (current_project['id'], index.generation, path, depth)
+        if folder_tree_cache and folder_tree_cache['key'] == cache_key:
+            tree = folder_tree_cache['tree']
+        else:
+            tree = build_folder_tree(current_project['path'], folder_states, path, depth)
+            folder_tree_cache = {'key': cache_key, 'tree': tree}
         
         return jsonify({'success': True, 'tree': tree, 'folder_states': folder_states})
         
@@ -126,15 +181,17 @@ def set_folder_state():
         is_selected = data.get('is_selected')
         is_expanded = data.get('is_expanded')
         
-        global current_project
+        global current_project, folder_tree_cache
         if not current_project:
             return jsonify({'success': False, 'error': 'Проект не выбран'})
         
         # Сохраняем состояние папки
         db.set_folder_state(current_project['id'], folder_path, is_selected, is_expanded)
+        folder_tree_cache = None  # Состояния входят в дерево
         
         # Если папка выбрана, добавляем её файлы в список
         if is_selected:
+            refresh_project_index(current_project)
             files_data = get_files_from_folder(current_project['path'], folder_path)
             if files_data:
                 db.add_files_to_project(current_project['id'], files_data)
@@ -148,6 +205,157 @@ def set_folder_state():
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/api/vault-watcher', methods=['GET', 'POST'])
+def vault_watcher_settings():
+    """Включение/выключение наблюдателя за хранилищем и его состояние"""
+    try:
+        if request.method == 'POST':
+            enabled = bool(request.json.get('enabled'))
+            db.set_setting('vault_watcher', '1' if enabled else '0')
+            sync_vault_watcher()
+        
+        return jsonify({
+            'success': True,
+            'enabled': db.get_setting('vault_watcher') == '1',
+            'stats': vault_watcher.stats() if vault_watcher else None
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/scan-settings', methods=['GET', 'POST'])
+def scan_settings():
+    """Настройки сканирования хранилища: потоки и правила исключения"""
+    try:
+        global current_project, folder_tree_cache
+        
+        if request.method == 'POST':
+            data = request.json
+            if 'workers' in data:
+                workers = int(data['workers'])
+                if workers < 1:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Число потоков должно быть не меньше 1'
+                    })
+                db.set_setting('scan_workers', str(workers))
+            
+            if 'exclude' in data or 'include' in data:
+                if not current_project:
+                    return jsonify({'success': False, 'error': 'Проект не выбран'})
+                
+                old_rules = get_scan_rules(current_project)
+                rules = ScanRules(data.get('exclude', old_rules.exclude),
+                                  data.get('include', old_rules.include))
+                db.set_setting(f"scan_rules:{current_project['id']}", rules.to_json())
+                
+                # Сохраненный снимок построен по старым правилам
+                if rules != old_rules:
+                    db.clear_vault_snapshot(current_project['id'])
+                    get_vault_index(current_project['path']).set_rules(rules)
+                    folder_tree_cache = None
+        
+        return jsonify({
+            'success': True,
+            'workers': get_scan_workers(),
+            'rules': get_scan_rules(current_project).to_dict() if current_project else None
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/export-settings', methods=['GET', 'POST'])
+def export_settings():
+    """Настройки экспорта: сборщик EPUB, число процессов обработки заметок,
+    число одновременно выполняемых заданий экспорта, таймаут ebook-convert,
+    профиль устройства для изображений и число потоков их перекодирования,
+    копирование книг в ~/Downloads и срок хранения готовых книг"""
+    try:
+        if request.method == 'POST':
+            data = request.json
+            if 'backend' in data:
+                if data['backend'] not in EPUB_BACKENDS:
+                    return jsonify({
+                        'success': False,
+                        'error': f"Неизвестный сборщик EPUB: {data['backend']}"
+                    })
+                db.set_setting('epub_backend', data['backend'])
+            if 'workers' in data:
+                workers = int(data['workers'])
+                if workers < 1:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Число процессов должно быть не меньше 1'
+                    })
+                db.set_setting('export_workers', str(workers))
+            if 'job_workers' in data:
+                job_workers = int(data['job_workers'])
+                if job_workers < 1:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Число одновременных экспортов должно быть не меньше 1'
+                    })
+                db.set_setting('export_job_workers', str(job_workers))
+                get_export_jobs(job_workers).set_workers(job_workers)
+            if 'image_profile' in data:
+                if data['image_profile'] != 'original' and data['image_profile'] not in IMAGE_PROFILES:
+                    return jsonify({
+                        'success': False,
+                        'error': f"Неизвестный профиль изображений: {data['image_profile']}"
+                    })
+                db.set_setting('image_profile', data['image_profile'])
+            if 'image_workers' in data:
+                image_workers = int(data['image_workers'])
+                if image_workers < 0:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Число потоков не может быть отрицательным'
+                    })
+                db.set_setting('image_workers', str(image_workers))
+            if 'convert_timeout' in data:
+                convert_timeout = int(data['convert_timeout'])
+                if convert_timeout < 0:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Таймаут не может быть отрицательным'
+                    })
+                db.set_setting('ebook_convert_timeout', str(convert_timeout))
+            if 'copy_to_downloads' in data:
+                db.set_setting('copy_to_downloads', '1' if data['copy_to_downloads'] else '0')
+            if 'retention_days' in data:
+                retention_days = int(data['retention_days'])
+                if retention_days < 0:
+                    return jsonify({
+                        'success': False,
+                        'error': 'Срок хранения не может быть отрицательным'
+                    })
+                db.set_setting('export_retention_days', str(retention_days))
+                store = get_export_store(retention_days * 86400)
+                store.retention = retention_days * 86400
+                store.prune()
+        
+        return jsonify({
+            'success': True,
+            'backend': get_epub_backend(),
+            'ebook_convert_available': shutil.which('ebook-convert') is not None,
+            'workers': get_export_workers(),
+            'job_workers': get_export_job_workers(),
+            'convert_timeout': get_convert_timeout(),
+            'copy_to_downloads': db.get_setting('copy_to_downloads') == '1',
+            'retention_days': get_export_retention_days(),
+            'image_profile': db.get_setting('image_profile') or 'original',
+            'image_profiles': [profile.to_dict() for profile in IMAGE_PROFILES.values()],
+            'image_workers': get_image_workers(),
+            'pillow_available': pillow_available(),
+            'cpu_count': os.cpu_count()
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
 @app.route('/api/get-project-files')
 def get_project_files():
     """Получение файлов проекта из базы данных"""
@@ -221,6 +429,7 @@ def get_files_from_folders():
             return jsonify({'success': False, 'error': 'Проект не выбран'})
         
         base_path = current_project['path']
+        refresh_project_index(current_project)
         all_files = []
         
         for folder_path in folder_paths:
@@ -238,133 +447,158 @@ def get_files_from_folders():
 
 @app.route('/api/export-epub', methods=['POST'])
 def export_epub():
-    """Экспорт выбранных файлов в EPUB"""
+    """Экспорт выбранных файлов в EPUB (ожидает завершения задания экспорта)"""
     try:
-        data = request.json
-        files = data.get('files', [])
-        title = data.get('title', 'Мои заметки')
+        job = submit_export_job(request.json)
+        job.join()
         
-        if not files:
-            return jsonify({
-                'success': False,
-                'error': 'Не выбраны файлы для экспорта'
-            })
+        if job.state != 'done':
+            return jsonify({'success': False, 'error': job.error or 'Экспорт отменен'})
+        
+        return jsonify({'success': True, **job.result})
         
-        # Создаем временную папку
-        with tempfile.TemporaryDirectory() as temp_dir:
-            processed_files = []
-            images_dir = os.path.join(temp_dir, 'images')
-            os.makedirs(images_dir, exist_ok=True)
-            
-            # Собираем все изображения
-            global current_project
-            base_path = current_project['path'] if current_project else ''
-            
-            # Объединяем все файлы в один markdown файл
-            combined_content = []
-            
-            for file_info in files:
-                if not file_info.get('is_included'):
-                    continue
-                    
-                file_path = file_info['path']
-                if not os.path.exists(file_path):
-                    continue
-                
-                # Читаем и обрабатываем содержимое файла
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Обрабатываем Obsidian-специфичные элементы и изображения
-                content = process_obsidian_content(content, file_path, images_dir, base_path)
-                
-                # Не добавляем заголовок главы если в контенте уже есть заголовок
-                if not content.lstrip().startswith('#'):
-                    chapter_title = file_info['name'].replace('.md', '')
-                    final_content = f"# {chapter_title}\n\n{content}"
-                else:
-                    final_content = content
-                
-                combined_content.append(final_content)
-            
-            # Создаем единый markdown файл
-            if combined_content:
-                combined_text = '\n\n'.join(combined_content)
-                temp_file = os.path.join(temp_dir, 'combined.md')
-                with open(temp_file, 'w', encoding='utf-8') as f:
-                    f.write(combined_text)
-                processed_files.append(temp_file)
-            
-            if not processed_files:
-                return jsonify({
-                    'success': False,
-                    'error': 'Нет файлов для обработки'
-                })
-            
-            # Создаем EPUB
-            epub_filename = f"{title}.epub"
-            epub_path = os.path.join(temp_dir, epub_filename)
-            
-            # Команда Calibre ebook-convert - с оглавлением для каждого файла
-            cmd = [
-                'ebook-convert',
-                processed_files[0],  # input file
-                epub_path,           # output file
-                '--title', title,
-                '--authors', '',
-                '--publisher', '',
-                '--book-producer', '',
-                '--language', 'ru',
-                '--enable-heuristics',
-                '--markdown-extensions', 'markdown.extensions.extra,markdown.extensions.nl2br,markdown.extensions.sane_lists',
-                '--chapter', '//h:h1',  # Каждый H1 - новая глава
-                '--chapter-mark', 'pagebreak',  # Разрыв страницы перед главой
-                '--page-breaks-before', '//h:h1',  # Разрыв страницы перед H1
-                '--insert-blank-line',  # Пустые строки между абзацами
-                '--insert-blank-line-size', '0.5',
-                '--level1-toc', '//h:h1',  # H1 в оглавлении уровня 1
-                '--level2-toc', '//h:h2',  # H2 в оглавлении уровня 2
-                '--level3-toc', '//h:h3',  # H3 в оглавлении уровня 3
-                '--toc-title', 'Оглавление',  # Название оглавления
-                '--max-toc-links', '1000',  # Максимум ссылок в оглавлении
-                '--duplicate-links-in-toc'  # Дубликаты ссылок в оглавлении
-            ]
-            
-            # Выполняем команду
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                return jsonify({
-                    'success': False,
-                    'error': f'Ошибка ebook-convert: {result.stderr}'
-                })
-            
-            # Копируем файл в папку загрузок
-            downloads_dir = os.path.expanduser('~/Downloads')
-            final_epub_path = os.path.join(downloads_dir, epub_filename)
-            
-            # Если файл уже существует, добавляем номер
-            counter = 1
-            while os.path.exists(final_epub_path):
-                name_part = title
-                final_epub_path = os.path.join(
-                    downloads_dir, f"{name_part}_{counter}.epub"
-                )
-                counter += 1
-            
-            shutil.copy2(epub_path, final_epub_path)
-            
-            return jsonify({
-                'success': True,
-                'filename': os.path.basename(final_epub_path),
-                'download_url': f'/download/{os.path.basename(final_epub_path)}',
-                'path': final_epub_path
-            })
-            
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/api/export-jobs', methods=['GET', 'POST'])
+def export_jobs():
+    """Постановка экспорта в очередь (POST) и список заданий (GET)"""
+    try:
+        if request.method == 'POST':
+            job = submit_export_job(request.json)
+            return jsonify({'success': True, 'job_id': job.id, 'job': job.to_dict()})
+        
+        jobs = get_export_jobs(get_export_job_workers()).jobs()
+        return jsonify({'success': True, 'jobs': [job.to_dict() for job in jobs]})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/projects/<int:project_id>/export', methods=['POST'])
+def export_project(project_id):
+    """Экспорт проекта по выбору файлов из базы данных (ставится в очередь).
+
+    Заметки и их порядок берутся из базы, клиент передает только
+    название и параметры: {title, options: {backend, image_profile},
+    include: [id файлов], exclude: [id файлов]}. options, include и
+    exclude действуют только на этот экспорт и не сохраняются.
+    """
+    try:
+        job = submit_project_export(project_id, request.json or {})
+        return jsonify({'success': True, 'job_id': job.id, 'job': job.to_dict()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/projects/<int:project_id>/batch-export', methods=['POST'])
+def batch_export_project(project_id):
+    """Пакетный экспорт: несколько книг проекта одним запросом.
+
+    {books: [{title, folder | files | include/exclude, options}]}: книга
+    собирается из папки хранилища (заметки папки и подпапок), из файлов
+    проекта с заданными id (в этом порядке) или из сохраненного выбора.
+    Каждая книга - отдельное задание экспорта, задания выполняются
+    параллельно (не больше job_workers одновременно) с общими индексом
+    хранилища и кэшем заметок.
+    """
+    try:
+        batch_id, jobs = submit_batch_export(project_id, request.json or {})
+        return jsonify({'success': True, 'batch_id': batch_id,
+                        'jobs': [job.to_dict() for job in jobs]})
+        
+    except ExportError as e:
+        # Ошибка в описании книг: ни одна книга пакета не поставлена в очередь
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/export-batches/<batch_id>')
+def export_batch_status(batch_id):
+    """Состояние заданий пакетного экспорта"""
+    jobs = get_export_jobs(get_export_job_workers()).jobs(batch_id)
+    if not jobs:
+        return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+    jobs = [job.to_dict() for job in jobs]
+    return jsonify({'success': True, 'batch_id': batch_id, 'jobs': jobs,
+                    'finished': all(job['state'] in FINISHED_STATES for job in jobs)})
+
+
+@app.route('/api/export-batches/<batch_id>/cancel', methods=['POST'])
+def cancel_export_batch(batch_id):
+    """Отмена всех незавершенных заданий пакетного экспорта"""
+    jobs = get_export_jobs(get_export_job_workers()).jobs(batch_id)
+    if not jobs:
+        return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+    cancelled = sum(job.cancel() for job in jobs)
+    return jsonify({'success': True, 'cancelled': cancelled})
+
+
+@app.route('/api/export-jobs/<job_id>')
+def export_job_status(job_id):
+    """Состояние задания экспорта: этап, прогресс и результат"""
+    job = get_export_jobs(get_export_job_workers()).get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Задание не найдено'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+
+@app.route('/api/export-jobs/<job_id>/events')
+def export_job_events(job_id):
+    """Поток Server-Sent Events с прогрессом задания до его завершения"""
+    job = get_export_jobs(get_export_job_workers()).get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Задание не найдено'}), 404
+    # Клиент может попросить отменить экспорт, если он закроет страницу
+    cancel_on_disconnect = request.args.get('cancel_on_close') == '1'
+    return Response(sse_events(job, cancel_on_disconnect=cancel_on_disconnect),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/export-jobs/<job_id>/cancel', methods=['POST'])
+def cancel_export_job(job_id):
+    """Отмена задания экспорта"""
+    jobs = get_export_jobs(get_export_job_workers())
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Задание не найдено'}), 404
+    return jsonify({'success': True, 'cancelled': jobs.cancel(job_id), 'job': job.to_dict()})
+
+
+@app.route('/api/export-jobs/<job_id>/download')
+def download_export_job(job_id):
+    """Скачивание EPUB, созданного заданием экспорта"""
+    try:
+        job = get_export_jobs(get_export_job_workers()).get(job_id)
+        if not job or job.state != 'done':
+            return jsonify({'error': 'Файл не найден'}), 404
+        
+        if not job.artifact or not os.path.exists(job.artifact):
+            return jsonify({'error': 'Файл не найден'}), 404
+        return send_artifact(job.artifact, job.artifact_name or os.path.basename(job.artifact),
+                             job.id)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/exports/<artifact_id>/download')
+def download_export(artifact_id):
+    """Скачивание готовой книги из хранилища по ее id (отпечатку экспорта)"""
+    try:
+        entry = get_export_store(get_export_retention_days() * 86400).artifact(artifact_id)
+        if not entry:
+            return jsonify({'error': 'Файл не найден'}), 404
+        return send_artifact(entry['path'], entry['filename'], artifact_id)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """Скачивание созданного EPUB файла"""
@@ -384,268 +618,783 @@ def download_file(filename):
 
 
 
-def get_files_from_folder(base_path, folder_path):
-    """Получение файлов из указанной папки"""
-    files_data = []
+def send_artifact(file_path, filename, artifact_id):
+    """Отдача книги с поддержкой If-None-Match/If-Modified-Since и Range
+    (докачка). ETag - id книги и версия файла: книга с тем же отпечатком
+    пересобирается при изменении вставок"""
+    stat = os.stat(file_path)
+    return send_file(file_path, as_attachment=True, download_name=filename,
+                     conditional=True, etag=f'{artifact_id}-{stat.st_mtime_ns:x}',
+                     last_modified=stat.st_mtime)
+
+
+def submit_export_job(data):
+    """Постановка экспорта выбранных файлов в очередь заданий"""
+    files = data.get('files', [])
+    title = data.get('title', 'Мои заметки')
     
-    full_path = (os.path.join(base_path, folder_path)
-                if not os.path.isabs(folder_path) else folder_path)
+    if not files:
+        raise ExportError('Не выбраны файлы для экспорта')
     
-    if os.path.exists(full_path):
-        # Получаем все MD файлы из папки и подпапок
-        for root, dirs, files in os.walk(full_path):
-            # Исключаем скрытые папки и папки Attachment
-            dirs[:] = [d for d in dirs 
-                      if not d.startswith('.') and
-                      not d.endswith('_Attachment') and
-                      not d.endswith('_Attachments') and
-                      not d.endswith('Attachment')]
-            
-            for file in files:
-                if (file.endswith('.md') and 
-                    not file.endswith('_Attachment.md') and
-                    not file.endswith('_Attachments.md') and
-                    not file.endswith('Attachment.md')):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, base_path)
-                    
-                    file_info = {
-                        'name': file,
-                        'path': file_path,
-                        'relative_path': relative_path,
-                        'size': os.path.getsize(file_path),
-                        'selected': True  # По умолчанию выбран
-                    }
-                    files_data.append(file_info)
+    # Новый экспорт проекта заменяет незавершенный предыдущий
+    project = dict(current_project) if current_project else None
+    project_id = project['id'] if project else None
+    return get_export_jobs(get_export_job_workers()).submit(
+        run_export, files, title, project,
+        title=title, project_id=project_id, key=project_id
+    )
+
+
+def submit_project_export(project_id, data):
+    """Постановка экспорта проекта по выбору файлов из базы данных"""
+    project = db.get_project(project_id)
+    if not project:
+        raise ExportError('Проект не найден')
     
-    return files_data
+    title = data.get('title') or 'Мои заметки'
+    options = check_export_options(data.get('options'))
+    files = iter_project_files(project_id, data.get('include', []), data.get('exclude', []))
+    return get_export_jobs(get_export_job_workers()).submit(
+        run_export, files, title, project, options,
+        title=title, project_id=project_id, key=project_id
+    )
 
 
-def build_folder_tree(base_path, folder_states=None):
-    """Построение дерева папок с состояниями"""
-    if folder_states is None:
-        folder_states = {}
+def submit_batch_export(project_id, data):
+    """Постановка книг пакетного экспорта в очередь, возвращает (id пакета, задания).
+
+    Все книги проверяются до постановки в очередь: папки - по индексу
+    хранилища (он проверяется здесь один раз на весь пакет), id файлов -
+    по базе данных. Повторный экспорт книги с тем же названием отменяет
+    ее незавершенный прошлый экспорт.
+    """
+    project = db.get_project(project_id)
+    if not project:
+        raise ExportError('Проект не найден')
     
-    def scan_folder(path, relative_path=""):
-        folder_info = {
-            'name': (os.path.basename(path) if relative_path
-                    else os.path.basename(base_path)),
-            'path': relative_path,
-            'children': [],
-            'files_count': 0,
-            'total_files_count': 0,
-            'is_selected': False,
-            'is_expanded': False
-        }
+    books = data.get('books') or []
+    if not books:
+        raise ExportError('Не заданы книги для экспорта')
+    
+    specs = []
+    for book in books:
+        if not isinstance(book, dict):
+            raise ExportError(f'Описание книги должно быть объектом: {book}')
+        folder = book.get('folder')
+        if folder is not None and not isinstance(folder, str):
+            raise ExportError(f'Папка книги должна быть строкой: {folder}')
+        title = book.get('title') or (os.path.basename(folder.rstrip('/')) if folder else '')
+        if not title:
+            raise ExportError('Не задано название книги')
+        if any(title == other for other, _, _ in specs):
+            raise ExportError(f'Название книги повторяется: {title}')
+        specs.append((title, check_export_options(book.get('options')), book))
+    
+    refresh = shared_index_refresh(project)
+    if any(book.get('folder') is not None for _, _, book in specs):
+        refresh()
+    for title, _, book in specs:
+        check_book_files(project, title, book)
+    
+    batch_id = uuid.uuid4().hex
+    queue = get_export_jobs(get_export_job_workers())
+    jobs = [
+        queue.submit(run_export, iter_book_files(project, title, book), title, project, options,
+                     refresh,
+                     title=title, project_id=project_id, key=(project_id, title),
+                     batch_id=batch_id)
+        for title, options, book in specs
+    ]
+    return batch_id, jobs
+
+
+def check_book_files(project, title, book):
+    """Проверка папки или файлов книги пакета (ошибка называет книгу)"""
+    folder = book.get('folder')
+    if folder is not None:
+        rel_dir = os.path.relpath(os.path.join(project['path'], folder), project['path'])
+        rel_dir = '' if rel_dir == os.curdir else rel_dir
+        if rel_dir.startswith(os.pardir) or not get_vault_index(project['path']).has_dir(rel_dir):
+            raise ExportError(f'Книга "{title}": папка не найдена: {folder}')
+        return
+    
+    book_file_ids(title, book, 'exclude')
+    for field in ('files', 'include'):
+        file_ids = book_file_ids(title, book, field)
+        found = {row[0] for row in db.get_files_by_ids(project['id'], file_ids)}
+        missing = [file_id for file_id in file_ids if file_id not in found]
+        if missing:
+            missing_ids = ', '.join(map(str, missing))
+            raise ExportError(f'Книга "{title}": файлы не найдены в проекте: {missing_ids}')
+
+
+def book_file_ids(title, book, field):
+    """id файлов из поля field книги пакета (files, include или exclude).
+
+    id из JSON приводятся к числам ("3" и 3 - один файл); не список или
+    не число - ошибка, которая называет книгу.
+    """
+    file_ids = book.get(field)
+    if file_ids is None:
+        return []
+    if not isinstance(file_ids, list):
+        raise ExportError(f'Книга "{title}": {field} должен быть списком id файлов')
+    try:
+        return [int(file_id) for file_id in file_ids]
+    except (TypeError, ValueError):
+        raise ExportError(f'Книга "{title}": неверный id файла в {field}: {file_ids}')
+
+
+def iter_book_files(project, title, book):
+    """Файлы книги пакетного экспорта (читаются в задании после проверки индекса)"""
+    if book.get('folder') is not None:
+        for file_info in get_files_from_folder(project['path'], book['folder']):
+            yield {'path': file_info['path'], 'name': file_info['name'], 'is_included': 1}
+    elif book.get('files') is not None:
+        file_ids = book_file_ids(title, book, 'files')
+        for _, path, name in db.get_files_by_ids(project['id'], file_ids):
+            yield {'path': path, 'name': name, 'is_included': 1}
+    else:
+        yield from iter_project_files(project['id'], book_file_ids(title, book, 'include'),
+                                      book_file_ids(title, book, 'exclude'))
+
+
+def shared_index_refresh(project):
+    """Проверка индекса хранилища один раз на все книги пакета"""
+    lock = threading.Lock()
+    refreshed = []
+    
+    def refresh():
+        with lock:
+            if not refreshed:
+                refresh_project_index(project)
+                refreshed.append(True)
+    return refresh
+
+
+def iter_project_files(project_id, include_ids=(), exclude_ids=()):
+    """Выбранные файлы проекта в порядке книги (читаются из базы в задании)"""
+    for _, path, name in db.iter_export_files(project_id, include_ids, exclude_ids):
+        yield {'path': path, 'name': name, 'is_included': 1}
+
+
+def check_export_options(options):
+    """Проверка параметров одного экспорта (переопределяют настройки)"""
+    options = dict(options or {})
+    unknown = set(options) - {'backend', 'image_profile'}
+    if unknown:
+        raise ExportError(f"Неизвестные параметры экспорта: {', '.join(sorted(unknown))}")
+    if 'backend' in options and options['backend'] not in EPUB_BACKENDS:
+        raise ExportError(f"Неизвестный сборщик EPUB: {options['backend']}")
+    if ('image_profile' in options and options['image_profile'] != 'original'
+            and options['image_profile'] not in IMAGE_PROFILES):
+        raise ExportError(f"Неизвестный профиль изображений: {options['image_profile']}")
+    return options
+
+
+def run_export(job, files, title, project, options=None, refresh=None):
+    """Экспорт в EPUB (выполняется в очереди заданий экспорта).
+
+    Этапы: scan - проверка индекса хранилища, preprocess - граф вставок,
+    convert - обработка глав, images - изображения, package - оглавление
+    и копирование результата. Готовый EPUB остается в папке задания.
+    options (см. check_export_options) переопределяют настройки экспорта,
+    refresh заменяет проверку индекса (общая для книг пакета).
+    """
+    options = options or {}
+    build_dir = os.path.join(job.work_dir, 'build')
+    backend = options.get('backend') or get_epub_backend()
+    
+    base_path = project['path'] if project else ''
+    
+    # Пул процессов держится до конца экспорта: смена числа процессов
+    # в настройках не закроет его, пока экспорт им пользуется
+    workers = get_export_workers()
+    pool = acquire_export_pool(workers) if workers > 1 else None
+    optimizer = None
+    images = None
+    
+    try:
+        # Изображения перекодируются под профиль устройства (если он выбран)
+        diagnostics = []
+        profile = get_image_profile(options.get('image_profile'))
+        optimizer = get_image_optimizer(profile, diagnostics, pool)
         
-        # Применяем сохраненные состояния
-        if relative_path in folder_states:
-            state = folder_states[relative_path]
-            folder_info['is_selected'] = bool(state.get('is_selected', 0))
-            folder_info['is_expanded'] = bool(state.get('is_expanded', 0))
+        # Встроенный сборщик пишет изображения в архив прямо из хранилища,
+        # для ebook-convert они размещаются рядом с markdown
+        images_dir = None
+        if backend == 'ebook-convert':
+            images_dir = os.path.join(build_dir, 'images')
+            os.makedirs(images_dir, exist_ok=True)
+        images = ImageStager(images_dir, optimizer)
         
-        if not os.path.exists(path):
-            return folder_info
+        # Проверяем актуальность индекса хранилища один раз на экспорт
+        job.stage('scan')
+        if refresh:
+            refresh()
+        elif project:
+            refresh_project_index(project)
         
-        try:
-            items = os.listdir(path)
-            dirs = []
-            files = []
-            
-            for item in items:
-                item_path = os.path.join(path, item)
-                # Фильтруем папки: скрытые (начинающиеся с точки) и Attachment
-                if (os.path.isdir(item_path) and 
-                    not item.startswith('.') and
-                    not item.endswith('_Attachment') and
-                    not item.endswith('_Attachments') and
-                    not item.endswith('Attachment')):
-                    dirs.append(item)
-                elif (item.endswith('.md') and 
-                      not item.endswith('_Attachment.md') and
-                      not item.endswith('_Attachments.md') and
-                      not item.endswith('Attachment.md')):
-                    files.append(item)
-            
-            # Файлы в текущей папке
-            folder_info['files_count'] = len(files)
-            folder_info['total_files_count'] = len(files)
-            
-            # Обрабатываем подпапки
-            for dir_name in sorted(dirs):
-                dir_path = os.path.join(path, dir_name)
-                child_relative_path = (os.path.join(relative_path, dir_name) 
-                                      if relative_path else dir_name)
-                child_info = scan_folder(dir_path, child_relative_path)
-                folder_info['children'].append(child_info)
-                folder_info['total_files_count'] += child_info['total_files_count']
-            
-        except PermissionError:
-            pass
+        # Выбранные заметки в порядке книги
+        export_files = [
+            file_info for file_info in files
+            if file_info.get('is_included') and os.path.exists(file_info['path'])
+        ]
+        if not export_files:
+            raise ExportError('Не выбраны файлы для экспорта')
         
-        return folder_info
-    
-    return scan_folder(base_path)
+        # Книга без изменений (те же заметки, вставки, изображения и
+        # параметры) отдается из хранилища без пересборки
+        store = get_export_store(get_export_retention_days() * 86400) if base_path else None
+        if store:
+            fingerprint = export_fingerprint([f['path'] for f in export_files], title,
+                                             export_options(backend, profile))
+            cached = store.get(fingerprint, dependency_lookup(base_path))
+            if cached:
+                return deliver_export(job, store, cached, cached=True)
+        
+        # Граф вставок строится заранее: каждая заметка (в том числе
+        # вставленная в несколько других) обрабатывается один раз,
+        # неизменившиеся берутся из кэша без чтения файла
+        job.stage('preprocess', len(export_files))
+        graph = None
+        if base_path:
+            if pool:
+                prefetch_notes([f['path'] for f in export_files], base_path, pool, workers)
+            graph = build_transclusion_graph(base_path)
+            for file_info in export_files:
+                graph.add(file_info['path'])
+                job.advance()
+        
+        epub_filename = f"{title}.epub"
+        epub_path = os.path.join(job.work_dir, epub_filename)
+        
+        # Главы обрабатываются и записываются по мере готовности,
+        # в памяти не собирается вся книга
+        job.stage('convert', len(export_files))
+        dependencies = ExportDependencies()
+        chapters = track_progress(job, iter_chapters(export_files, images, base_path, graph,
+                                                     dependencies))
+        
+        if backend == 'ebook-convert':
+            temp_file = os.path.join(build_dir, 'combined.md')
+            chapters_count = write_combined_markdown(chapters, temp_file)
+            if chapters_count:
+                # Все изображения должны быть готовы до запуска ebook-convert
+                images.files(stage_progress(job))
+                job.stage('convert', message='ebook-convert')
+                returncode, stderr = run_ebook_convert(job, temp_file, epub_path, title)
+                if returncode != 0:
+                    raise ExportError(f'Ошибка ebook-convert: {stderr}')
+        else:
+            # XHTML неизменившихся глав берется из кэша проекта, остальные
+            # главы преобразуются в пуле процессов (если он есть): задания
+            # пакета не упираются в GIL одного процесса
+            chapter_cache = get_chapter_cache(base_path) if base_path else None
+            chapters_count = build_epub(chapters, epub_path, title, images=images,
+                                        css_path=EPUB_CSS_PATH, chapter_cache=chapter_cache,
+                                        progress=stage_progress(job),
+                                        executor=pool, workers=workers)
+        
+        if not chapters_count:
+            raise ExportError('Нет файлов для обработки')
+        
+        diagnostics += graph.diagnostics if graph else []
+        if store:
+            record_graph_dependencies(graph, dependencies)
+            entry = store.put(fingerprint, epub_path, epub_filename, dependencies,
+                              title=title, diagnostics=diagnostics)
+            return deliver_export(job, store, entry)
+        
+        job.artifact = epub_path
+        job.artifact_name = epub_filename
+        return {
+            'filename': epub_filename,
+            'artifact_id': None,
+            'download_url': f'/api/export-jobs/{job.id}/download',
+            'path': copy_to_downloads(epub_path, title) if get_copy_to_downloads() else None,
+            'diagnostics': diagnostics,
+            'cached': False
+        }
+        
+    finally:
+        if images:
+            images.cancel()
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if optimizer:
+            prune_renditions()
+        if pool:
+            release_export_pool(pool)
 
 
-def process_obsidian_content(content, file_path=None, images_dir=None, base_path=None):
-    """Минимальная обработка Obsidian контента - только критически необходимое"""
+def deliver_export(job, store, entry, cached=False):
+    """Результат задания для книги из хранилища.
+
+    Книга скачивается прямо из хранилища по id. Копия в папке загрузок
+    создается, только если это включено в настройках, и переиспользуется,
+    пока она на месте, поэтому повторный экспорт без изменений не создает
+    копии с номерами.
+    """
+    downloads_path = None
+    if get_copy_to_downloads():
+        job.stage('package', message='Копирование в загрузки')
+        downloads_path = entry.get('downloads_path')
+        if not (downloads_path and os.path.exists(downloads_path)
+                and os.path.getsize(downloads_path) == entry['size']):
+            downloads_path = copy_to_downloads(entry['path'], entry['title'])
+            entry['downloads_path'] = downloads_path
+            store.update(entry['key'], entry)
     
-    # 1. Убираем YAML front matter (только это может ломать конвертер)
-    if content.strip().startswith('---'):
-        lines = content.split('\n')
-        yaml_end = -1
-        
-        # Ищем закрывающий ---
-        for i in range(1, len(lines)):
-            if lines[i].strip() == '---':
-                yaml_end = i
-                break
-        
-        if yaml_end > 0:
-            content = '\n'.join(lines[yaml_end + 1:])
-        else:
-            # Если нет закрывающего ---, удаляем первые 10 строк
-            content = '\n'.join(lines[10:] if len(lines) > 10 else lines[1:])
+    job.artifact = entry['path']
+    job.artifact_name = entry['filename']
+    return {
+        'filename': entry['filename'],
+        'artifact_id': entry['key'],
+        'download_url': f"/api/exports/{entry['key']}/download",
+        'path': downloads_path,
+        'diagnostics': entry['diagnostics'],
+        'cached': cached
+    }
+
+
+def copy_to_downloads(epub_path, title):
+    """Копия книги в папке загрузок, возвращает ее путь"""
+    downloads_dir = os.path.expanduser('~/Downloads')
+    final_epub_path = os.path.join(downloads_dir, f"{title}.epub")
     
-    # 2. Простая обработка callout'ов - убираем только синтаксис
-    content = re.sub(r'^\s*\[![^\]]+\].*?$', '', content, flags=re.MULTILINE)
+    # Если файл уже существует, добавляем номер
+    counter = 1
+    while os.path.exists(final_epub_path):
+        name_part = title
+        final_epub_path = os.path.join(
+            downloads_dir, f"{name_part}_{counter}.epub"
+        )
+        counter += 1
     
-    # 3. Обрабатываем изображения и вставки (если есть папки)
-    if file_path and base_path and images_dir:
-        content = process_embeds(content, file_path, base_path, images_dir)
+    shutil.copy2(epub_path, final_epub_path)
+    return final_epub_path
+
+
+def export_options(backend, profile):
+    """Параметры, от которых зависит результат сборки (для отпечатка экспорта)"""
+    return {
+        'backend': backend,
+        'image_profile': profile.key if profile and pillow_available() else None,
+        'versions': [PROCESSOR_VERSION, RENDER_VERSION],
+        'css': file_key(EPUB_CSS_PATH) if os.path.exists(EPUB_CSS_PATH) else None
+    }
+
+
+def record_graph_dependencies(graph, dependencies):
+    """Вставленные заметки и результаты поиска вставок графа"""
+    if not graph:
+        return
+    for (path, _), entry in graph.nodes.items():
+        dependencies.add_file(path)
+        for target, child in entry['notes'].items():
+            name, _ = split_embed_target(target)
+            if name:
+                dependencies.add_lookup('note', name, path, child[0] if child else None)
+
+
+def dependency_lookup(base_path):
+    """Повторный поиск вставки для проверки зависимостей книги"""
+    index = get_vault_index(base_path)
     
-    # 4. Простая замена Obsidian ссылок на жирный текст
-    content = re.sub(r'\[\[([^\]]+)\]\]', r'**\1**', content)
+    def lookup(kind, name, from_path):
+        if kind == 'note':
+            found = index.find_note(name)
+            return os.path.abspath(found) if found else None
+        return index.find_attachment(name, os.path.dirname(from_path))
+    return lookup
+
+
+def track_progress(job, items):
+    """Шаг этапа задания на каждый элемент (здесь же проверяется отмена)"""
+    for item in items:
+        job.check()
+        yield item
+        job.advance()
+
+
+def stage_progress(job):
+    """Обработчик progress(этап, сделано, всего) для build_epub"""
+    def progress(stage, done, total):
+        if done:
+            job.advance()
+        else:
+            job.stage(stage, total)
+    return progress
+
+
+def iter_chapters(export_files, images, base_path, graph=None, dependencies=None):
+    """Обработанные главы книги по одной (генератор)"""
+    if graph:
+        contents = (content for _, content in graph.iter_outputs(
+            [file_info['path'] for file_info in export_files],
+            image_embedder(images, base_path, dependencies)
+        ))
+    else:
+        contents = (process_note_file(file_info['path']) for file_info in export_files)
     
-    # 5. Убираем лишние переносы строк
-    content = re.sub(r'\n{3,}', '\n\n', content)
+    for file_info, content in zip(export_files, contents):
+        # Не добавляем заголовок главы если в контенте уже есть заголовок
+        if not content.lstrip().startswith('#'):
+            chapter_title = file_info['name'].replace('.md', '')
+            yield f"# {chapter_title}\n\n{content}"
+        else:
+            yield content
+
+
+def run_ebook_convert(job, input_path, epub_path, title):
+    """Конвертация markdown в EPUB через Calibre ebook-convert.
+
+    Вывод Calibre построчно попадает в журнал задания, процесс
+    завершается при отмене задания и по истечении таймаута из настроек.
+    Возвращает (код возврата, stderr).
+    """
+    # Команда Calibre ebook-convert - с оглавлением для каждого файла
+    cmd = [
+        'ebook-convert',
+        input_path,  # input file
+        epub_path,   # output file
+        '--title', title,
+        '--authors', '',
+        '--publisher', '',
+        '--book-producer', '',
+        '--language', 'ru',
+        '--enable-heuristics',
+        '--markdown-extensions', 'markdown.extensions.extra,markdown.extensions.nl2br,markdown.extensions.sane_lists',
+        '--chapter', '//h:h1',  # Каждый H1 - новая глава
+        '--chapter-mark', 'pagebreak',  # Разрыв страницы перед главой
+        '--page-breaks-before', '//h:h1',  # Разрыв страницы перед H1
+        '--insert-blank-line',  # Пустые строки между абзацами
+        '--insert-blank-line-size', '0.5',
+        '--level1-toc', '//h:h1',  # H1 в оглавлении уровня 1
+        '--level2-toc', '//h:h2',  # H2 в оглавлении уровня 2
+        '--level3-toc', '//h:h3',  # H3 в оглавлении уровня 3
+        '--toc-title', 'Оглавление',  # Название оглавления
+        '--max-toc-links', '1000',  # Максимум ссылок в оглавлении
+        '--duplicate-links-in-toc'  # Дубликаты ссылок в оглавлении
+    ]
     
-    return content.strip()
+    # Выполняем команду
+    return run_process(job, cmd, get_convert_timeout())
+
+
+def write_combined_markdown(chapters, output_path):
+    """Запись глав в один markdown файл, возвращает число глав"""
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for chapter in chapters:
+            if count:
+                f.write('\n\n')
+            f.write(chapter)
+            count += 1
+    return count
+
+
+def get_epub_backend():
+    """Сборщик EPUB: 'native' (встроенный) или 'ebook-convert' (Calibre)"""
+    backend = db.get_setting('epub_backend')
+    return backend if backend in EPUB_BACKENDS else 'native'
+
+
+def get_export_workers():
+    """Число процессов обработки заметок при экспорте (1 - без пула)"""
+    try:
+        return max(1, int(db.get_setting('export_workers') or 1))
+    except ValueError:
+        return 1
+
+
+def get_convert_timeout():
+    """Таймаут ebook-convert в секундах (0 - без ограничения)"""
+    try:
+        return max(0, int(db.get_setting('ebook_convert_timeout') or DEFAULT_CONVERT_TIMEOUT))
+    except ValueError:
+        return DEFAULT_CONVERT_TIMEOUT
+
+
+def get_copy_to_downloads():
+    """Копировать ли готовые книги в ~/Downloads (кроме скачивания по ссылке)"""
+    return db.get_setting('copy_to_downloads') == '1'
 
 
-def process_embeds(content, file_path, base_path, images_dir, visited_files=None):
-    """Обработка вставок страниц Obsidian (![[filename]])"""
-    if visited_files is None:
-        visited_files = set()
+def get_export_retention_days():
+    """Сколько дней хранятся неиспользуемые готовые книги (0 - без ограничения)"""
+    try:
+        return max(0, int(db.get_setting('export_retention_days') or DEFAULT_EXPORT_RETENTION_DAYS))
+    except ValueError:
+        return DEFAULT_EXPORT_RETENTION_DAYS
+
+
+def get_image_profile(name=None):
+    """Профиль устройства для изображений (None - без перекодирования).
+
+    name переопределяет профиль из настроек ('original' - без перекодирования).
+    """
+    return IMAGE_PROFILES.get(name or db.get_setting('image_profile') or 'original')
+
+
+def get_image_workers():
+    """Число потоков перекодирования изображений (0 - в потоке экспорта)"""
+    try:
+        return max(0, int(db.get_setting('image_workers') or DEFAULT_IMAGE_WORKERS))
+    except ValueError:
+        return DEFAULT_IMAGE_WORKERS
+
+
+def get_image_executor():
+    """Общий пул потоков перекодирования изображений (None - без пула).
+
+    Pillow отпускает GIL при декодировании, масштабировании и сжатии,
+    поэтому потоки перекодируют параллельно без запуска процессов. При
+    смене числа потоков старый пул закрывается без ожидания: уже
+    отправленные в него изображения он все равно перекодирует.
+    """
+    global image_executor
+    workers = get_image_workers()
+    with image_executor_lock:
+        if image_executor and image_executor[0] != workers:
+            image_executor[1].shutdown(wait=False)
+            image_executor = None
+        if image_executor is None and workers:
+            image_executor = (workers, ThreadPoolExecutor(max_workers=workers,
+                                                          thread_name_prefix='images'))
+        return image_executor[1] if image_executor else None
+
+
+def get_image_optimizer(profile, diagnostics, pool=None):
+    """Перекодировщик изображений экспорта по профилю (None - изображения как есть).
+
+    Перекодирование идет в пуле процессов экспорта pool (см.
+    acquire_export_pool), без него - в общем пуле потоков (см.
+    get_image_executor) и только при image_workers = 0 - в потоке
+    экспорта. Если профиль выбран, а Pillow не установлен, в
+    diagnostics добавляется предупреждение.
+    """
+    if profile is None:
+        return None
+    if not pillow_available():
+        diagnostics.append({
+            'type': 'warning', 'source': None, 'target': None,
+            'message': 'Pillow не установлен: изображения добавлены без перекодирования'
+        })
+        return None
+    return ImageOptimizer(profile, executor=pool or get_image_executor())
+
+
+def get_export_job_workers():
+    """Сколько заданий экспорта выполняется одновременно"""
+    try:
+        return max(1, int(db.get_setting('export_job_workers') or 2))
+    except ValueError:
+        return 2
+
+
+def acquire_export_pool(workers):
+    """Общий пул процессов для экспорта (вернуть через release_export_pool).
+
+    При смене числа процессов создается новый пул. Старый закрывается,
+    только когда его отпустит последний использующий его экспорт -
+    иначе отправка задач в закрытый пул падала бы посреди экспорта.
+    """
+    global export_pool
+    with export_pool_lock:
+        if export_pool and export_pool[0] != workers:
+            retire_export_pool(export_pool[1])
+            export_pool = None
+        if export_pool is None:
+            export_pool = (workers, ProcessPoolExecutor(max_workers=workers))
+            export_pool_users[export_pool[1]] = 0
+        executor = export_pool[1]
+        export_pool_users[executor] += 1
+        return executor
+
+
+def release_export_pool(executor):
+    """Возврат пула; замененный пул закрывается после последнего экспорта"""
+    with export_pool_lock:
+        export_pool_users[executor] -= 1
+        if not (export_pool and export_pool[1] is executor):
+            retire_export_pool(executor)
+
+
+def retire_export_pool(executor):
+    """Закрытие замененного пула, если им никто не пользуется (под export_pool_lock)"""
+    if not export_pool_users[executor]:
+        del export_pool_users[executor]
+        executor.shutdown(wait=False)
+
+
+def prefetch_notes(paths, base_path, pool, workers):
+    """Параллельная обработка заметок и всех их вставок в пуле процессов.
+
+    Заметки разбираются уровнями: выбранные, затем вставленные в них и
+    так далее. Результаты попадают в кэш заметок, после чего граф
+    вставок и сборка глав идут в основном процессе в порядке книги -
+    поэтому имена изображений назначаются так же, как без пула.
+    """
+    note_cache = get_note_cache(base_path)
+    pending = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+    seen = set(pending)
     
-    # Добавляем текущий файл в посещенные для предотвращения циклических ссылок
-    current_file = os.path.abspath(file_path)
-    if current_file in visited_files:
-        return content
-    visited_files.add(current_file)
+    while pending:
+        found = []
+        for file_path, parts in note_cache.prefetch(pending, pool, workers).items():
+            for embed_name in parts[1::2]:
+                if is_image_embed(embed_name):
+                    continue
+                name, _ = split_embed_target(embed_name)
+                embed_path = find_markdown_file(name, base_path) if name else None
+                if embed_path:
+                    embed_path = os.path.abspath(embed_path)
+                    if embed_path not in seen:
+                        seen.add(embed_path)
+                        found.append(embed_path)
+        pending = found
+
+
+def get_scan_workers():
+    """Число потоков сканера хранилища (1 - последовательный обход)"""
+    try:
+        return max(1, int(db.get_setting('scan_workers') or 1))
+    except ValueError:
+        return 1
+
+
+def get_scan_rules(project):
+    """Правила исключения/включения путей проекта"""
+    return ScanRules.from_json(db.get_setting(f"scan_rules:{project['id']}"))
+
+
+def refresh_project_index(project):
+    """Актуализация индекса хранилища проекта со снимком в базе данных"""
+    index = get_vault_index(project['path'])
+    index.workers = get_scan_workers()
+    index.set_rules(get_scan_rules(project))
+    project_id = project['id']
+    index.attach_store(
+        lambda: db.get_vault_snapshot(project_id),
+        lambda changed, removed: db.save_vault_changes(project_id, changed, removed)
+    )
+    index.refresh()
+    return index
+
+
+def sync_vault_watcher():
+    """Запуск наблюдателя для текущего проекта, если он включен в настройках"""
+    global vault_watcher
+    enabled = db.get_setting('vault_watcher') == '1'
     
-    def replace_embed(match):
-        embed_name = match.group(1)
-        
-        # Проверяем, не является ли это изображением
-        _, ext = os.path.splitext(embed_name)
-        if ext.lower() in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp']:
-            # Обрабатываем как изображение
-            return process_single_image(embed_name, file_path, images_dir, base_path)
-        
-        # Ищем markdown файл для вставки
-        embed_file_path = find_markdown_file(embed_name, base_path)
-        
-        if embed_file_path and os.path.exists(embed_file_path):
-            try:
-                # Читаем содержимое файла
-                with open(embed_file_path, 'r', encoding='utf-8') as f:
-                    embed_content = f.read()
-                
-                # Рекурсивно обрабатываем содержимое (для вложенных вставок)
-                embed_content = process_obsidian_content(
-                    embed_content, embed_file_path, images_dir, base_path
-                )
-                
-                # Добавляем разделитель без длинного имени
-                return f"\n\n{embed_content}\n\n"
-                
-            except Exception as e:
-                print(f"Ошибка при обработке вставки {embed_name}: {e}")
-                return ''
-        else:
-            return ''
+    if vault_watcher and (not enabled or not current_project or
+                          vault_watcher.index.base_path !=
+                          os.path.abspath(current_project['path'])):
+        vault_watcher.stop()
+        vault_watcher = None
     
-    # Заменяем все вставки
-    content = re.sub(r'!\[\[([^\]]+)\]\]', replace_embed, content)
+    if enabled and current_project and vault_watcher is None:
+        vault_watcher = VaultWatcher(refresh_project_index(current_project))
+        vault_watcher.start()
+
+
+def get_files_from_folder(base_path, folder_path):
+    """Получение файлов из указанной папки (из снимка хранилища)"""
+    return get_vault_index(base_path).get_files(folder_path)
+
+
+def build_folder_tree(base_path, folder_states=None, path='', depth=None):
+    """Построение дерева папок с состояниями (из снимка хранилища)"""
+    return get_vault_index(base_path).build_tree(folder_states, path, depth)
+
+
+def process_obsidian_content(content, file_path=None, images_dir=None, base_path=None):
+    """Минимальная обработка Obsidian контента - только критически необходимое.
+
+    Front matter, callout'ы, вставки, ссылки и лишние переносы строк
+    обрабатываются за один проход (obsidian_markdown), блоки кода
+    остаются без изменений.
+    """
+    parts = parse_obsidian_markdown(content)
+    # Вставки обрабатываем только если есть папки
+    if not (file_path and base_path and images_dir):
+        return render_obsidian_markdown(parts)
     
-    # Убираем текущий файл из посещенных
-    visited_files.discard(current_file)
+    graph = build_transclusion_graph(base_path)
+    graph.add(file_path, parts)
+    render_transclusions(graph, ImageStager(images_dir), base_path)
+    return graph.output(file_path)
+
+
+def process_note_file(file_path, images_dir=None, base_path=None):
+    """Обработка файла заметки через кэш обработанных заметок проекта"""
+    if not (base_path and images_dir):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return process_obsidian_content(f.read())
     
-    return content
+    graph = build_transclusion_graph(base_path)
+    graph.add(file_path)
+    render_transclusions(graph, ImageStager(images_dir), base_path)
+    return graph.output(file_path)
+
+
+def build_transclusion_graph(base_path):
+    """Граф вставок, читающий заметки через кэш проекта"""
+    note_cache = get_note_cache(base_path)
+    return TransclusionGraph(
+        note_cache.get_parts,
+        lambda embed_name, file_path: find_markdown_file(embed_name, base_path),
+        note_cache.get_sections
+    )
+
+
+def render_transclusions(graph, images, base_path):
+    """Обработка всех заметок графа (изображения добавляются в images)"""
+    return graph.render(image_embedder(images, base_path))
+
+
+def image_embedder(images, base_path, dependencies=None):
+    """Обработчик вставок изображений для графа вставок"""
+    def embed_image(image_name, file_path):
+        return process_single_image(image_name, file_path, images, base_path, dependencies)
+    return embed_image
 
 
 def find_markdown_file(filename, base_path):
-    """Поиск markdown файла по имени"""
-    # Если filename уже содержит расширение .md
-    if filename.endswith('.md'):
-        search_name = filename
-    else:
-        search_name = f"{filename}.md"
-    
-    # Поиск рекурсивно по всему проекту
-    for root, dirs, files in os.walk(base_path):
-        # Исключаем папки attachments
-        dirs[:] = [d for d in dirs 
-                  if not d.startswith('.') and
-                  not d.endswith('_Attachment') and
-                  not d.endswith('_Attachments') and
-                  not d.endswith('Attachment')]
-        
-        if search_name in files:
-            return os.path.join(root, search_name)
-    
-    return None
+    """Поиск markdown файла по имени через индекс хранилища"""
+    return get_vault_index(base_path).find_note(filename)
 
 
-def process_single_image(image_name, file_path, images_dir, base_path):
-    """Обработка одного изображения"""
-    if not images_dir:
+def process_single_image(image_name, file_path, images, base_path, dependencies=None):
+    """Обработка одного изображения (images - ImageStager книги,
+    в dependencies записываются поиск и версия изображения)"""
+    if images is None:
         return f'*[Изображение: {image_name}]*'
     
-    # Ищем изображение в разных местах
-    possible_paths = []
-    
-    # Папка с самим файлом
+    # Ищем изображение через индекс вложений (ближайший к заметке путь)
+    index = get_vault_index(base_path)
     file_dir = os.path.dirname(file_path)
-    possible_paths.append(os.path.join(file_dir, image_name))
+    img_path = index.find_attachment(image_name, file_dir)
+    if img_path and not os.path.exists(img_path):
+        # Индекс устарел - проверяем изменившиеся папки и ищем снова
+        index.refresh()
+        img_path = index.find_attachment(image_name, file_dir)
     
-    # Папки attachments рядом с файлом
-    possible_paths.append(os.path.join(file_dir, '_Attachments', image_name))
-    possible_paths.append(os.path.join(file_dir, '_Attachment', image_name))
-    possible_paths.append(os.path.join(file_dir, 'Attachments', image_name))
-    possible_paths.append(os.path.join(file_dir, 'Attachment', image_name))
+    if dependencies is not None:
+        dependencies.add_lookup('image', image_name, file_path, img_path)
+        if img_path:
+            dependencies.add_file(img_path)
     
-    # Папки attachments в корне проекта
-    possible_paths.append(os.path.join(base_path, '_Attachments', image_name))
-    possible_paths.append(os.path.join(base_path, '_Attachment', image_name))
-    possible_paths.append(os.path.join(base_path, 'Attachments', image_name))
-    possible_paths.append(os.path.join(base_path, 'Attachment', image_name))
-    
-    # Поиск рекурсивно по всему проекту
-    for root, dirs, files in os.walk(base_path):
-        if image_name in files:
-            possible_paths.append(os.path.join(root, image_name))
-    
-    # Пытаемся найти изображение
-    for img_path in possible_paths:
-        if os.path.exists(img_path):
-            try:
-                # Определяем расширение
-                _, ext = os.path.splitext(image_name)
-                if ext.lower() in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp']:
-                    # Копируем изображение с коротким именем
-                    file_ext = os.path.splitext(image_name)[1]
-                    short_name = f"image_{len(os.listdir(images_dir)) + 1}{file_ext}"
-                    dest_path = os.path.join(images_dir, short_name)
-                    shutil.copy2(img_path, dest_path)
-                    
-                    # Возвращаем markdown ссылку без подписи
-                    return f'![](images/{short_name})'
-            except Exception as e:
-                print(f"Ошибка при копировании изображения {image_name}: {e}")
-                break
+    if img_path:
+        try:
+            # Одинаковые изображения попадают в книгу один раз
+            short_name = images.stage(img_path)
+            
+            # Возвращаем markdown ссылку без подписи
+            return f'![](images/{short_name})'
+        except Exception as e:
+            print(f"Ошибка при добавлении изображения {image_name}: {e}")
     
     # Если изображение не найдено - не показываем ничего
     return ''
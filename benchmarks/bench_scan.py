@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Сравнение последовательного и параллельного сканера хранилища
+
+Создает синтетическое глубокое хранилище во временной папке и замеряет
+полное сканирование и повторную проверку (refresh) с разным числом
+потоков. Параметр --latency-ms добавляет задержку к каждому
+scandir/stat, имитируя iCloud или NFS. Результаты выводятся в JSON
+того же вида, что у run_benchmarks.py, и сравниваются через --compare.
+
+    python benchmarks/bench_scan.py --depth 5 --fanout 4 --workers 8 --latency-ms 2 \
+        --output scan.json
+    python benchmarks/bench_scan.py --workers 8 --latency-ms 2 --compare scan.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from run_benchmarks import compare, git_revision, measure  # noqa: E402
+from vault_scanner import VaultScanner  # noqa: E402
+
+
+def make_deep_vault(root, depth, fanout, notes_per_dir):
+    """Дерево папок глубины depth с fanout подпапками на уровень"""
+    def fill(path, level):
+        os.makedirs(path, exist_ok=True)
+        for i in range(notes_per_dir):
+            with open(os.path.join(path, f'Заметка {level}-{i}.md'), 'w',
+                      encoding='utf-8') as f:
+                f.write(f'# Заметка {i}\n\nТекст на уровне {level}.\n')
+        if level < depth:
+            for i in range(fanout):
+                fill(os.path.join(path, f'Папка {level}-{i}'), level + 1)
+
+    fill(root, 0)
+
+
+def add_latency(latency):
+    """Задержка на каждый вызов scandir/stat (как у сетевого хранилища)"""
+    real_scandir = os.scandir
+    real_stat = os.stat
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(latency)
+        return real_scandir(*args, **kwargs)
+
+    def slow_stat(*args, **kwargs):
+        time.sleep(latency)
+        return real_stat(*args, **kwargs)
+
+    os.scandir = slow_scandir
+    os.stat = slow_stat
+
+
+def measure_scanner(base_path, workers, repeat):
+    """Полное сканирование и повторная проверка, дерево последнего сканирования"""
+    scanners = []
+
+    def new_scanner():
+        scanners.append(VaultScanner(base_path, workers=workers))
+
+    full = measure(lambda: scanners[-1].refresh(), repeat, setup=new_scanner)
+    refresh = measure(lambda: scanners[-1].refresh(), repeat)
+    return full, refresh, scanners[-1].build_tree()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--notes-per-dir', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='файл для JSON результатов (по умолчанию stdout)')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='obs2epub-bench-')
+    try:
+        make_deep_vault(root, args.depth, args.fanout, args.notes_per_dir)
+        if args.latency_ms:
+            add_latency(args.latency_ms / 1000)
+
+        serial_full, serial_refresh, serial_tree = measure_scanner(root, 1, args.repeat)
+        par_full, par_refresh, par_tree = measure_scanner(root, args.workers, args.repeat)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {
+                'depth': args.depth,
+                'fanout': args.fanout,
+                'notes_per_dir': args.notes_per_dir,
+                'workers': args.workers,
+                'latency_ms': args.latency_ms,
+                'repeat': args.repeat
+            },
+            'vault': {'notes': serial_tree['total_files_count']}
+        },
+        'results': {
+            'scan_parallel.full.serial': serial_full,
+            'scan_parallel.full.parallel': par_full,
+            'scan_parallel.refresh.serial': serial_refresh,
+            'scan_parallel.refresh.parallel': par_refresh
+        },
+        'trees_equal': serial_tree == par_tree
+    }
+    if args.compare:
+        report['comparison'] = compare(report, args.compare)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
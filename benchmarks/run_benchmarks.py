@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Набор бенчмарков: сканирование, обработка заметок, база данных и экспорт
+
+Генерирует синтетическое хранилище (synthetic_vault.py), замеряет
+основные этапы и выводит результаты в JSON. ebook-convert заменяется
+заглушкой в PATH, которая копирует markdown как есть, поэтому
+замеряется только собственная работа приложения.
+
+    python benchmarks/run_benchmarks.py --notes 2000 --output before.json
+    python benchmarks/run_benchmarks.py --notes 2000 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_vault import generate_vault  # noqa: E402
+
+EBOOK_CONVERT_STUB = '#!/bin/sh\ncp "$1" "$2"\n'
+
+
+def measure(fn, repeat, setup=None):
+    """Время выполнения fn (setup не замеряется)"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+        'mean': round(statistics.mean(times), 6),
+        'runs': len(times)
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def install_stubs(work_dir):
+    """Заглушка ebook-convert, отдельный HOME (экспорт может копировать в
+    ~/Downloads) и отдельная папка кэша"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    stub = os.path.join(bin_dir, 'ebook-convert')
+    with open(stub, 'w') as f:
+        f.write(EBOOK_CONVERT_STUB)
+    os.chmod(stub, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+    home = os.path.join(work_dir, 'home')
+    os.makedirs(os.path.join(home, 'Downloads'))
+    os.environ['HOME'] = home
+    os.environ['OBS2EPUB_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='obs2epub-bench-')
+    vault = os.path.join(work_dir, 'vault')
+    results = {}
+    try:
+        started = time.perf_counter()
+        generated = generate_vault(vault, args.notes, args.depth, args.fanout,
+                                   args.embed_density, args.images,
+                                   args.frontmatter_ratio, seed=args.seed)
+        generate_seconds = time.perf_counter() - started
+
+        install_stubs(work_dir)
+        # app создает базу данных в текущей папке
+        os.chdir(work_dir)
+        import app
+        import vault_index
+        from obsidian_markdown import transform_obsidian_markdown
+        from note_cache import NoteCache
+
+        def reset_index():
+            vault_index._indexes.clear()
+
+        # --- Сканирование ---
+        results['scan.build_folder_tree.cold'] = measure(
+            lambda: app.build_folder_tree(vault), args.repeat, setup=reset_index)
+        results['scan.refresh.unchanged'] = measure(
+            lambda: vault_index.get_vault_index(vault).refresh(), args.repeat)
+        results['scan.build_folder_tree.warm'] = measure(
+            lambda: app.build_folder_tree(vault), args.repeat)
+        results['scan.get_files_from_folder'] = measure(
+            lambda: app.get_files_from_folder(vault, ''), args.repeat)
+
+        # --- Обработка заметок ---
+        contents = []
+        for path in generated['notes']:
+            with open(path, 'r', encoding='utf-8') as f:
+                contents.append((path, f.read()))
+        images_dir = os.path.join(work_dir, 'images')
+
+        def fresh_images_dir():
+            shutil.rmtree(images_dir, ignore_errors=True)
+            os.makedirs(images_dir)
+
+        def process_all():
+            for path, content in contents:
+                app.process_obsidian_content(content, path, images_dir, vault)
+
+        def transform_all():
+            for _, content in contents:
+                transform_obsidian_markdown(content)
+
+        results['markdown.process_obsidian_content'] = measure(
+            process_all, args.repeat, setup=fresh_images_dir)
+        results['markdown.transform'] = measure(transform_all, args.repeat)
+
+        # Холодная обработка всех заметок: без пула и в пуле процессов
+        note_paths = [path for path, _ in contents]
+        results['markdown.prefetch.serial'] = measure(
+            lambda: NoteCache().prefetch(note_paths), args.repeat)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            # Первый вызов запускает процессы пула
+            NoteCache().prefetch(note_paths[:args.workers * 2], pool, args.workers)
+            results[f'markdown.prefetch.workers_{args.workers}'] = measure(
+                lambda: NoteCache().prefetch(note_paths, pool, args.workers), args.repeat)
+
+        # --- База данных ---
+        files_data = app.get_files_from_folder(vault, '')
+        db = app.db
+        project = db.create_or_update_project('bench', vault)
+        db.set_active_project(project['id'])
+        project_id = project['id']
+
+        def clear_files():
+            db.remove_files_from_folder(project_id, '')
+
+        results['db.add_files_to_project'] = measure(
+            lambda: db.add_files_to_project(project_id, files_data),
+            args.repeat, setup=clear_files)
+        results['db.get_project_files'] = measure(
+            lambda: db.get_project_files(project_id), args.repeat)
+        results['db.get_included_files'] = measure(
+            lambda: db.get_included_files(project_id), args.repeat)
+        project_files = db.get_project_files(project_id)
+        file_orders = [(f['id'], i) for i, f in enumerate(reversed(project_files))]
+        results['db.update_file_order'] = measure(
+            lambda: db.update_file_order(project_id, file_orders), args.repeat)
+        results['db.set_folder_state'] = measure(
+            lambda: db.set_folder_state(project_id, 'Раздел 1.1', True, True),
+            args.repeat)
+
+        index = vault_index.get_vault_index(vault)
+        index.refresh()
+        dirs = dict(index._dirs)
+        results['db.save_vault_changes'] = measure(
+            lambda: db.save_vault_changes(project_id, dirs, []),
+            args.repeat, setup=lambda: db.clear_vault_snapshot(project_id))
+        results['db.get_vault_snapshot'] = measure(
+            lambda: db.get_vault_snapshot(project_id), args.repeat)
+
+        # --- Экспорт (ebook-convert заменен заглушкой) ---
+        client = app.app.test_client()
+        client.post('/api/set-project', json={'path': vault, 'name': 'bench'})
+        export_files = db.get_project_files(project_id)
+        downloads = os.path.join(os.environ['HOME'], 'Downloads')
+
+        def export():
+            response = client.post('/api/export-epub', json={
+                'files': export_files, 'title': 'Бенчмарк'
+            }).get_json()
+            if not response.get('success'):
+                raise RuntimeError(response.get('error'))
+
+        def clear_downloads():
+            for name in os.listdir(downloads):
+                os.remove(os.path.join(downloads, name))
+
+        def clear_export_store():
+            shutil.rmtree(app.get_export_store().root, ignore_errors=True)
+
+        def rebuild():
+            # Готовая книга из хранилища отдавалась бы без сборки
+            clear_downloads()
+            clear_export_store()
+
+        # Встроенный сборщик (по умолчанию) и ebook-convert (заглушка)
+        client.post('/api/export-settings', json={'backend': 'native'})
+        results['export.export_epub'] = measure(
+            export, args.repeat, setup=rebuild)
+
+        # Книга без изменений - из хранилища готовых книг
+        export()
+        results['export.export_epub.cached'] = measure(
+            export, args.repeat, setup=clear_downloads)
+
+        # Повторный экспорт после правки одной заметки (остальные главы - из кэша)
+        edited_note = export_files[len(export_files) // 2]['path']
+
+        def edit_one_note():
+            clear_downloads()
+            with open(edited_note, 'a', encoding='utf-8') as f:
+                f.write('\n\nПравка.\n')
+
+        results['export.export_epub.one_changed'] = measure(
+            export, args.repeat, setup=edit_one_note)
+        client.post('/api/export-settings', json={'backend': 'ebook-convert'})
+        results['export.export_epub.ebook_convert'] = measure(
+            export, args.repeat, setup=rebuild)
+        client.post('/api/export-settings', json={'backend': 'native'})
+
+        # Пакетный экспорт: книга на каждую папку верхнего уровня (без
+        # готовых книг в хранилище, с общими индексом и кэшем заметок)
+        top_folders = [folder for folder in generated['folders']
+                       if folder and os.sep not in folder]
+
+        def batch_export(folders=top_folders):
+            response = client.post(f'/api/projects/{project_id}/batch-export', json={
+                'books': [{'folder': folder} for folder in folders]
+            }).get_json()
+            if not response.get('success'):
+                raise RuntimeError(response.get('error'))
+            for job_info in response['jobs']:
+                job = app.get_export_jobs().get(job_info['id'])
+                job.join()
+                if job.state != 'done':
+                    raise RuntimeError(job.error)
+
+        def sequential_exports():
+            for folder in top_folders:
+                batch_export([folder])
+
+        # Главы преобразуются в пуле процессов: пакет должен быть
+        # быстрее тех же книг, собранных по одной
+        client.post('/api/export-settings', json={'workers': args.workers})
+        results['export.batch_export'] = measure(
+            batch_export, args.repeat, setup=clear_export_store)
+        results['export.batch_export.sequential'] = measure(
+            sequential_exports, args.repeat, setup=clear_export_store)
+
+        return {
+            'meta': {
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': {
+                    'notes': args.notes,
+                    'depth': args.depth,
+                    'fanout': args.fanout,
+                    'embed_density': args.embed_density,
+                    'images': args.images,
+                    'frontmatter_ratio': args.frontmatter_ratio,
+                    'seed': args.seed,
+                    'repeat': args.repeat,
+                    'workers': args.workers
+                },
+                'vault': {
+                    'notes': len(generated['notes']),
+                    'images': len(generated['images']),
+                    'folders': len(generated['folders']),
+                    'generate_seconds': round(generate_seconds, 3)
+                }
+            },
+            'results': results
+        }
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(current, baseline_path):
+    """Сравнение медиан с сохраненным результатом (>1 - стало медленнее)"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    comparison = {}
+    for name, stats in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if old and old['median']:
+            comparison[name] = round(stats['median'] / old['median'], 3)
+    return {'baseline_revision': baseline.get('meta', {}).get('revision'),
+            'ratio': comparison}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--notes', type=int, default=500)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--embed-density', type=float, default=0.5)
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--frontmatter-ratio', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='число процессов для параллельной обработки заметок')
+    parser.add_argument('--output', help='файл для JSON результатов (по умолчанию stdout)')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.compare:
+        report['comparison'] = compare(report, args.compare)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
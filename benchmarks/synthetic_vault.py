@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Генератор воспроизводимых синтетических хранилищ Obsidian
+
+Одинаковые параметры и seed дают байт-в-байт одинаковое хранилище,
+поэтому результаты бенчмарков сравнимы между версиями.
+
+    python benchmarks/synthetic_vault.py /tmp/vault --notes 2000 --depth 4
+"""
+import argparse
+import base64
+import os
+import random
+
+# PNG 1x1, чтобы картинки были настоящими файлами изображений
+TINY_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='
+)
+
+WORDS = ('заметка текст пример книга глава раздел идея вывод вопрос ответ '
+         'note text example book chapter section idea result').split()
+
+
+def make_folders(rng, depth, fanout):
+    """Список относительных путей папок (корень - '')"""
+    folders = ['']
+    level = ['']
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(rng.randint(1, fanout)):
+                name = f'Раздел {d + 1}.{i + 1}'
+                next_level.append(os.path.join(parent, name) if parent else name)
+        folders.extend(next_level)
+        level = next_level
+    return folders
+
+
+def make_paragraph(rng, words=40):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def generate_vault(root, notes=500, depth=3, fanout=3, embed_density=0.5,
+                   images=50, frontmatter_ratio=0.7, paragraphs=8, seed=42):
+    """Создание хранилища в папке root.
+
+    embed_density - среднее число вставок ![[заметка]] на заметку,
+    images - число картинок в папках _Attachments (каждая вставлена
+    в случайную заметку), frontmatter_ratio - доля заметок с YAML.
+    Возвращает словарь с путями созданных заметок и картинок.
+    """
+    rng = random.Random(seed)
+    folders = make_folders(rng, depth, fanout)
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    note_names = [f'Заметка {i:05d}' for i in range(notes)]
+    note_folders = [rng.choice(folders) for _ in range(notes)]
+
+    image_names = [f'image_{i:05d}.png' for i in range(images)]
+    image_folders = [rng.choice(folders) for _ in range(images)]
+    image_embeds = {}
+    if notes:
+        for name in image_names:
+            image_embeds.setdefault(rng.randrange(notes), []).append(name)
+
+    note_paths = []
+    for i, name in enumerate(note_names):
+        parts = []
+        if rng.random() < frontmatter_ratio:
+            parts.append('---\n'
+                         f'title: {name}\n'
+                         f'tags: [{rng.choice(WORDS)}, {rng.choice(WORDS)}]\n'
+                         f'created: 2024-01-{rng.randint(1, 28):02d}\n'
+                         '---')
+        parts.append(f'# {name}')
+
+        embeds = int(embed_density) + (1 if rng.random() < embed_density % 1 else 0)
+        for p in range(paragraphs):
+            parts.append(make_paragraph(rng))
+            if p == 1:
+                parts.append(f'> [!note] {rng.choice(WORDS)}\n> {make_paragraph(rng, 12)}')
+            if p == 2:
+                parts.append(f'См. [[{rng.choice(note_names)}]] и '
+                             f'[[{rng.choice(note_names)}|{rng.choice(WORDS)}]].')
+            if p == 3:
+                parts.append('```python\nprint("[[не ссылка]]")\n```')
+            if p == 4 and rng.random() < 0.3:
+                parts.append(f'## {rng.choice(WORDS).capitalize()}\n\n{make_paragraph(rng)}')
+        for _ in range(embeds):
+            parts.append(f'![[{rng.choice(note_names)}]]')
+        for image in image_embeds.get(i, []):
+            parts.append(f'![[{image}]]')
+
+        path = os.path.join(root, note_folders[i], f'{name}.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n\n'.join(parts) + '\n')
+        note_paths.append(path)
+
+    image_paths = []
+    for name, folder in zip(image_names, image_folders):
+        attachments = os.path.join(root, folder, '_Attachments')
+        os.makedirs(attachments, exist_ok=True)
+        path = os.path.join(attachments, name)
+        with open(path, 'wb') as f:
+            f.write(TINY_PNG)
+        image_paths.append(path)
+
+    return {'folders': folders, 'notes': note_paths, 'images': image_paths}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root')
+    parser.add_argument('--notes', type=int, default=500)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--embed-density', type=float, default=0.5)
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--frontmatter-ratio', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    result = generate_vault(args.root, args.notes, args.depth, args.fanout,
+                            args.embed_density, args.images,
+                            args.frontmatter_ratio, seed=args.seed)
+    print(f"Создано: {len(result['notes'])} заметок, {len(result['images'])} картинок, "
+          f"{len(result['folders'])} папок в {args.root}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Кэш глав EPUB (готового XHTML) между экспортами
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from note_cache import disk_entries, project_cache_dir, prune_disk_entries
+
+# Версия преобразования Markdown → XHTML: увеличивается при любом
+# изменении результата (расширения, шаблон, обработка сущностей)
+RENDER_VERSION = 2
+
+
+class ChapterCache:
+    """XHTML глав по хэшу их Markdown.
+
+    Ключ - хэш текста главы вместе с версией и настройками
+    преобразования, поэтому записи не устаревают: изменившаяся глава
+    просто получает новый ключ. При повторном экспорте python-markdown
+    запускается только для изменившихся глав, остальные берутся с диска.
+    Размер кэша ограничен max_bytes: при превышении удаляются давно не
+    использованные записи (время использования - mtime файла).
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Суммарный размер записей (None - еще не подсчитан)
+        self._bytes: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, *config) -> str:
+        """Ключ главы: хэш Markdown, версии и настроек преобразования"""
+        digest = hashlib.sha1(json.dumps([RENDER_VERSION, config]).encode('utf-8'))
+        digest.update(text.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key: str) -> Optional[dict]:
+        """Запись главы {'body': XHTML, 'toc': [[уровень, заголовок, id], ...]}"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                chapter = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return chapter
+
+    def put(self, key: str, body: str, toc: List[list]):
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        data = json.dumps({'body': body, 'toc': toc}, ensure_ascii=False).encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Ошибка записи кэша главы: {e}")
+            return
+
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += len(data)
+        if self._size() > self.max_bytes:
+            self.prune()
+
+    def _size(self) -> int:
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in disk_entries(self.cache_dir))
+            return self._bytes
+
+    def prune(self):
+        """Удаление давно не использованных записей до 3/4 max_bytes"""
+        total = prune_disk_entries(self.cache_dir, self.max_bytes * 3 // 4)
+        with self._lock:
+            self._bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self._bytes}
+
+
+_caches: Dict[str, ChapterCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_chapter_cache(base_path: str) -> ChapterCache:
+    """Получение (или создание) кэша глав для папки проекта"""
+    key = os.path.abspath(base_path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = ChapterCache(project_cache_dir(key, 'chapters'))
+            _caches[key] = cache
+        return cache
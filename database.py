@@ -68,6 +68,31 @@ class Database:
                 )
             ''')
             
+            # Снимок структуры хранилища: папки и файлы с размерами и mtime
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vault_dirs (
+                    project_id INTEGER NOT NULL,
+                    dir_path TEXT NOT NULL,
+                    mtime REAL,
+                    in_attachments INTEGER DEFAULT 0,
+                    subdirs TEXT,
+                    FOREIGN KEY (project_id) REFERENCES projects (id),
+                    PRIMARY KEY (project_id, dir_path)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vault_files (
+                    project_id INTEGER NOT NULL,
+                    dir_path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL,
+                    FOREIGN KEY (project_id) REFERENCES projects (id),
+                    PRIMARY KEY (project_id, dir_path, name)
+                )
+            ''')
+            
             conn.commit()
     
     def get_connection(self):
@@ -133,6 +158,15 @@ class Database:
             
             conn.commit()
     
+    def get_project(self, project_id):
+        """Получение проекта по id"""
+        with self.get_connection() as conn:
+            conn.row_factory = self.dict_factory
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM projects WHERE id = ?', (project_id,))
+            return cursor.fetchone()
+    
     def get_all_projects(self):
         """Получение всех проектов"""
         with self.get_connection() as conn:
@@ -150,6 +184,10 @@ class Database:
             # Удаляем файлы проекта
             cursor.execute('DELETE FROM files WHERE project_id = ?', (project_id,))
             
+            # Удаляем снимок хранилища
+            cursor.execute('DELETE FROM vault_files WHERE project_id = ?', (project_id,))
+            cursor.execute('DELETE FROM vault_dirs WHERE project_id = ?', (project_id,))
+            
             # Удаляем проект
             cursor.execute('DELETE FROM projects WHERE id = ?', (project_id,))
             
@@ -208,6 +246,45 @@ class Database:
             
             return cursor.fetchall()
     
+    def iter_export_files(self, project_id, include_ids=(), exclude_ids=()):
+        """Файлы для экспорта в порядке книги по одному: (id, путь, имя).
+
+        include_ids и exclude_ids - id файлов, которые только в этом
+        экспорте включаются или исключаются, независимо от выбора в базе.
+        """
+        include_ids = list(include_ids)
+        exclude_ids = set(exclude_ids)
+        placeholders = ', '.join('?' * len(include_ids))
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, path, name FROM files
+                WHERE project_id = ? AND (is_included = 1 OR id IN ({placeholders}))
+                ORDER BY file_order ASC, name ASC
+            ''', (project_id, *include_ids))
+            
+            for row in cursor:
+                if row[0] not in exclude_ids:
+                    yield row
+        finally:
+            conn.close()
+    
+    def get_files_by_ids(self, project_id, file_ids):
+        """Файлы проекта по id в заданном порядке: (id, путь, имя)"""
+        file_ids = list(file_ids)
+        if not file_ids:
+            return []
+        placeholders = ', '.join('?' * len(file_ids))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, path, name FROM files
+                WHERE project_id = ? AND id IN ({placeholders})
+            ''', (project_id, *file_ids))
+            rows = {row[0]: row for row in cursor.fetchall()}
+        return [rows[file_id] for file_id in file_ids if file_id in rows]
+    
     def toggle_file_inclusion(self, file_id, is_included):
         """Переключение включения файла в экспорт"""
         with self.get_connection() as conn:
@@ -340,6 +417,80 @@ class Database:
             
             conn.commit()
     
+    def get_vault_snapshot(self, project_id) -> Dict[str, dict]:
+        """Получение сохраненного снимка хранилища"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT dir_path, mtime, in_attachments, subdirs FROM vault_dirs
+                WHERE project_id = ?
+            ''', (project_id,))
+            
+            snapshot = {}
+            for dir_path, mtime, in_attachments, subdirs in cursor.fetchall():
+                snapshot[dir_path] = {
+                    'mtime': mtime,
+                    'in_attachments': bool(in_attachments),
+                    'subdirs': json.loads(subdirs or '[]'),
+                    'files': {}
+                }
+            
+            cursor.execute('''
+                SELECT dir_path, name, size, mtime FROM vault_files
+                WHERE project_id = ?
+            ''', (project_id,))
+            
+            for dir_path, name, size, mtime in cursor.fetchall():
+                record = snapshot.get(dir_path)
+                if record is not None:
+                    record['files'][name] = (size, mtime)
+            
+            return snapshot
+    
+    def save_vault_changes(self, project_id, changed: Dict[str, dict], removed: List[str]):
+        """Сохранение изменившихся папок снимка хранилища"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            for dir_path in list(removed) + list(changed):
+                cursor.execute('''
+                    DELETE FROM vault_files WHERE project_id = ? AND dir_path = ?
+                ''', (project_id, dir_path))
+                cursor.execute('''
+                    DELETE FROM vault_dirs WHERE project_id = ? AND dir_path = ?
+                ''', (project_id, dir_path))
+            
+            cursor.executemany('''
+                INSERT INTO vault_dirs (project_id, dir_path, mtime, in_attachments, subdirs)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (project_id, dir_path, record['mtime'],
+                 int(record['in_attachments']), json.dumps(record['subdirs']))
+                for dir_path, record in changed.items()
+            ])
+            
+            cursor.executemany('''
+                INSERT INTO vault_files (project_id, dir_path, name, size, mtime)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (project_id, dir_path, name, size, mtime)
+                for dir_path, record in changed.items()
+                for name, (size, mtime) in record['files'].items()
+            ])
+            
+            conn.commit()
+    
+    def clear_vault_snapshot(self, project_id):
+        """Удаление снимка хранилища (например, после смены правил сканирования)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM vault_files WHERE project_id = ?', (project_id,))
+            cursor.execute('DELETE FROM vault_dirs WHERE project_id = ?', (project_id,))
+            
+            conn.commit()
+    
     def get_setting(self, key):
         """Получение настройки"""
         with self.get_connection() as conn:
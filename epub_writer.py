@@ -0,0 +1,395 @@
+"""
+Сборка EPUB 3 без Calibre: Markdown → XHTML (python-markdown) → zip
+"""
+import html
+import os
+import re
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, Future
+from datetime import datetime, timezone
+from html.entities import name2codepoint
+from typing import Callable, Iterable, List, Optional, Tuple
+from xml.etree import ElementTree
+
+import markdown
+from bs4 import BeautifulSoup
+from markdown.extensions.toc import slugify_unicode
+
+from chapter_cache import ChapterCache
+
+# Те же расширения, что передаются ebook-convert (--markdown-extensions)
+MARKDOWN_EXTENSIONS = ['extra', 'nl2br', 'sane_lists', 'toc']
+
+MEDIA_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.svg': 'image/svg+xml',
+    '.webp': 'image/webp'
+}
+
+# Изображения, которые имеет смысл сжимать в архиве
+DEFLATE_MEDIA_TYPES = {'image/bmp', 'image/svg+xml'}
+
+# Именованные HTML-сущности не определены в XHTML без DTD
+ENTITY_RE = re.compile(r'&([A-Za-z][A-Za-z0-9]*);')
+XML_ENTITIES = {'amp', 'lt', 'gt', 'quot', 'apos'}
+# Имена атрибутов, допустимые в XML (прочие атрибуты из HTML в заметках отбрасываются)
+XML_NAME_RE = re.compile(r'[A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?\Z')
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+CHAPTER_XHTML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang}" xml:lang="{lang}">
+<head>
+<meta charset="UTF-8"/>
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="styles.css"/>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+
+def _xml_entity(match):
+    name = match.group(1)
+    if name in XML_ENTITIES:
+        return match.group(0)
+    codepoint = name2codepoint.get(name)
+    return f'&#{codepoint};' if codepoint else f'&amp;{name};'
+
+
+def _well_formed(body: str) -> bool:
+    try:
+        ElementTree.fromstring(f'<body>{body}</body>')
+    except ElementTree.ParseError:
+        return False
+    return True
+
+
+def html_to_xhtml(body: str) -> str:
+    """Пересборка фрагмента с HTML из заметок (<br>, незакрытые теги,
+    атрибуты без значений) в корректный XHTML"""
+    soup = BeautifulSoup(body, 'html.parser')
+    for tag in soup.find_all(True):
+        for name in [name for name in tag.attrs if not XML_NAME_RE.match(name)]:
+            del tag[name]
+    return soup.decode(formatter='minimal')
+
+
+def markdown_to_xhtml(md: markdown.Markdown, text: str) -> str:
+    """Преобразование главы в XHTML-фрагмент.
+
+    python-markdown переносит HTML из заметок как есть, поэтому
+    фрагмент, который не разбирается как XML, пересобирается через
+    BeautifulSoup (проверка expat быстрая, пересборка нужна редко).
+    """
+    md.reset()
+    body = ENTITY_RE.sub(_xml_entity, md.convert(text))
+    return body if _well_formed(body) else html_to_xhtml(body)
+
+
+def new_markdown(toc_depth: int) -> markdown.Markdown:
+    return markdown.Markdown(
+        extensions=MARKDOWN_EXTENSIONS,
+        extension_configs={'toc': {'toc_depth': f'1-{toc_depth}',
+                                   'slugify': slugify_unicode}},
+        output_format='xhtml'
+    )
+
+
+def render_chapter(md: markdown.Markdown, text: str) -> tuple:
+    """XHTML главы и ее заголовки [[уровень, заголовок, id], ...]"""
+    body = markdown_to_xhtml(md, text)
+    toc = []
+    stack = list(reversed(md.toc_tokens))
+    while stack:
+        token = stack.pop()
+        toc.append([token['level'], token['name'], token['id']])
+        stack.extend(reversed(token['children']))
+    return body, toc
+
+
+# Преобразователь Markdown процесса пула: (toc_depth, Markdown)
+_process_md = None
+
+
+def _render_chapter_job(job: tuple) -> tuple:
+    """render_chapter в процессе пула (Markdown создается один раз на процесс)"""
+    global _process_md
+    text, toc_depth = job
+    if _process_md is None or _process_md[0] != toc_depth:
+        _process_md = (toc_depth, new_markdown(toc_depth))
+    return render_chapter(_process_md[1], text)
+
+
+def _ready(rendered) -> bool:
+    return not isinstance(rendered, Future) or rendered.done()
+
+
+class EpubWriter:
+    """Потоковая запись EPUB 3.
+
+    Каждая добавленная глава сразу преобразуется в отдельный XHTML-файл
+    и записывается в архив, в памяти остается только оглавление.
+    Оглавление (nav.xhtml и toc.ncx для старых читалок) строится из
+    заголовков H1-H3, как --level1/2/3-toc у ebook-convert.
+
+    С chapter_cache XHTML глав, не изменившихся с прошлого экспорта,
+    берется из кэша без преобразования Markdown; описание книги,
+    порядок глав и оглавление собираются заново при каждой записи.
+    add_chapters с executor (пул процессов) преобразует главы
+    параллельно, записывая их в архив в исходном порядке.
+    """
+
+    def __init__(self, path: str, title: str, language: str = 'ru',
+                 css: Optional[str] = None, toc_title: str = 'Оглавление',
+                 toc_depth: int = 3, chapter_cache: Optional[ChapterCache] = None):
+        self.path = path
+        self.title = title
+        self.language = language
+        self.toc_title = toc_title
+        self.toc_depth = toc_depth
+        self.chapter_cache = chapter_cache
+        self.identifier = f'urn:uuid:{uuid.uuid4()}'
+        # (файл, заголовок главы); заголовки уже экранированы для XML
+        self.chapters: List[tuple] = []
+        # (уровень, заголовок, ссылка)
+        self.toc: List[tuple] = []
+        # (id, путь в архиве, media-type)
+        self.images: List[tuple] = []
+        self._md = new_markdown(toc_depth)
+
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        # mimetype - первым и без сжатия
+        self._zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip',
+                           compress_type=zipfile.ZIP_STORED)
+        self._zip.writestr('META-INF/container.xml', CONTAINER_XML)
+        self._zip.writestr('OEBPS/styles.css', css or '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._zip.close()
+
+    def _cached(self, text: str) -> tuple:
+        """Ключ главы в chapter_cache и ее запись оттуда (None - нет кэша или записи)"""
+        if not self.chapter_cache:
+            return None, None
+        key = self.chapter_cache.key(text, self.toc_depth)
+        cached = self.chapter_cache.get(key)
+        return key, (cached['body'], cached['toc']) if cached else None
+
+    def add_chapter(self, text: str):
+        """Добавление главы из Markdown"""
+        key, rendered = self._cached(text)
+        if rendered is None:
+            rendered = render_chapter(self._md, text)
+            if key:
+                self.chapter_cache.put(key, *rendered)
+        self._write_chapter(*rendered)
+
+    def add_chapters(self, texts: Iterable[str], executor: Optional[Executor] = None,
+                     window: int = 8):
+        """Добавление глав; с executor преобразуется до window глав одновременно"""
+        if executor is None:
+            for text in texts:
+                self.add_chapter(text)
+            return
+
+        # (ключ в кэше, (XHTML, заголовки) или Future) в порядке глав
+        pending: 'deque[tuple]' = deque()
+        try:
+            for text in texts:
+                key, rendered = self._cached(text)
+                if rendered is None:
+                    rendered = executor.submit(_render_chapter_job, (text, self.toc_depth))
+                pending.append((key, rendered))
+                # Готовые главы записываются сразу, не дожидаясь заполнения окна
+                while pending and (len(pending) > window or _ready(pending[0][1])):
+                    self._write_pending(*pending.popleft())
+            while pending:
+                self._write_pending(*pending.popleft())
+        finally:
+            for _, rendered in pending:
+                if isinstance(rendered, Future):
+                    rendered.cancel()
+
+    def _write_pending(self, key: Optional[str], rendered):
+        if isinstance(rendered, Future):
+            rendered = rendered.result()
+            if key:
+                self.chapter_cache.put(key, *rendered)
+        self._write_chapter(*rendered)
+
+    def _write_chapter(self, body: str, toc: List[list]):
+        file_name = f'chapter_{len(self.chapters) + 1:04d}.xhtml'
+        for level, name, anchor in toc:
+            self.toc.append((level, name, f'{file_name}#{anchor}'))
+        chapter_title = toc[0][1] if toc else html.escape(self.title)
+
+        self._zip.writestr(f'OEBPS/{file_name}', CHAPTER_XHTML.format(
+            lang=self.language, title=chapter_title, body=body))
+        self.chapters.append((file_name, chapter_title))
+
+    def add_image(self, file_path: str, name: str):
+        """Добавление изображения как images/<name> (так на него ссылаются главы).
+
+        Тип в манифесте определяется по самому файлу, а не по имени:
+        изображение, которое не удалось перекодировать (webp под именем
+        .jpg), объявляется в своем настоящем формате.
+        """
+        media_type = MEDIA_TYPES.get(os.path.splitext(file_path)[1].lower())
+        if not media_type:
+            return
+        arcname = f'images/{name}'
+        # Сжатые форматы повторно не сжимаются
+        compress_type = zipfile.ZIP_DEFLATED if media_type in DEFLATE_MEDIA_TYPES else zipfile.ZIP_STORED
+        self._zip.write(file_path, f'OEBPS/{arcname}', compress_type=compress_type)
+        self.images.append((f'image_{len(self.images) + 1}', arcname, media_type))
+
+    def add_images_dir(self, images_dir: str):
+        for name in sorted(os.listdir(images_dir)):
+            self.add_image(os.path.join(images_dir, name), name)
+
+    def _nav_points(self):
+        """Оглавление: (уровень, заголовок, ссылка), без пропуска уровней"""
+        entries = self.toc or [(1, chapter_title, file_name)
+                               for file_name, chapter_title in self.chapters]
+        points = []
+        previous = 0
+        for level, name, href in entries:
+            level = min(level, previous + 1)
+            points.append((level, name, href))
+            previous = level
+        return points
+
+    def _nav_xhtml(self) -> str:
+        lines = []
+        depth = 0
+        for level, name, href in self._nav_points():
+            if level > depth:
+                lines.append('<ol>' * (level - depth))
+            else:
+                lines.append('</li>' + '</ol></li>' * (depth - level))
+            depth = level
+            lines.append(f'<li><a href="{html.escape(href)}">{name}</a>')
+        if depth:
+            lines.append('</li>' + '</ol></li>' * (depth - 1) + '</ol>')
+        return CHAPTER_XHTML.format(
+            lang=self.language, title=html.escape(self.toc_title),
+            body=(f'<nav epub:type="toc" id="toc"><h1>{html.escape(self.toc_title)}</h1>\n'
+                  + '\n'.join(lines) + '\n</nav>'))
+
+    def _toc_ncx(self) -> str:
+        lines = []
+        depth = 0
+        for order, (level, name, href) in enumerate(self._nav_points(), 1):
+            lines.append('</navPoint>' * (depth - level + 1) if depth >= level else '')
+            depth = level
+            lines.append(f'<navPoint id="nav_{order}" playOrder="{order}">'
+                         f'<navLabel><text>{name}</text></navLabel>'
+                         f'<content src="{html.escape(href)}"/>')
+        lines.append('</navPoint>' * depth)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+                f'<head><meta name="dtb:uid" content="{self.identifier}"/></head>\n'
+                f'<docTitle><text>{html.escape(self.title)}</text></docTitle>\n'
+                '<navMap>' + ''.join(lines) + '</navMap>\n</ncx>\n')
+
+    def _content_opf(self) -> str:
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        manifest = [
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+            '<item id="css" href="styles.css" media-type="text/css"/>'
+        ]
+        spine = []
+        for i, (file_name, _) in enumerate(self.chapters, 1):
+            manifest.append(f'<item id="chapter_{i}" href="{file_name}" '
+                            'media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="chapter_{i}"/>')
+        for item_id, arcname, media_type in self.images:
+            manifest.append(f'<item id="{item_id}" href="{html.escape(arcname)}" '
+                            f'media-type="{media_type}"/>')
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" '
+                'unique-identifier="book-id">\n'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                f'<dc:identifier id="book-id">{self.identifier}</dc:identifier>\n'
+                f'<dc:title>{html.escape(self.title)}</dc:title>\n'
+                f'<dc:language>{self.language}</dc:language>\n'
+                f'<meta property="dcterms:modified">{modified}</meta>\n'
+                '</metadata>\n'
+                '<manifest>\n' + '\n'.join(manifest) + '\n</manifest>\n'
+                '<spine toc="ncx">\n' + '\n'.join(spine) + '\n</spine>\n'
+                '</package>\n')
+
+    def close(self):
+        """Запись оглавления и описания книги"""
+        self._zip.writestr('OEBPS/nav.xhtml', self._nav_xhtml())
+        self._zip.writestr('OEBPS/toc.ncx', self._toc_ncx())
+        self._zip.writestr('OEBPS/content.opf', self._content_opf())
+        self._zip.close()
+
+
+def build_epub(chapters: Iterable[str], path: str, title: str, images_dir: Optional[str] = None,
+               css_path: Optional[str] = None, language: str = 'ru',
+               chapter_cache: Optional[ChapterCache] = None,
+               progress: Optional[Callable[[str, int, int], None]] = None,
+               images: Optional[Iterable[Tuple[str, str]]] = None,
+               executor: Optional[Executor] = None, workers: int = 1) -> int:
+    """Сборка EPUB из глав Markdown, возвращает число глав.
+
+    С executor (пул из workers процессов) главы преобразуются в XHTML
+    параллельно, не больше двух на процесс сверх записанных.
+
+    Изображения берутся из images_dir или из images - пар (имя, файл),
+    которые перебираются после записи всех глав (например, ImageStager,
+    наполняемый при их обработке).
+
+    progress(этап, сделано, всего) сообщает о добавлении изображений
+    ('images') и записи оглавления ('package'); прогресс глав виден
+    по итерации chapters.
+    """
+    css = None
+    if css_path and os.path.exists(css_path):
+        with open(css_path, 'r', encoding='utf-8') as f:
+            css = f.read()
+
+    with EpubWriter(path, title, language, css, chapter_cache=chapter_cache) as writer:
+        writer.add_chapters(chapters, executor, window=workers * 2)
+        # Изображения добавляются во время обработки глав
+        if images is not None:
+            image_files = list(images)
+        elif images_dir and os.path.isdir(images_dir):
+            image_files = [(name, os.path.join(images_dir, name))
+                           for name in sorted(os.listdir(images_dir))]
+        else:
+            image_files = []
+        if progress:
+            progress('images', 0, len(image_files))
+        for done, (name, file_path) in enumerate(image_files, 1):
+            writer.add_image(file_path, name)
+            if progress:
+                progress('images', done, len(image_files))
+        if progress:
+            progress('package', 0, 0)
+        return len(writer.chapters)
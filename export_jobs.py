@@ -0,0 +1,407 @@
+"""
+Очередь фоновых заданий экспорта с отслеживанием прогресса
+"""
+import json
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, List, Optional
+
+# Этапы экспорта в порядке выполнения
+EXPORT_STAGES = ('scan', 'preprocess', 'convert', 'images', 'package')
+
+# Состояния задания
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Сколько последних строк вывода внешних программ хранит задание
+LOG_LINES = 200
+
+
+class ExportCancelled(Exception):
+    """Задание отменено пользователем"""
+
+
+class ExportError(Exception):
+    """Ошибка экспорта с сообщением для пользователя"""
+
+
+class ExportJob:
+    """Задание экспорта: состояние, этап и прогресс.
+
+    Функция задания получает его первым аргументом, сообщает этапы через
+    stage()/advance() и регулярно вызывает check(), который прерывает
+    работу исключением ExportCancelled после cancel(). Каждое изменение
+    увеличивает version, wait() позволяет дождаться следующего.
+    Результат и файлы задания хранятся в work_dir до удаления задания
+    из очереди.
+    """
+
+    def __init__(self, title: str = '', project_id=None, key=None,
+                 batch_id: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.title = title
+        self.project_id = project_id
+        # Новое задание с тем же ключом отменяет это (см. ExportJobQueue.submit)
+        self.key = key
+        # Пакетный экспорт, в который входит задание
+        self.batch_id = batch_id
+        self.state = QUEUED
+        self.stage_name: Optional[str] = None
+        self.done = 0
+        self.total = 0
+        self.message = ''
+        self.result: Optional[dict] = None
+        # Путь к готовому файлу (в work_dir или в хранилище книг) и имя для скачивания
+        self.artifact: Optional[str] = None
+        self.artifact_name: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.work_dir = tempfile.mkdtemp(prefix=f'obs2epub-export-{self.id[:8]}-')
+        # Последние строки вывода внешних программ (ebook-convert)
+        self.log: 'deque[str]' = deque(maxlen=LOG_LINES)
+        self.version = 0
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    # --- Вызывается из функции задания ---
+
+    def stage(self, name: str, total: int = 0, message: str = ''):
+        """Переход к этапу name (total - число шагов, 0 - неизвестно)"""
+        self.check()
+        self._update(stage_name=name, done=0, total=total, message=message)
+
+    def advance(self, step: int = 1, message: Optional[str] = None):
+        """Шаг этапа (например, обработана одна заметка)"""
+        self.check()
+        if message is None:
+            self._update(done=self.done + step)
+        else:
+            self._update(done=self.done + step, message=message)
+
+    def add_log(self, line: str):
+        """Строка вывода внешней программы (последняя видна в message)"""
+        with self._changed:
+            self.log.append(line)
+            self.message = line
+            self.version += 1
+            self._changed.notify_all()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise ExportCancelled()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    # --- Управление заданием ---
+
+    def cancel(self) -> bool:
+        """Запрос отмены (False - задание уже завершено)"""
+        if self.state in FINISHED_STATES:
+            return False
+        self._cancel.set()
+        if self.state == QUEUED:
+            self._finish(CANCELLED)
+        else:
+            # Будит ожидающих, чтобы они увидели запрос отмены
+            self._update(message='Отмена...')
+        return True
+
+    def _start(self) -> bool:
+        """Переход в RUNNING (False - задание отменено, пока ждало в очереди)"""
+        with self._changed:
+            if self.state != QUEUED:
+                return False
+            self.state = RUNNING
+            self.version += 1
+            self._changed.notify_all()
+            return True
+
+    def _finish(self, state: str, result: Optional[dict] = None, error: Optional[str] = None):
+        with self._changed:
+            if self.state in FINISHED_STATES:
+                return
+            self.state = state
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version: int = -1, timeout: Optional[float] = None) -> int:
+        """Ожидание изменения после version, возвращает текущую версию"""
+        with self._changed:
+            if self.version == version and self.state not in FINISHED_STATES:
+                self._changed.wait(timeout)
+            return self.version
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Ожидание завершения задания"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while self.state not in FINISHED_STATES:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def to_dict(self) -> dict:
+        with self._changed:
+            return {
+                'id': self.id,
+                'title': self.title,
+                'project_id': self.project_id,
+                'batch_id': self.batch_id,
+                'state': self.state,
+                'stage': self.stage_name,
+                'stages': list(EXPORT_STAGES),
+                'done': self.done,
+                'total': self.total,
+                'message': self.message,
+                'log': list(self.log)[-20:],
+                'result': self.result,
+                'error': self.error,
+                'created': self.created,
+                'finished': self.finished,
+                'version': self.version
+            }
+
+    def remove_files(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class ExportJobQueue:
+    """Очередь заданий экспорта с ограниченным числом потоков.
+
+    Одновременно выполняется не больше workers заданий, остальные ждут
+    в порядке поступления. Завершенные задания (и их файлы) хранятся,
+    пока их не больше keep и они не старше retention секунд.
+    """
+
+    def __init__(self, workers: int = 2, keep: int = 20, retention: float = 3600):
+        self.keep = keep
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._queue: 'queue.Queue[Optional[tuple]]' = queue.Queue()
+        self._jobs: 'OrderedDict[str, ExportJob]' = OrderedDict()
+        self._threads: List[threading.Thread] = []
+        self.workers = 0
+        self.set_workers(workers)
+
+    def set_workers(self, workers: int):
+        """Изменение числа потоков (лишние завершаются после текущих заданий)"""
+        workers = max(1, workers)
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for _ in range(workers - self.workers):
+                thread = threading.Thread(target=self._worker, name='export-job', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            for _ in range(self.workers - workers):
+                self._queue.put(None)
+            self.workers = workers
+
+    def submit(self, fn: Callable, *args, title: str = '', project_id=None,
+               key=None, batch_id: Optional[str] = None) -> ExportJob:
+        """Постановка fn(job, *args) в очередь; результат fn - результат задания.
+
+        Незавершенные задания с тем же key (например, прошлый экспорт
+        того же проекта) отменяются: новое задание их заменяет.
+        """
+        job = ExportJob(title, project_id, key, batch_id)
+        with self._lock:
+            superseded = [other for other in self._jobs.values()
+                          if key is not None and other.key == key]
+            self._jobs[job.id] = job
+        for other in superseded:
+            other.cancel()
+        self._cleanup()
+        self._queue.put((job, fn, args))
+        return job
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, batch_id: Optional[str] = None) -> List[ExportJob]:
+        """Задания очереди (с batch_id - только задания этого пакета)"""
+        with self._lock:
+            return [job for job in self._jobs.values()
+                    if batch_id is None or job.batch_id == batch_id]
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return bool(job and job.cancel())
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, fn, args = item
+            if not job._start():
+                job.remove_files()
+                continue
+            try:
+                result = fn(job, *args)
+            except ExportCancelled:
+                job._finish(CANCELLED)
+            except Exception as e:
+                job._finish(FAILED, error=str(e))
+            else:
+                job._finish(DONE, result=result)
+            finally:
+                # Файлы хранятся только у успешно завершенных заданий
+                if job.state != DONE:
+                    job.remove_files()
+            self._cleanup()
+
+    def _cleanup(self):
+        """Удаление старых завершенных заданий вместе с их файлами.
+
+        Задания незавершенного пакета не удаляются до его завершения, чтобы
+        результаты всех книг пакета оставались доступны.
+        """
+        now = time.time()
+        removed = []
+        with self._lock:
+            active_batches = {job.batch_id for job in self._jobs.values()
+                              if job.batch_id and job.state not in FINISHED_STATES}
+            finished = [job for job in self._jobs.values() if job.state in FINISHED_STATES
+                        and job.batch_id not in active_batches]
+            extra = len(finished) - self.keep
+            for job in finished:
+                if extra > 0 or now - job.finished > self.retention:
+                    del self._jobs[job.id]
+                    removed.append(job)
+                    extra -= 1
+        for job in removed:
+            job.remove_files()
+
+
+def run_process(job: ExportJob, cmd: List[str], timeout: Optional[float] = None) -> tuple:
+    """Запуск внешней программы задания, возвращает (код возврата, stderr).
+
+    Вывод читается построчно по мере появления и попадает в журнал
+    задания. Процесс (вместе с дочерними) завершается при отмене
+    задания - тогда выбрасывается ExportCancelled - и по истечении
+    timeout секунд (TimeoutError).
+    """
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        errors='replace', start_new_session=(os.name == 'posix')
+    )
+    stderr = deque(maxlen=LOG_LINES)
+
+    def read(stream, lines=None):
+        for line in stream:
+            line = line.rstrip()
+            if lines is not None:
+                lines.append(line)
+            if line:
+                job.add_log(line)
+        stream.close()
+
+    readers = [threading.Thread(target=read, args=(process.stdout,), daemon=True),
+               threading.Thread(target=read, args=(process.stderr, stderr), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    deadline = None if not timeout else time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                process.wait(0.2)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            job.check()
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f'{os.path.basename(cmd[0])} не завершился за {timeout:g} с')
+    finally:
+        if process.poll() is None:
+            _kill(process)
+        for reader in readers:
+            reader.join(1)
+    return process.returncode, '\n'.join(stderr)
+
+
+def _kill(process: subprocess.Popen, grace: float = 5):
+    """Завершение процесса и его дочерних процессов (SIGTERM, затем SIGKILL)"""
+    def send(sig):
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, sig)
+            elif sig == signal.SIGTERM:
+                process.terminate()
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    send(signal.SIGTERM)
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        send(getattr(signal, 'SIGKILL', signal.SIGTERM))
+        process.wait()
+
+
+def sse_events(job: ExportJob, keepalive: float = 15, cancel_on_disconnect: bool = False):
+    """Поток Server-Sent Events с состоянием задания до его завершения.
+
+    С cancel_on_disconnect задание отменяется, если клиент отключился
+    раньше (закрыта вкладка) - это обнаруживается при очередной отправке.
+    """
+    version = -1
+    finished = False
+    try:
+        while True:
+            current = job.wait(version, keepalive)
+            if current == version:
+                yield ': keepalive\n\n'
+                continue
+            version = current
+            data = job.to_dict()
+            yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            if data['state'] in FINISHED_STATES:
+                finished = True
+                return
+    finally:
+        if cancel_on_disconnect and not finished:
+            job.cancel()
+
+
+_queue: Optional[ExportJobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_export_jobs(workers: int = 2) -> ExportJobQueue:
+    """Общая очередь заданий экспорта (создается при первом обращении)"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ExportJobQueue(workers)
+        return _queue
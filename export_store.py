@@ -0,0 +1,224 @@
+"""
+Хранилище готовых книг: повторный экспорт без изменений не пересобирает EPUB
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from note_cache import CACHE_DIR
+
+# Версия формата записей хранилища
+STORE_VERSION = 1
+
+EXPORTS_DIR = os.path.join(CACHE_DIR, 'exports')
+
+# Отпечаток экспорта - он же id готовой книги (artifact id)
+ARTIFACT_ID_RE = re.compile(r'[0-9a-f]{40}')
+
+
+def file_key(path: str) -> list:
+    """Ключ версии файла: mtime и размер"""
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def export_fingerprint(paths: List[str], title: str, options: dict) -> str:
+    """Отпечаток экспорта: выбранные заметки по порядку (путь, mtime,
+    размер), название и параметры сборки"""
+    files = []
+    for path in paths:
+        try:
+            files.append([path] + file_key(path))
+        except OSError:
+            files.append([path, None, None])
+    data = json.dumps([STORE_VERSION, title, options, files], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class ExportDependencies:
+    """Все, от чего зависит готовая книга, кроме выбранных заметок.
+
+    files - вставленные заметки и изображения с их версиями, lookups -
+    результаты поиска вставок по имени: [вид, имя, путь заметки, найденный
+    путь или None]. Книга из хранилища действительна, пока файлы не
+    изменились и поиск дает те же результаты (например, в хранилище не
+    появилась заметка с именем прежде ненайденной вставки).
+    """
+
+    def __init__(self, files: Optional[Dict[str, list]] = None,
+                 lookups: Optional[List[list]] = None):
+        self.files = files or {}
+        self.lookups = lookups or []
+
+    def add_file(self, path: str):
+        if path not in self.files:
+            try:
+                self.files[path] = file_key(path)
+            except OSError:
+                self.files[path] = None
+
+    def add_lookup(self, kind: str, name: str, from_path: str, result: Optional[str]):
+        self.lookups.append([kind, name, from_path, result])
+
+    def valid(self, lookup: Callable[[str, str, str], Optional[str]]) -> bool:
+        """Проверка: lookup(вид, имя, путь заметки) повторяет поиск вставки"""
+        for path, key in self.files.items():
+            try:
+                if file_key(path) != key:
+                    return False
+            except OSError:
+                if key is not None:
+                    return False
+        return all(lookup(kind, name, from_path) == result
+                   for kind, name, from_path, result in self.lookups)
+
+    def to_dict(self) -> dict:
+        return {'files': self.files, 'lookups': self.lookups}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ExportDependencies':
+        return cls(data.get('files'), data.get('lookups'))
+
+
+class ExportStore:
+    """Готовые EPUB по отпечатку экспорта (export_fingerprint).
+
+    Запись - папка <отпечаток> с книгой и meta.json (имя файла, зависимости,
+    диагностика); отпечаток служит id книги для скачивания. Записи, не
+    использованные дольше retention секунд (0 - без ограничения),
+    удаляются, а при превышении max_bytes удаляются давно не
+    использованные (время использования - mtime meta.json).
+    """
+
+    def __init__(self, root: str = EXPORTS_DIR, max_bytes: int = 2 * 1024 * 1024 * 1024,
+                 retention: float = 0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _read_meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._dir(key), 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != STORE_VERSION or not os.path.exists(meta.get('path', '')):
+            return None
+        return meta
+
+    def get(self, key: str, lookup: Callable[[str, str, str], Optional[str]]) -> Optional[dict]:
+        """Запись с действительными зависимостями (lookup - см. ExportDependencies.valid)"""
+        meta = self._read_meta(key)
+        if meta is None or not ExportDependencies.from_dict(meta['dependencies']).valid(lookup):
+            with self._lock:
+                self.misses += 1
+            return None
+        self._touch(key)
+        with self._lock:
+            self.hits += 1
+        return meta
+
+    def artifact(self, key: str) -> Optional[dict]:
+        """Запись по id книги без проверки зависимостей (для скачивания)"""
+        if not ARTIFACT_ID_RE.fullmatch(key):
+            return None
+        meta = self._read_meta(key)
+        if meta is not None:
+            self._touch(key)
+        return meta
+
+    def _touch(self, key: str):
+        try:
+            os.utime(os.path.join(self._dir(key), 'meta.json'))
+        except OSError:
+            pass
+
+    def put(self, key: str, epub_path: str, filename: str,
+            dependencies: ExportDependencies, **extra) -> dict:
+        """Перенос готовой книги в хранилище, возвращает запись"""
+        entry_dir = self._dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        dest = os.path.join(entry_dir, 'book.epub')
+        temp_path = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.move(epub_path, temp_path)
+        os.replace(temp_path, dest)
+
+        meta = dict(extra, version=STORE_VERSION, key=key, path=dest, filename=filename,
+                    size=os.path.getsize(dest), created=time.time(),
+                    dependencies=dependencies.to_dict())
+        self.update(key, meta)
+        self.prune()
+        return meta
+
+    def update(self, key: str, meta: dict):
+        """Запись meta.json через временный файл"""
+        meta_path = os.path.join(self._dir(key), 'meta.json')
+        temp_path = f'{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temp_path, meta_path)
+
+    def _entries(self) -> List[tuple]:
+        """(время использования, размер, отпечаток) всех записей"""
+        entries = []
+        try:
+            dirs = list(os.scandir(self.root))
+        except OSError:
+            return entries
+        for entry in dirs:
+            if not entry.is_dir():
+                continue
+            size = 0
+            try:
+                # Запись без meta.json еще создается - время папки
+                used = entry.stat().st_mtime
+                for item in os.scandir(entry.path):
+                    stat = item.stat()
+                    size += stat.st_size
+                    if item.name == 'meta.json':
+                        used = stat.st_mtime
+            except OSError:
+                continue
+            entries.append((used, size, entry.name))
+        return entries
+
+    def prune(self):
+        """Удаление записей старше retention и давно не использованных сверх max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        expired = time.time() - self.retention if self.retention else 0
+        for used, size, key in entries:
+            if total <= self.max_bytes and used >= expired:
+                break
+            shutil.rmtree(self._dir(key), ignore_errors=True)
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_store: Optional[ExportStore] = None
+_store_lock = threading.Lock()
+
+
+def get_export_store(retention: float = 0) -> ExportStore:
+    """Общее хранилище готовых книг (retention задается при создании,
+    далее - через атрибут)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ExportStore(retention=retention)
+            _store.prune()
+        return _store
@@ -0,0 +1,234 @@
+"""
+Подготовка изображений под устройство чтения (Pillow - необязательно)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Dict, List, Optional
+
+from note_cache import CACHE_DIR
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен - изображения не перекодируются
+    Image = ImageOps = None
+
+# Версия перекодирования: увеличивается при изменении результата,
+# чтобы не использовать старые версии изображений из кэша
+OPTIMIZER_VERSION = 1
+
+# Папка кэша перекодированных изображений (общая для всех проектов:
+# ключ - хэш содержимого исходного файла и профиль)
+RENDITIONS_DIR = os.path.join(CACHE_DIR, 'images')
+
+# Метка в кэше: исходный файл меньше перекодированного и используется как есть
+ORIGINAL_MARK = '.orig'
+
+# Сколько секунд недавно использованные изображения не удаляются из кэша
+RENDITION_MIN_AGE = 10 * 60
+
+# Форматы, которые перекодируются; остальные (gif, svg) попадают в книгу как есть
+TRANSCODE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+
+class ImageProfile:
+    """Профиль устройства: наибольшие размеры, оттенки серого, качество JPEG.
+
+    webp и bmp, которые поддерживают не все читалки, преобразуются в
+    JPEG (или в PNG, если у изображения есть прозрачность).
+    """
+
+    def __init__(self, name: str, title: str, max_width: int, max_height: int,
+                 grayscale: bool = False, jpeg_quality: int = 85):
+        self.name = name
+        self.title = title
+        self.max_width = max_width
+        self.max_height = max_height
+        self.grayscale = grayscale
+        self.jpeg_quality = jpeg_quality
+        self.key = hashlib.sha1(json.dumps(
+            [OPTIMIZER_VERSION, max_width, max_height, grayscale, jpeg_quality]
+        ).encode('utf-8')).hexdigest()[:12]
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'title': self.title,
+            'max_width': self.max_width,
+            'max_height': self.max_height,
+            'grayscale': self.grayscale,
+            'jpeg_quality': self.jpeg_quality
+        }
+
+
+# 'original' - изображения без изменений
+IMAGE_PROFILES: Dict[str, ImageProfile] = {profile.name: profile for profile in [
+    ImageProfile('eink', 'Электронная книга 6"', 1072, 1448, grayscale=True, jpeg_quality=70),
+    ImageProfile('eink-hd', 'Электронная книга 7" и больше', 1264, 1680,
+                 grayscale=True, jpeg_quality=75),
+    ImageProfile('phone', 'Телефон', 1440, 1440, jpeg_quality=80),
+    ImageProfile('tablet', 'Планшет', 2048, 2048, jpeg_quality=85)
+]}
+
+
+def pillow_available() -> bool:
+    return Image is not None
+
+
+def _has_alpha(image) -> bool:
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+def _transcode(job: tuple) -> str:
+    """Перекодирование одного изображения (выполняется в процессе пула).
+
+    Возвращает путь к результату в кэше или к исходному файлу, если
+    изображение не удалось перекодировать или результат без смены
+    формата не меньше исходного файла (тогда в кэше остается метка).
+    """
+    source, dest, max_width, max_height, grayscale, quality = job
+    ext = os.path.splitext(dest)[1]
+    temp_path = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        with Image.open(source) as opened:
+            if getattr(opened, 'is_animated', False):
+                raise ValueError('анимированное изображение')
+            image = ImageOps.exif_transpose(opened)
+            alpha = _has_alpha(image)
+            if image.width > max_width or image.height > max_height:
+                image.thumbnail((max_width, max_height), Image.LANCZOS)
+            if ext == '.png':
+                if grayscale:
+                    image = image.convert('LA' if alpha else 'L')
+                elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    image = image.convert('RGBA' if alpha else 'RGB')
+                image.save(temp_path, 'PNG', optimize=True)
+            else:
+                image = image.convert('L' if grayscale else 'RGB')
+                image.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    except Exception as e:
+        # Битые, анимированные и слишком большие (DecompressionBombError) файлы
+        print(f"Ошибка перекодирования изображения {source}: {e}")
+        _remove(temp_path)
+        return source
+
+    if (os.path.splitext(source)[1].lower() == ext
+            and os.path.getsize(temp_path) >= os.path.getsize(source)):
+        _remove(temp_path)
+        with open(dest + ORIGINAL_MARK, 'w'):
+            pass
+        return source
+    os.replace(temp_path, dest)
+    return dest
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ImageOptimizer:
+    """Перекодирование изображений книги по профилю устройства.
+
+    Результаты хранятся в cache_dir по хэшу содержимого исходного файла
+    и ключу профиля, поэтому при повторном экспорте берутся из кэша.
+    Перекодирование идет в executor (пул процессов или потоков)
+    параллельно с обработкой глав; без executor - сразу при вызове
+    submit(). Ошибка перекодирования в обоих случаях попадает в Future.
+    """
+
+    def __init__(self, profile: ImageProfile, cache_dir: str = RENDITIONS_DIR,
+                 executor: Optional[Executor] = None):
+        self.profile = profile
+        self.cache_dir = cache_dir
+        self.executor = executor
+        self.hits = 0
+        self.misses = 0
+
+    def output_ext(self, source: str) -> str:
+        """Расширение изображения после перекодирования"""
+        ext = os.path.splitext(source)[1].lower()
+        if ext not in ('.webp', '.bmp'):
+            return ext
+        if ext == '.bmp':
+            return '.png'
+        try:
+            # Открытие читает только заголовок файла
+            with Image.open(source) as image:
+                return '.png' if _has_alpha(image) else '.jpg'
+        except (OSError, ValueError):
+            return '.jpg'
+
+    def submit(self, source: str, digest: str, ext: str) -> Future:
+        """Перекодирование source (хэш содержимого digest) в формат ext"""
+        if os.path.splitext(source)[1].lower() not in TRANSCODE_EXTENSIONS:
+            return _done(source)
+
+        dest = os.path.join(self.cache_dir, digest[:2], f'{digest}-{self.profile.key}{ext}')
+        for cached, result in ((dest, dest), (dest + ORIGINAL_MARK, source)):
+            if os.path.exists(cached):
+                try:
+                    os.utime(cached)
+                except OSError:
+                    pass
+                self.hits += 1
+                return _done(result)
+
+        self.misses += 1
+        profile = self.profile
+        job = (source, dest, profile.max_width, profile.max_height,
+               profile.grayscale, profile.jpeg_quality)
+        if self.executor is not None:
+            return self.executor.submit(_transcode, job)
+        future = Future()
+        try:
+            future.set_result(_transcode(job))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def prune_renditions(cache_dir: str = RENDITIONS_DIR, max_bytes: int = 1024 * 1024 * 1024,
+                     min_age: float = RENDITION_MIN_AGE):
+    """Удаление давно не использованных изображений из кэша сверх max_bytes.
+
+    Изображения, использованные за последние min_age секунд, не
+    удаляются: их может еще читать параллельный экспорт (submit
+    обновляет mtime при каждом попадании в кэш).
+    """
+    entries: List[tuple] = []
+    recent = time.time() - min_age
+    try:
+        subdirs = list(os.scandir(cache_dir))
+    except OSError:
+        return
+    for subdir in subdirs:
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for used, size, path in sorted(entries):
+        if total <= max_bytes or used >= recent:
+            break
+        _remove(path)
+        total -= size
@@ -0,0 +1,177 @@
+"""
+Подготовка изображений книги: без дубликатов и без копирования
+"""
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+# Сколько символов хэша содержимого входит в имя изображения
+NAME_HASH_LENGTH = 16
+
+# Хэши содержимого файлов: путь → (mtime_ns, размер, хэш)
+_hashes: Dict[str, tuple] = {}
+_hashes_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """Хэш содержимого файла (пересчитывается только после его изменения)"""
+    stat = os.stat(path)
+    with _hashes_lock:
+        cached = _hashes.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    result = digest.hexdigest()
+    with _hashes_lock:
+        _hashes[path] = (stat.st_mtime_ns, stat.st_size, result)
+    return result
+
+
+def link_or_copy(source: str, dest: str):
+    """Размещение файла без копирования данных, если это возможно:
+    жесткая ссылка, затем копирование средствами ядра (copy_file_range,
+    на CoW-файловых системах - reflink) и, наконец, обычное копирование"""
+    try:
+        os.link(source, dest)
+        return
+    except OSError:
+        pass
+
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range:
+        try:
+            with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            if remaining <= 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+
+
+class ImageStager:
+    """Изображения книги по содержимому.
+
+    Имя изображения - image_<хэш содержимого><расширение>: одинаковые
+    изображения (в том числе из разных файлов) попадают в книгу один
+    раз, имя выдается без просмотра папки и не зависит от порядка глав,
+    поэтому не меняется от экспорта к экспорту.
+
+    С images_dir файлы размещаются в этой папке (для ebook-convert,
+    которому нужны файлы рядом с markdown) через link_or_copy. Без нее
+    ничего не копируется: встроенный сборщик читает изображения прямо
+    из хранилища при записи архива (см. __iter__).
+
+    С optimizer (ImageOptimizer) изображения перекодируются под профиль
+    устройства: в фоне, пока обрабатываются главы, а files() дожидается
+    результатов.
+    """
+
+    def __init__(self, images_dir: Optional[str] = None, optimizer=None):
+        self.images_dir = images_dir
+        self.optimizer = optimizer
+        self._lock = threading.Lock()
+        # имя в книге → исходный файл (или перекодирование в процессе)
+        self._files: Dict[str, Union[str, Future]] = {}
+        # Имена, уже размещенные в images_dir
+        self._placed = set()
+        # исходный файл → имя в книге
+        self._names: Dict[str, str] = {}
+        self.duplicates = 0
+
+    def stage(self, source: str) -> str:
+        """Добавление изображения, возвращает его имя в папке images/"""
+        source = os.path.abspath(source)
+        with self._lock:
+            name = self._names.get(source)
+        if name:
+            return name
+
+        digest = file_digest(source)
+        if self.optimizer:
+            ext = self.optimizer.output_ext(source)
+        else:
+            ext = os.path.splitext(source)[1].lower()
+        name = f'image_{digest[:NAME_HASH_LENGTH]}{ext}'
+        with self._lock:
+            self._names[source] = name
+            if name in self._files:
+                self.duplicates += 1
+                return name
+            self._files[name] = source
+
+        if self.optimizer:
+            future = self.optimizer.submit(source, digest, ext)
+            with self._lock:
+                self._files[name] = future
+        elif self.images_dir:
+            self._place(name, source)
+        return name
+
+    def _place(self, name: str, file_path: str):
+        dest = os.path.join(self.images_dir, name)
+        if not os.path.exists(dest):
+            link_or_copy(file_path, dest)
+        self._placed.add(name)
+
+    def files(self, progress: Optional[Callable[[str, int, int], None]] = None
+              ) -> List[Tuple[str, str]]:
+        """(имя, файл для книги) в порядке имен, с ожиданием перекодирования.
+
+        Изображение, которое не удалось перекодировать, берется как есть:
+        имя в главах остается прежним (с расширением результата), а
+        формат определяется по файлу (см. EpubWriter.add_image).
+        progress(этап, сделано, всего) - как у build_epub, этап 'images'.
+        """
+        with self._lock:
+            items = sorted(self._files.items())
+        if progress:
+            progress('images', 0, len(items))
+        result = []
+        for done, (name, item) in enumerate(items, 1):
+            if isinstance(item, Future):
+                try:
+                    file_path = item.result()
+                except Exception as e:
+                    print(f"Ошибка перекодирования изображения {name}: {e}")
+                    file_path = self._source(name)
+                with self._lock:
+                    self._files[name] = file_path
+            else:
+                file_path = item
+            if self.images_dir and name not in self._placed:
+                self._place(name, file_path)
+            result.append((name, file_path))
+            if progress:
+                progress('images', done, len(items))
+        return result
+
+    def _source(self, name: str) -> str:
+        with self._lock:
+            return next(source for source, staged in self._names.items() if staged == name)
+
+    def cancel(self):
+        """Отмена еще не начатых перекодирований (экспорт прерван)"""
+        with self._lock:
+            futures = [item for item in self._files.values() if isinstance(item, Future)]
+        for future in futures:
+            future.cancel()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._files)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return iter(self.files())
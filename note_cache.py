@@ -0,0 +1,315 @@
+"""
+Кэш обработанных заметок между экспортами
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
+
+from obsidian_markdown import PROCESSOR_VERSION, SectionIndex, parse_obsidian_markdown
+
+# Папка кэша (рядом с приложением, можно задать OBS2EPUB_CACHE_DIR),
+# внутри - подпапка на проект
+CACHE_DIR = os.path.abspath(os.environ.get('OBS2EPUB_CACHE_DIR') or
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+
+
+class NoteCache:
+    """Разобранные заметки (parse_obsidian_markdown) по пути файла.
+
+    Запись действительна, пока у файла те же mtime и размер, а версия
+    обработки совпадает с PROCESSOR_VERSION. Записи держатся в памяти
+    с вытеснением давно не использованных (LRU по суммарному размеру)
+    и сохраняются на диск в cache_dir, поэтому переживают перезапуск:
+    при повторном экспорте неизменившиеся заметки не читаются и не
+    обрабатываются заново. Размер cache_dir ограничен max_bytes так же,
+    как у кэша глав (см. prune_disk_entries).
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_chars: int = 64 * 1024 * 1024,
+                 max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Суммарный размер записей на диске (None - еще не подсчитан)
+        self._bytes: Optional[int] = None
+        # путь → (ключ, части, размер, индекс разделов или None),
+        # от давно использованных к недавним
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(stat: os.stat_result) -> list:
+        return [PROCESSOR_VERSION, stat.st_mtime_ns, stat.st_size]
+
+    def _disk_path(self, file_path: str) -> str:
+        name = hashlib.sha1(file_path.encode('utf-8', 'surrogatepass')).hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name + '.json')
+
+    def _remember(self, file_path: str, key: list, parts: List[str]):
+        """Запись в память с вытеснением старых записей"""
+        old = self._entries.pop(file_path, None)
+        if old:
+            self._chars -= old[2]
+        size = sum(len(part) for part in parts)
+        self._entries[file_path] = (key, parts, size, None)
+        self._chars += size
+        while self._chars > self.max_chars and len(self._entries) > 1:
+            _, (_, _, evicted, _) = self._entries.popitem(last=False)
+            self._chars -= evicted
+
+    def _load(self, file_path: str, key: list) -> Optional[List[str]]:
+        """Чтение записи с диска (None - нет или устарела)"""
+        if not self.cache_dir:
+            return None
+        disk_path = self._disk_path(file_path)
+        try:
+            with open(disk_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            os.utime(disk_path)
+        except (OSError, ValueError):
+            return None
+        if data.get('path') != file_path or data.get('key') != key:
+            return None
+        return data['parts']
+
+    def _save(self, file_path: str, key: list, parts: List[str]) -> int:
+        """Запись на диск (старая версия заменяется), возвращает изменение размера кэша"""
+        if not self.cache_dir:
+            return 0
+        return _write_entry(self._disk_path(file_path), file_path, key, parts)
+
+    def _written(self, size: int):
+        """Учет изменения размера записей на диске, при превышении max_bytes - очистка"""
+        if not size:
+            return
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+        if self._size() > self.max_bytes:
+            self.prune()
+
+    def _size(self) -> int:
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in disk_entries(self.cache_dir))
+            return self._bytes
+
+    def prune(self):
+        """Удаление давно не использованных записей с диска до 3/4 max_bytes"""
+        if not self.cache_dir:
+            return
+        total = prune_disk_entries(self.cache_dir, self.max_bytes * 3 // 4)
+        with self._lock:
+            self._bytes = total
+
+    def _cached(self, file_path: str, key: list) -> Optional[List[str]]:
+        """Запись из памяти или с диска (None - нет или устарела)"""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry and entry[0] == key:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return entry[1]
+
+        parts = self._load(file_path, key)
+        if parts is not None:
+            with self._lock:
+                self.hits += 1
+                self._remember(file_path, key, parts)
+        return parts
+
+    def _store(self, file_path: str, key: list, parts: List[str], written: Optional[int] = None):
+        """Запись обработанной заметки (written - изменение размера, если она уже на диске)"""
+        if written is None:
+            written = self._save(file_path, key, parts)
+        with self._lock:
+            self.misses += 1
+            self._remember(file_path, key, parts)
+        self._written(written)
+
+    def get_parts(self, file_path: str) -> List[str]:
+        """Разобранная заметка: из памяти, с диска или после обработки файла"""
+        file_path = os.path.abspath(file_path)
+        key = self._key(os.stat(file_path))
+
+        parts = self._cached(file_path, key)
+        if parts is None:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                parts = parse_obsidian_markdown(f.read())
+            self._store(file_path, key, parts)
+        return parts
+
+    def prefetch(self, file_paths: List[str], executor: Optional[Executor] = None,
+                 workers: int = 1) -> Dict[str, List[str]]:
+        """Разобранные заметки file_paths (путь → части).
+
+        Отсутствующие в кэше заметки обрабатываются в executor (пул
+        процессов с workers процессами), остальные берутся из кэша.
+        Нечитаемые файлы пропускаются - ошибку сообщит get_parts.
+        """
+        result = {}
+        missing = []
+        for file_path in file_paths:
+            file_path = os.path.abspath(file_path)
+            try:
+                key = self._key(os.stat(file_path))
+            except OSError:
+                continue
+            parts = self._cached(file_path, key)
+            if parts is None:
+                missing.append((file_path, key))
+            else:
+                result[file_path] = parts
+
+        if missing:
+            # Процессы пула сами записывают результат в кэш на диске
+            jobs = [(file_path, key, self._disk_path(file_path) if self.cache_dir else None)
+                    for file_path, key in missing]
+            if executor is not None and len(jobs) > 1:
+                chunksize = max(1, len(jobs) // (workers * 4))
+                parsed = executor.map(_process_note_file, jobs, chunksize=chunksize)
+            else:
+                parsed = map(_process_note_file, jobs)
+            for (file_path, key), processed in zip(missing, parsed):
+                if processed is not None:
+                    parts, written = processed
+                    self._store(file_path, key, parts, written)
+                    result[file_path] = parts
+        return result
+
+    def get_sections(self, file_path: str) -> SectionIndex:
+        """Индекс заголовков и блоков заметки (хранится вместе с записью)"""
+        file_path = os.path.abspath(file_path)
+        parts = self.get_parts(file_path)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry and entry[1] is parts and entry[3] is not None:
+                return entry[3]
+
+        index = SectionIndex(parts)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry and entry[1] is parts:
+                self._entries[file_path] = entry[:3] + (index,)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'chars': self._chars,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes': self._bytes
+            }
+
+
+def _write_entry(disk_path: str, file_path: str, key: list, parts: List[str]) -> int:
+    """Запись записи кэша через временный файл.
+
+    Возвращает изменение размера кэша: размер записи минус размер
+    замененной старой версии (0 - ошибка записи).
+    """
+    temp_path = f'{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    data = json.dumps({'path': file_path, 'key': key, 'parts': parts},
+                      ensure_ascii=False).encode('utf-8', 'surrogatepass')
+    try:
+        old_size = os.path.getsize(disk_path)
+    except OSError:
+        old_size = 0
+    try:
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, disk_path)
+    except OSError as e:
+        print(f"Ошибка записи кэша заметки {file_path}: {e}")
+        return 0
+    return len(data) - old_size
+
+
+def _process_note_file(job: tuple) -> Optional[tuple]:
+    """Чтение, разбор и запись в кэш одной заметки (выполняется в процессе пула).
+
+    Возвращает (части, изменение размера кэша на диске) или None, если файл не прочитан.
+    """
+    file_path, key, disk_path = job
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            parts = parse_obsidian_markdown(f.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+    written = _write_entry(disk_path, file_path, key, parts) if disk_path else 0
+    return parts, written
+
+
+def disk_entries(cache_dir: str) -> List[tuple]:
+    """(mtime, размер, путь) всех записей дискового кэша (cache_dir/xx/*.json)"""
+    entries = []
+    try:
+        subdirs = list(os.scandir(cache_dir))
+    except OSError:
+        return entries
+    for subdir in subdirs:
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def prune_disk_entries(cache_dir: str, limit: int) -> int:
+    """Удаление давно не использованных записей (по mtime) до limit байт.
+
+    Возвращает суммарный размер оставшихся записей.
+    """
+    entries = sorted(disk_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+
+_caches: Dict[str, NoteCache] = {}
+_caches_lock = threading.Lock()
+
+
+def project_cache_dir(base_path: str, name: str) -> str:
+    """Папка кэша name для проекта base_path"""
+    key = os.path.abspath(base_path)
+    project_dir = hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, project_dir, name)
+
+
+def get_note_cache(base_path: str) -> NoteCache:
+    """Получение (или создание) кэша заметок для папки проекта"""
+    key = os.path.abspath(base_path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = NoteCache(project_cache_dir(key, 'notes'))
+            _caches[key] = cache
+        return cache
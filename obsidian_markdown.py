@@ -0,0 +1,363 @@
+"""
+Однопроходное преобразование Obsidian Markdown в обычный Markdown
+"""
+import bisect
+import re
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+# Версия обработки: увеличивается при любом изменении результата,
+# чтобы кэш обработанных заметок не отдавал устаревший текст
+PROCESSOR_VERSION = 1
+
+# Начало YAML front matter (допускаются пустые строки перед ---)
+FRONTMATTER_START_RE = re.compile(r'\s*---')
+# Закрывающая строка front matter: '---' с пробелами вокруг
+FRONTMATTER_END_RE = re.compile(r'^[^\S\n]*---[^\S\n]*$', re.MULTILINE)
+
+# Записано с буквальным началом: так re ищет его быстрым поиском подстроки
+BLANK_LINES_RE = re.compile(r'\n\n\n+')
+NEWLINES_RE = re.compile(r'\n*')
+
+# Блок кода ``` или ~~~ (без закрывающей строки - до конца текста)
+FENCE = r'''
+    [ ]{0,3}(?P<fchar>`{3,}|~{3,})[^\n]*
+    (?:
+        \n(?:[^\n]*\n)*?[ ]{0,3}(?P=fchar)(?:(?<=`)`*|(?<=~)~*)[ \t]*(?=\n|\Z)
+      | (?:\n[^\n]*)*\Z
+    )
+'''
+CALLOUT = r'\s*\[![^\]]+\][^\n]*'
+
+# Конструкции в начале текста (после front matter)
+START_RE = re.compile(rf'''
+    (?P<callout>{CALLOUT})
+  | (?P<fence>{FENCE})
+''', re.VERBOSE)
+
+# Все остальные конструкции в одном выражении. Каждая альтернатива
+# начинается с '\n', '!' или '[', поэтому поиск быстро пропускает обычный
+# текст. Строчные конструкции привязаны к переносу строки перед ними:
+# callout поглощает пустые строки перед собой (перенос остается). Пустые
+# строки схлопываются в _Writer одной заменой на весь текст между блоками кода.
+#
+# Строчные альтернативы проверяются на каждом переносе строки, что заметно
+# замедляет поиск в тексте из коротких строк. Поэтому выражение собирается
+# только из конструкций, которые есть в заметке (см. _token_re).
+LINE_TOKENS = {
+    'callout': rf'(?P<callout>{CALLOUT})',
+    'fence': rf'(?P<fence>{FENCE})'
+}
+INLINE_TOKENS = r'''
+    !\[\[(?P<embed>[^\]]+)\]\]
+  | \[\[(?P<link>[^\]]+)\]\]
+'''
+
+
+@lru_cache(maxsize=None)
+def _token_re(callouts: bool, fences: bool):
+    line_tokens = [LINE_TOKENS[name] for name, used in
+                   (('callout', callouts), ('fence', fences)) if used]
+    if not line_tokens:
+        return re.compile(INLINE_TOKENS, re.VERBOSE)
+    return re.compile(rf"\n(?:{' | '.join(line_tokens)}) | {INLINE_TOKENS}", re.VERBOSE)
+
+
+def _collapse(text: str) -> str:
+    """Схлопывание переносов внутри имени ссылки (оно может занимать несколько строк)"""
+    return BLANK_LINES_RE.sub('\n\n', text) if '\n\n\n' in text else text
+
+
+def _frontmatter_end(content: str) -> int:
+    """Смещение, с которого начинается текст после YAML front matter"""
+    if not FRONTMATTER_START_RE.match(content):
+        return 0
+
+    first_newline = content.find('\n')
+    if first_newline < 0:
+        return len(content)
+
+    # Ищем закрывающий --- со второй строки
+    match = FRONTMATTER_END_RE.search(content, first_newline + 1)
+    if match:
+        return min(match.end() + 1, len(content))
+
+    # Если нет закрывающего ---, удаляем первые 10 строк
+    offset = first_newline
+    for _ in range(9):
+        offset = content.find('\n', offset + 1)
+        if offset < 0:
+            return first_newline + 1
+    return offset + 1
+
+
+class _Writer:
+    """Сборка текста со схлопыванием трех и более переносов строк в два.
+
+    Обычный текст копится и схлопывается одной заменой перед следующим
+    куском verbatim (блок кода, уже собранная часть) или в getvalue().
+    У кусков verbatim схлопываются только переносы на границах.
+    """
+
+    def __init__(self):
+        self.out: List[str] = []
+        # Сколько переносов строк подряд в конце уже собранного текста
+        self.trailing = 0
+        # Обычный текст, еще не добавленный в out (список не заменяется)
+        self.pending: List[str] = []
+
+    def emit(self, text: str, verbatim: bool = False):
+        if not verbatim:
+            self.pending.append(text)
+            return
+        if self.pending:
+            self._flush()
+        self.append(text)
+
+    def _flush(self):
+        if not self.pending:
+            return
+        text = ''.join(self.pending)
+        self.pending.clear()
+        if '\n\n\n' in text:
+            text = BLANK_LINES_RE.sub('\n\n', text)
+        self.append(text)
+
+    def append(self, text: str):
+        """Добавление готового текста (переносы схлопываются только на границе)"""
+        if not text:
+            return
+        if text[0] == '\n':
+            leading = NEWLINES_RE.match(text).end()
+            trailing = self.trailing
+            keep = leading if trailing + leading <= 2 else max(0, 2 - trailing)
+            if keep:
+                self.out.append('\n' * keep)
+            if leading == len(text):
+                self.trailing += keep
+                return
+            text = text[leading:]
+        self.out.append(text)
+        end = len(text)
+        while text[end - 1] == '\n':
+            end -= 1
+        self.trailing = len(text) - end
+
+    def getvalue(self) -> str:
+        self._flush()
+        return ''.join(self.out)
+
+
+def parse_obsidian_markdown(content: str) -> List[str]:
+    """Разбор заметки за один проход.
+
+    Убирает YAML front matter и строки callout'ов ([!type]), заменяет
+    ссылки [[...]] жирным текстом и схлопывает три и более переносов
+    строк в два. Блоки кода ``` / ~~~ переносятся без изменений.
+    Возвращает список [текст, вставка, текст, ..., текст]: на нечетных
+    позициях - имена вставок ![[...]], которые подставляет render.
+    """
+    parts = []
+    writer = _Writer()
+
+    pos = _frontmatter_end(content)
+    match = START_RE.match(content, pos)
+    if match:
+        if match.lastgroup == 'fence':
+            writer.emit(match.group(), verbatim=True)
+        pos = match.end()
+
+    # Поиск одного символа (memchr) намного быстрее поиска подстроки,
+    # поэтому подстроки ищутся, только если символ есть
+    token_re = _token_re('!' in content and '[!' in content,
+                         ('`' in content and '```' in content)
+                         or ('~' in content and '~~~' in content))
+    # Обычный текст добавляется в буфер writer напрямую: это самый частый
+    # случай, и вызов emit на каждую ссылку заметно замедляет разбор
+    pending = writer.pending
+    for match in token_re.finditer(content, pos):
+        start, end = match.span()
+        kind = match.lastgroup
+        if kind == 'link':
+            # Переносы внутри имени схлопываются вместе с остальным текстом
+            pending += (content[pos:start], '**', match.group('link'), '**')
+        elif kind == 'embed':
+            pending.append(content[pos:start])
+            parts.append(writer.getvalue())
+            parts.append(match.group('embed'))
+            writer = _Writer()
+            pending = writer.pending
+        elif kind == 'callout':
+            # Строка callout'а удаляется вместе с пустыми строками перед ней
+            pending += (content[pos:start], '\n')
+        else:
+            pending.append(content[pos:start])
+            writer.emit(match.group(), verbatim=True)
+        pos = end
+
+    pending.append(content[pos:])
+    parts.append(writer.getvalue())
+    return parts
+
+
+def render_obsidian_markdown(parts: List[str],
+                             embed: Optional[Callable[[str], str]] = None) -> str:
+    """Сборка разобранной заметки: вставки заменяются результатом
+    embed(имя), без embed они становятся ссылками"""
+    if len(parts) == 1:
+        return parts[0].strip()
+
+    writer = _Writer()
+    for i, part in enumerate(parts):
+        # Части и вставки уже обработаны: схлопываются только их границы
+        if i % 2 == 0:
+            writer.append(part)
+        else:
+            writer.append(embed(part) if embed else f'!**{_collapse(part)}**')
+    return writer.getvalue().strip()
+
+
+def transform_obsidian_markdown(content: str,
+                                embed: Optional[Callable[[str], str]] = None) -> str:
+    """Преобразование заметки за один проход (parse + render)"""
+    return render_obsidian_markdown(parse_obsidian_markdown(content), embed)
+
+
+# Заголовки и метки блоков (^id) в разобранном тексте, блоки кода пропускаются
+SECTION_RE = re.compile(rf'''
+    ^(?P<fence>{FENCE})
+  | ^(?P<hashes>\#{{1,6}})[ \t]+(?P<title>[^\n]*?)[ \t\#]*$
+  | (?:^|[ \t]+)\^(?P<block>[A-Za-z0-9-]+)[ \t]*$
+''', re.MULTILINE | re.VERBOSE)
+LIST_ITEM_RE = re.compile(r'[ \t]*(?:[-*+]|\d+[.)])[ \t]')
+# Символы, которые Obsidian не учитывает в ссылках на заголовки
+HEADING_PUNCTUATION_RE = re.compile(r'[\[\]*|#^:\\]')
+
+# Разделитель на месте вставки при сквозной нумерации смещений
+EMBED_MARK = '\x00'
+
+
+def split_embed_target(target: str):
+    """'заметка#Заголовок', 'заметка#^id' или 'заметка^id' → (заметка, ссылка).
+
+    Ссылка - 'Заголовок' (вложенные через '#') или '^id', None - вся
+    заметка. Пустое имя заметки означает текущую заметку.
+    """
+    name = target.split('|', 1)[0]
+    if '#' in name:
+        name, _, ref = name.partition('#')
+    elif '^' in name:
+        name, _, ref = name.partition('^')
+        ref = '^' + ref
+    else:
+        return name.strip(), None
+    return name.strip(), ref.strip() or None
+
+
+def _heading_key(title: str) -> str:
+    return ' '.join(HEADING_PUNCTUATION_RE.sub(' ', title).split()).lower()
+
+
+class SectionIndex:
+    """Заголовки и блоки разобранной заметки (parse_obsidian_markdown).
+
+    Смещения считаются по тексту заметки, в котором каждая вставка
+    занимает один символ. section() возвращает части только нужного
+    раздела или блока в том же формате, что parse_obsidian_markdown.
+    """
+
+    def __init__(self, parts: List[str]):
+        self.texts = parts[0::2]
+        self.embeds = parts[1::2]
+        self.offsets = []
+        offset = 0
+        for text in self.texts:
+            self.offsets.append(offset)
+            offset += len(text) + 1
+        text = EMBED_MARK.join(self.texts)
+
+        # (начало строки, уровень, ключ заголовка)
+        self.headings = []
+        # id → (начало, конец)
+        self.blocks = {}
+        # Концы строк заголовков и блоков кода: абзац не начинается раньше
+        self._breaks = []
+        for match in SECTION_RE.finditer(text):
+            if match.lastgroup == 'title':
+                self.headings.append((match.start(), len(match.group('hashes')),
+                                      _heading_key(match.group('title'))))
+                self._breaks.append(match.end() + 1)
+            elif match.lastgroup == 'fence':
+                self._breaks.append(match.end() + 1)
+            elif match.lastgroup == 'block':
+                self.blocks.setdefault(match.group('block'), self._block(text, match))
+
+        self.length = len(text)
+
+    def _block(self, text: str, match) -> tuple:
+        """Границы блока, помеченного ^id (сама метка в блок не входит)"""
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        if text[line_start:match.start()].strip():
+            # Метка в конце строки: пункт списка или весь абзац
+            end = match.start()
+            if LIST_ITEM_RE.match(text, line_start):
+                return line_start, end
+            search_to = line_start
+        else:
+            # Метка на отдельной строке относится к абзацу над ней
+            end = max(line_start - 1, 0)
+            search_to = end
+
+        start = text.rfind('\n\n', 0, search_to)
+        start = 0 if start < 0 else start + 2
+        # Абзац не начинается раньше конца заголовка или блока кода над ним
+        i = bisect.bisect_right(self._breaks, search_to)
+        if i:
+            start = max(start, self._breaks[i - 1])
+        return start, end
+
+    def _heading_range(self, path: List[str]):
+        start, end, level = 0, self.length, 0
+        position = 0
+        for name in path:
+            key = _heading_key(name)
+            for i in range(position, len(self.headings)):
+                heading_start, heading_level, heading_key = self.headings[i]
+                if heading_start >= end:
+                    return None
+                if heading_start >= start and heading_level > level and heading_key == key:
+                    break
+            else:
+                return None
+            start, level, position = heading_start, heading_level, i + 1
+            end = self.length
+            for next_start, next_level, _ in self.headings[i + 1:]:
+                if next_level <= level:
+                    end = next_start
+                    break
+        return start, end
+
+    def section(self, ref: str) -> Optional[List[str]]:
+        """Части раздела ('Заголовок#Подзаголовок') или блока ('^id')"""
+        if ref.startswith('^'):
+            bounds = self.blocks.get(ref[1:])
+        else:
+            bounds = self._heading_range([name for name in ref.split('#') if name.strip()])
+        if bounds is None:
+            return None
+        return self._slice(*bounds)
+
+    def _slice(self, start: int, end: int) -> List[str]:
+        parts = []
+        current = ''
+        for i, text in enumerate(self.texts):
+            offset = self.offsets[i]
+            a, b = max(start, offset), min(end, offset + len(text))
+            if a < b:
+                current += text[a - offset:b - offset]
+            if i < len(self.embeds) and start <= offset + len(text) < end:
+                parts.append(current)
+                parts.append(self.embeds[i])
+                current = ''
+        parts.append(current)
+        return parts
@@ -0,0 +1,33 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# Тесты импортируют модули приложения из корня репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Кэш приложения - во временной папке: задается до импорта модулей,
+# которые читают OBS2EPUB_CACHE_DIR при загрузке
+CACHE_DIR = tempfile.mkdtemp(prefix='obs2epub-tests-')
+os.environ['OBS2EPUB_CACHE_DIR'] = CACHE_DIR
+atexit.register(shutil.rmtree, CACHE_DIR, True)
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """Модуль приложения со своей базой данных и домашней папкой теста"""
+    home = tmp_path / 'home'
+    (home / 'Downloads').mkdir(parents=True)
+    monkeypatch.setenv('HOME', str(home))
+    # Импорт приложения создает obs2epub.db в текущей папке
+    monkeypatch.chdir(tmp_path)
+    import app
+    from database import Database
+
+    monkeypatch.setattr(app, 'db', Database(str(tmp_path / 'obs2epub.db')))
+    monkeypatch.setattr(app, 'current_project', None)
+    monkeypatch.setattr(app, 'folder_tree_cache', None)
+    return app
@@ -0,0 +1,215 @@
+"""
+Экспорт через API приложения: скачивание готовых книг и пакетный экспорт
+"""
+import os
+import threading
+import zipfile
+
+import pytest
+
+NOTE = '# Заметка {name}\n\nТекст заметки {name}.\n'
+
+
+def make_vault(root, folders):
+    """Хранилище: папка → имена заметок"""
+    for folder, names in folders.items():
+        os.makedirs(root / folder, exist_ok=True)
+        for name in names:
+            (root / folder / f'{name}.md').write_text(NOTE.format(name=name), encoding='utf-8')
+    return str(root)
+
+
+def set_project(client, path, selected=()):
+    project = client.post('/api/set-project', json={'path': path, 'name': 'vault'}).json
+    assert project['success'], project
+    for folder in selected:
+        result = client.post('/api/set-folder-state',
+                             json={'folder_path': folder, 'is_selected': True}).json
+        assert result['success'], result
+    return project['project']
+
+
+def finished(app_module, job_id):
+    job = app_module.get_export_jobs().get(job_id)
+    assert job.join(timeout=60)
+    return job.to_dict()
+
+
+@pytest.fixture
+def exported(app_module, tmp_path):
+    """Клиент и результат экспорта проекта из одной папки"""
+    client = app_module.app.test_client()
+    vault = make_vault(tmp_path / 'vault', {'Book': ['a', 'b']})
+    project = set_project(client, vault, ['Book'])
+
+    response = client.post(f"/api/projects/{project['id']}/export", json={'title': 'Книга'}).json
+    assert response['success'], response
+    job = finished(app_module, response['job_id'])
+    assert job['state'] == 'done', job
+    return client, job['result']
+
+
+def test_download_sends_book_with_etag(exported):
+    client, result = exported
+
+    response = client.get(result['download_url'])
+
+    assert response.status_code == 200
+    assert response.data[:2] == b'PK'
+    assert response.headers['ETag'].strip('"').startswith(result['artifact_id'])
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_download_is_not_modified_for_same_etag(exported):
+    client, result = exported
+    etag = client.get(result['download_url']).headers['ETag']
+
+    response = client.get(result['download_url'], headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_download_resumes_with_range(exported):
+    client, result = exported
+    book = client.get(result['download_url']).data
+
+    response = client.get(result['download_url'], headers={'Range': 'bytes=10-'})
+
+    assert response.status_code == 206
+    assert response.data == book[10:]
+    assert response.headers['Content-Range'] == f'bytes 10-{len(book) - 1}/{len(book)}'
+
+
+def test_download_of_unknown_book(exported):
+    client, result = exported
+
+    assert client.get(f"/api/exports/{'0' * 40}/download").status_code == 404
+    assert client.get('/api/exports/not-an-id/download').status_code == 404
+
+
+def chapters(path):
+    with zipfile.ZipFile(path) as epub:
+        return [epub.read(name).decode('utf-8') for name in sorted(epub.namelist())
+                if 'chapter_' in name]
+
+
+@pytest.fixture
+def batch_project(app_module, tmp_path, monkeypatch):
+    """Клиент, проект из трех папок и счетчик проверок индекса хранилища"""
+    client = app_module.app.test_client()
+    vault = make_vault(tmp_path / 'vault', {'Book0': ['a0', 'b0'], 'Book1': ['a1'],
+                                            'Selected': ['s0', 's1', 's2'], 'Common': []})
+    # Общая вставка в обеих книгах из папок
+    (tmp_path / 'vault' / 'Common' / 'Общее.md').write_text('Общий текст.', encoding='utf-8')
+    for folder, name in (('Book0', 'b0'), ('Book1', 'a1')):
+        with open(tmp_path / 'vault' / folder / f'{name}.md', 'a', encoding='utf-8') as f:
+            f.write('\n![[Общее]]\n')
+    project = set_project(client, vault, ['Selected'])
+
+    result = client.post('/api/export-settings',
+                         json={'workers': 2, 'copy_to_downloads': True}).json
+    assert result['success'], result
+    refreshes = []
+    refresh_project_index = app_module.refresh_project_index
+    monkeypatch.setattr(app_module, 'refresh_project_index',
+                        lambda project: refreshes.append(project['id'])
+                        or refresh_project_index(project))
+    return client, project, refreshes
+
+
+def submit_batch(client, project, books):
+    response = client.post(f"/api/projects/{project['id']}/batch-export", json={'books': books})
+    return response.status_code, response.json
+
+
+def test_batch_builds_books_in_parallel(app_module, batch_project, tmp_path):
+    client, project, refreshes = batch_project
+    downloads = tmp_path / 'home' / 'Downloads'
+    (downloads / 'Book0.epub').write_bytes(b'busy')
+
+    status, response = submit_batch(client, project, [
+        {'folder': 'Book0'}, {'folder': 'Book1'}, {'title': 'Выбор'}])
+    assert status == 200, response
+    jobs = [finished(app_module, job['id']) for job in response['jobs']]
+
+    assert [job['state'] for job in jobs] == ['done'] * 3, jobs
+    assert [job['title'] for job in jobs] == ['Book0', 'Book1', 'Выбор']
+    # Индекс хранилища проверяется один раз на пакет
+    assert len(refreshes) == 1
+    paths = [job['result']['path'] for job in jobs]
+    assert [os.path.basename(path) for path in paths] == ['Book0_1.epub', 'Book1.epub',
+                                                          'Выбор.epub']
+    assert (downloads / 'Book0.epub').read_bytes() == b'busy'
+
+    book0, book1, selected = (chapters(path) for path in paths)
+    assert len(book0) == 2 and len(book1) == 1 and len(selected) == 3
+    assert 'Общий текст.' in book0[1] and 'Общий текст.' in book1[0]
+    # Кэш заметок общий для книг пакета: каждая заметка, в том числе
+    # общая вставка, разобрана один раз
+    stats = app_module.get_note_cache(project['path']).stats()
+    assert stats['entries'] == stats['misses'] == 7
+
+    batch = client.get(f"/api/export-batches/{response['batch_id']}").json
+    assert batch['finished']
+
+
+def test_cancelled_batch(app_module, batch_project, tmp_path, monkeypatch):
+    client, project, _ = batch_project
+    # Первое задание ждет, пока пакет не будет отменен
+    started, release = threading.Event(), threading.Event()
+    run_export = app_module.run_export
+
+    def gated_export(job, *args):
+        started.set()
+        release.wait(10)
+        return run_export(job, *args)
+
+    monkeypatch.setattr(app_module, 'run_export', gated_export)
+    status, response = submit_batch(client, project, [
+        {'folder': 'Book0', 'title': 'Отмена 0'}, {'folder': 'Book1', 'title': 'Отмена 1'},
+        {'title': 'Отмена 2'}])
+    assert status == 200, response
+    assert started.wait(10)
+
+    cancelled = client.post(f"/api/export-batches/{response['batch_id']}/cancel").json
+    release.set()
+    jobs = [finished(app_module, job['id']) for job in response['jobs']]
+
+    assert cancelled == {'success': True, 'cancelled': 3}
+    assert [job['state'] for job in jobs] == ['cancelled'] * 3
+    assert os.listdir(tmp_path / 'home' / 'Downloads') == []
+
+
+def test_batch_file_ids_are_normalised(app_module, batch_project):
+    client, project, _ = batch_project
+    ids = {file['name']: file['id'] for file in client.get('/api/get-project-files').json['files']}
+
+    # id из JSON строкой и числом - книга в заданном порядке
+    status, response = submit_batch(client, project, [
+        {'title': 'По id', 'files': [str(ids['s2.md']), ids['s0.md']]}])
+    assert status == 200, response
+    [job] = [finished(app_module, job['id']) for job in response['jobs']]
+
+    assert job['state'] == 'done', job
+    book = chapters(job['result']['path'])
+    assert len(book) == 2
+    assert 'Заметка s2' in book[0] and 'Заметка s0' in book[1]
+
+
+@pytest.mark.parametrize('book, error', [
+    ({'title': 'Книга', 'files': 5}, 'Книга "Книга": files должен быть списком'),
+    ({'title': 'Книга', 'include': ['x']}, 'Книга "Книга": неверный id файла в include'),
+    ({'title': 'Книга', 'exclude': [None]}, 'Книга "Книга": неверный id файла в exclude'),
+    ({'title': 'Книга', 'files': ['999999']}, 'Книга "Книга": файлы не найдены в проекте: 999999'),
+    ({'folder': 'Нет такой'}, 'Книга "Нет такой": папка не найдена'),
+    ({'folder': 5}, 'Папка книги должна быть строкой'),
+])
+def test_invalid_batch_is_rejected(batch_project, book, error):
+    client, project, _ = batch_project
+
+    status, response = submit_batch(client, project, [{'folder': 'Book0'}, book])
+
+    assert status == 400
+    assert response['error'].startswith(error)
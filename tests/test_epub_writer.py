@@ -0,0 +1,73 @@
+"""
+Встроенная сборка EPUB: все XHTML-файлы книги должны разбираться как XML
+"""
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+from chapter_cache import ChapterCache
+from epub_writer import build_epub
+
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+CHAPTERS = [
+    '# Глава & <первая>\n\nТекст с переносом<br>и <b>незакрытым тегом.\n\n'
+    'Сущности: &nbsp; &copy; &mdash; и одиночный & амперсанд.',
+    '## Раздел\n\n<div class="note" data-open>Блок <img src="images/a.png"> '
+    '<input disabled></div>\n\n<p>Абзац <span>без конца</p>\n\n---\n\n'
+    '```\n<br> в коде остается текстом\n```',
+    'Без заголовка: <i>курсив</b> и <hr> разделитель',
+]
+
+
+def build(tmp_path, chapter_cache=None, executor=None, name='book.epub'):
+    path = str(tmp_path / name)
+    image = tmp_path / 'a.png'
+    image.write_bytes(b'\x89PNG\r\n\x1a\n')
+    build_epub(CHAPTERS, path, 'Книга <тест>', images=[('a.png', str(image))],
+               chapter_cache=chapter_cache, executor=executor, workers=2)
+    return path
+
+
+def parse_xhtml(path):
+    """Разбор всех .xhtml (и описаний книги) архива, имя → корневой элемент"""
+    documents = {}
+    with zipfile.ZipFile(path) as epub:
+        for name in epub.namelist():
+            if name.endswith(('.xhtml', '.opf', '.ncx', '.xml')):
+                documents[name] = ElementTree.fromstring(epub.read(name))
+    return documents
+
+
+def test_every_xhtml_is_well_formed(tmp_path):
+    documents = parse_xhtml(build(tmp_path))
+
+    chapters = sorted(name for name in documents if 'chapter_' in name)
+    assert chapters == ['OEBPS/chapter_0001.xhtml', 'OEBPS/chapter_0002.xhtml',
+                        'OEBPS/chapter_0003.xhtml']
+    assert 'OEBPS/nav.xhtml' in documents
+
+    first = documents['OEBPS/chapter_0001.xhtml']
+    assert first.find(f'.//{XHTML}br') is not None
+    assert first.find(f'.//{XHTML}b').text == 'незакрытым тегом.'
+
+
+def test_cached_chapters_are_well_formed(tmp_path):
+    cache = ChapterCache(str(tmp_path / 'chapters'))
+    build(tmp_path, cache)
+    parse_xhtml(build(tmp_path, cache))
+
+    assert cache.stats()['hits'] == len(CHAPTERS)
+
+
+def test_pool_build_keeps_chapter_order(tmp_path):
+    sequential = build(tmp_path)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        parallel = build(tmp_path, executor=pool, name='parallel.epub')
+
+    with zipfile.ZipFile(sequential) as first, zipfile.ZipFile(parallel) as second:
+        chapters = [name for name in first.namelist() if 'chapter_' in name]
+        assert chapters == [name for name in second.namelist() if 'chapter_' in name]
+        for name in chapters:
+            assert first.read(name) == second.read(name)
+    parse_xhtml(parallel)
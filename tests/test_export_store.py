@@ -0,0 +1,144 @@
+"""
+Хранилище готовых книг: проверка зависимостей и очистка
+"""
+import os
+import time
+
+from export_store import ExportDependencies, ExportStore, export_fingerprint
+
+
+def write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return str(path)
+
+
+def put(store, tmp_path, key, dependencies=None, size=100):
+    epub_path = tmp_path / f'{key}.epub'
+    epub_path.write_bytes(b'x' * size)
+    return store.put(key, str(epub_path), 'Книга.epub', dependencies or ExportDependencies())
+
+
+def no_lookups(kind, name, from_path):
+    raise AssertionError('поиск вставок не ожидался')
+
+
+def age(store, key, seconds):
+    """Последнее использование записи seconds секунд назад"""
+    used = time.time() - seconds
+    os.utime(os.path.join(store.root, key, 'meta.json'), (used, used))
+
+
+def test_fingerprint_follows_notes_title_and_options(tmp_path):
+    note = write(tmp_path / 'note.md', 'текст')
+    fingerprint = export_fingerprint([note], 'Книга', {'backend': 'native'})
+
+    assert export_fingerprint([note], 'Книга', {'backend': 'native'}) == fingerprint
+    assert export_fingerprint([note], 'Другая', {'backend': 'native'}) != fingerprint
+    assert export_fingerprint([note], 'Книга', {'backend': 'ebook-convert'}) != fingerprint
+
+    stat = os.stat(note)
+    os.utime(note, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert export_fingerprint([note], 'Книга', {'backend': 'native'}) != fingerprint
+
+
+def test_changed_dependency_invalidates_entry(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'))
+    embedded = write(tmp_path / 'embedded.md', 'вставка')
+    dependencies = ExportDependencies()
+    dependencies.add_file(embedded)
+    dependencies.add_file(str(tmp_path / 'missing.png'))
+    key = 'a' * 40
+    put(store, tmp_path, key, dependencies)
+
+    assert store.get(key, no_lookups)['filename'] == 'Книга.epub'
+
+    write(embedded, 'вставка изменилась')
+    assert store.get(key, no_lookups) is None
+    assert store.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_appeared_dependency_invalidates_entry(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'))
+    dependencies = ExportDependencies()
+    dependencies.add_file(str(tmp_path / 'missing.png'))
+    key = 'a' * 40
+    put(store, tmp_path, key, dependencies)
+    assert store.get(key, no_lookups) is not None
+
+    write(tmp_path / 'missing.png', 'появилось')
+    assert store.get(key, no_lookups) is None
+
+
+def test_changed_lookup_invalidates_entry(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'))
+    dependencies = ExportDependencies()
+    dependencies.add_lookup('note', 'Вставка', '/vault/a.md', None)
+    dependencies.add_lookup('image', 'pic.png', '/vault/a.md', '/vault/pic.png')
+    key = 'a' * 40
+    put(store, tmp_path, key, dependencies)
+    found = {('note', 'Вставка'): None, ('image', 'pic.png'): '/vault/pic.png'}
+
+    def lookup(kind, name, from_path):
+        assert from_path == '/vault/a.md'
+        return found[(kind, name)]
+
+    assert store.get(key, lookup) is not None
+
+    # В хранилище появилась заметка с именем прежде ненайденной вставки
+    found[('note', 'Вставка')] = '/vault/Вставка.md'
+    assert store.get(key, lookup) is None
+
+
+def test_artifact_checks_id_but_not_dependencies(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'))
+    embedded = write(tmp_path / 'embedded.md', 'вставка')
+    dependencies = ExportDependencies()
+    dependencies.add_file(embedded)
+    key = 'b' * 40
+    put(store, tmp_path, key, dependencies)
+    write(embedded, 'вставка изменилась')
+
+    assert store.artifact(key)['key'] == key
+    assert store.artifact('../' + key) is None
+    assert store.artifact('c' * 40) is None
+
+
+def test_retention_removes_unused_entries(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'), retention=3600)
+    old, recent = 'a' * 40, 'b' * 40
+    put(store, tmp_path, old)
+    put(store, tmp_path, recent)
+    age(store, old, 7200)
+    age(store, recent, 60)
+
+    store.prune()
+
+    assert store.artifact(old) is None
+    assert store.artifact(recent) is not None
+
+
+def test_max_bytes_removes_least_recently_used(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'), max_bytes=10 ** 6)
+    keys = ['a' * 40, 'b' * 40, 'c' * 40]
+    for seconds, key in zip((300, 100, 200), keys):
+        put(store, tmp_path, key, size=1000)
+        age(store, key, seconds)
+
+    # Места не хватает на одну запись - удаляется давно не использованная
+    store.max_bytes = sum(size for _, size, _ in store._entries()) - 1
+    store.prune()
+
+    assert [store.artifact(key) is not None for key in keys] == [False, True, True]
+
+
+def test_put_prunes_and_keeps_new_entry(tmp_path):
+    store = ExportStore(str(tmp_path / 'exports'), max_bytes=1500)
+    put(store, tmp_path, 'a' * 40, size=1000)
+    age(store, 'a' * 40, 60)
+
+    entry = put(store, tmp_path, 'b' * 40, size=1000)
+
+    assert entry['size'] == 1000
+    assert os.path.exists(entry['path'])
+    assert store.artifact('a' * 40) is None
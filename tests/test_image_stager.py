@@ -0,0 +1,89 @@
+"""
+Изображения книги: перекодирование и тип изображений в манифесте
+"""
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import pytest
+
+import image_optimizer
+from epub_writer import build_epub
+from image_optimizer import IMAGE_PROFILES, ImageOptimizer
+from image_stager import ImageStager
+
+OPF = '{http://www.idpf.org/2007/opf}'
+
+
+def manifest(path):
+    """Изображения из манифеста книги: путь в архиве → media-type"""
+    with zipfile.ZipFile(path) as epub:
+        root = ElementTree.fromstring(epub.read('OEBPS/content.opf'))
+    return {item.get('href'): item.get('media-type')
+            for item in root.iter(f'{OPF}item') if item.get('href').startswith('images/')}
+
+
+def build(tmp_path, stager, name):
+    path = str(tmp_path / 'book.epub')
+    build_epub([f'![](images/{name})'], path, 'Книга', images=stager)
+    return manifest(path)
+
+
+def failing_transcode(job):
+    raise OSError('не удалось перекодировать')
+
+
+@pytest.mark.parametrize('inline', [False, True])
+def test_failed_transcode_keeps_source_media_type(tmp_path, monkeypatch, inline):
+    monkeypatch.setattr(image_optimizer, '_transcode', failing_transcode)
+    source = tmp_path / 'scan.bmp'
+    source.write_bytes(b'BM' + b'\0' * 64)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        optimizer = ImageOptimizer(IMAGE_PROFILES['phone'], str(tmp_path / 'cache'),
+                                   executor=None if inline else executor)
+        stager = ImageStager(optimizer=optimizer)
+        name = stager.stage(str(source))
+        images = build(tmp_path, stager, name)
+
+    # Имя, на которое ссылаются главы, выдано заранее под формат результата
+    assert name.endswith('.png')
+    assert images == {f'images/{name}': 'image/bmp'}
+
+
+def test_transcoded_image_uses_result_media_type(tmp_path, monkeypatch):
+    def transcode(job):
+        dest = job[1]
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+        return dest
+
+    monkeypatch.setattr(image_optimizer, '_transcode', transcode)
+    source = tmp_path / 'scan.bmp'
+    source.write_bytes(b'BM' + b'\0' * 64)
+    optimizer = ImageOptimizer(IMAGE_PROFILES['phone'], str(tmp_path / 'cache'))
+
+    stager = ImageStager(optimizer=optimizer)
+    name = stager.stage(str(source))
+
+    assert build(tmp_path, stager, name) == {f'images/{name}': 'image/png'}
+    assert optimizer.misses == 1
+
+
+def test_export_without_process_pool_transcodes_in_threads(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'pillow_available', lambda: True)
+    profile = IMAGE_PROFILES['phone']
+
+    optimizer = app_module.get_image_optimizer(profile, [])
+    assert isinstance(optimizer.executor, ThreadPoolExecutor)
+    assert app_module.get_image_optimizer(profile, []).executor is optimizer.executor
+
+    # Пул процессов экспорта, если он есть, используется и для изображений
+    pool = object()
+    assert app_module.get_image_optimizer(profile, [], pool).executor is pool
+
+    # В потоке экспорта - только если это задано явно
+    app_module.db.set_setting('image_workers', '0')
+    assert app_module.get_image_optimizer(profile, []).executor is None
@@ -0,0 +1,64 @@
+"""
+Кэш обработанных заметок: учет и ограничение размера записей на диске
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from note_cache import NoteCache, disk_entries
+
+
+def disk_bytes(cache):
+    return sum(size for _, size, _ in disk_entries(cache.cache_dir))
+
+
+def write_note(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    # Новый mtime даже при быстрой повторной записи
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+def test_rewritten_entry_is_not_counted_twice(tmp_path):
+    note = str(tmp_path / 'note.md')
+    cache = NoteCache(str(tmp_path / 'cache'))
+    write_note(note, 'Текст [[ссылка]]\n')
+    cache.get_parts(note)
+    assert cache.stats()['bytes'] == disk_bytes(cache)
+
+    for i in range(5):
+        write_note(note, f'Правка {i} [[ссылка]]\n' * (i + 1))
+        cache.get_parts(note)
+        assert cache.stats()['bytes'] == disk_bytes(cache)
+
+    # Запись стала короче - размер уменьшается
+    write_note(note, 'x\n')
+    cache.get_parts(note)
+    assert cache.stats()['bytes'] == disk_bytes(cache)
+
+
+def test_pool_rewrites_are_counted_once(tmp_path):
+    notes = [str(tmp_path / f'{i}.md') for i in range(4)]
+    cache = NoteCache(str(tmp_path / 'cache'))
+    for note in notes:
+        write_note(note, '# Заметка\n')
+    cache.prefetch(notes)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        for i in range(3):
+            cache.clear()
+            for note in notes:
+                write_note(note, f'# Заметка {i}\n' * (i + 2))
+            cache.prefetch(notes, pool, 2)
+            assert cache.stats()['bytes'] == disk_bytes(cache)
+
+
+def test_disk_entries_are_bounded(tmp_path):
+    cache = NoteCache(str(tmp_path / 'cache'), max_bytes=4000)
+    for i in range(40):
+        note = str(tmp_path / f'{i}.md')
+        write_note(note, f'Заметка {i} ' * 20)
+        cache.get_parts(note)
+
+    assert disk_bytes(cache) <= 4000
+    assert cache.stats()['bytes'] == disk_bytes(cache)
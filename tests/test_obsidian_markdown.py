@@ -0,0 +1,135 @@
+"""
+Преобразование Obsidian Markdown: сравнение с эталонными результатами.
+
+Входные заметки лежат в golden/obsidian_markdown/input, ожидаемый
+результат - в golden/obsidian_markdown/expected под тем же именем.
+"""
+import os
+
+import pytest
+
+from obsidian_markdown import (SectionIndex, parse_obsidian_markdown,
+                               render_obsidian_markdown, split_embed_target,
+                               transform_obsidian_markdown)
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden', 'obsidian_markdown')
+CASES = sorted(name[:-3] for name in os.listdir(os.path.join(GOLDEN_DIR, 'input'))
+               if name.endswith('.md'))
+
+
+def read(*path):
+    with open(os.path.join(GOLDEN_DIR, *path), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_golden(name):
+    content = read('input', f'{name}.md')
+
+    assert transform_obsidian_markdown(content) + '\n' == read('expected', f'{name}.md')
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_parse_render_matches_transform(name):
+    content = read('input', f'{name}.md')
+
+    assert render_obsidian_markdown(parse_obsidian_markdown(content)) == \
+        transform_obsidian_markdown(content)
+
+
+def test_golden_embeds_are_rendered():
+    content = read('input', 'embeds.md')
+    result = transform_obsidian_markdown(content, lambda name: f'<<{name}>>')
+
+    assert result + '\n' == read('expected', 'embeds.embedded.md')
+
+
+def test_triple_newlines_collapse_across_many_chunks():
+    # Пустые строки из нескольких кусков текста схлопываются на границах
+    content = 'a\n\n\n[[b]]\n\n\n\n[[c]]\n\n\nd' * 3
+
+    assert '\n\n\n' not in transform_obsidian_markdown(content)
+
+
+SECTIONS_NOTE = '''# Введение
+
+Вступление.
+
+## Детали
+
+Подробности ![[схема.png]] тут.
+
+### Глубже
+
+Самое глубокое.
+
+## Итоги: *главное*
+
+- пункт один
+- пункт два ^list-item
+
+Абзац блока
+на двух строках.
+^para
+
+```
+# не заголовок
+```
+
+# Приложение
+
+Конец.
+'''
+
+
+def sections():
+    return SectionIndex(parse_obsidian_markdown(SECTIONS_NOTE))
+
+
+def test_heading_section_runs_to_next_heading_of_same_level():
+    section = sections().section('Детали')
+
+    assert section[1::2] == ['схема.png']
+    text = ''.join(section[0::2])
+    assert text.startswith('## Детали\n\nПодробности ')
+    assert '### Глубже\n\nСамое глубокое.' in text
+    assert '## Итоги' not in text
+
+
+def test_nested_heading_path_and_heading_punctuation():
+    index = sections()
+
+    assert ''.join(index.section('Введение#Детали#Глубже')).strip() == \
+        '### Глубже\n\nСамое глубокое.'
+    # Знаки, которые Obsidian не учитывает, и регистр
+    assert index.section('итоги главное') is not None
+    assert index.section('Детали#Введение') is None
+    assert index.section('Нет такого') is None
+
+
+def test_fenced_heading_is_not_a_section():
+    index = sections()
+
+    assert index.section('не заголовок') is None
+    assert ''.join(index.section('Приложение')).strip() == '# Приложение\n\nКонец.'
+
+
+def test_block_references():
+    index = sections()
+
+    assert index.section('^list-item') == ['- пункт два']
+    assert index.section('^para') == ['Абзац блока\nна двух строках.']
+    assert index.section('^missing') is None
+
+
+@pytest.mark.parametrize('target, expected', [
+    ('Заметка', ('Заметка', None)),
+    ('Заметка#Раздел#Подраздел', ('Заметка', 'Раздел#Подраздел')),
+    ('Заметка#^id', ('Заметка', '^id')),
+    ('Заметка^id', ('Заметка', '^id')),
+    ('#Раздел', ('', 'Раздел')),
+    ('Заметка#Раздел|псевдоним', ('Заметка', 'Раздел')),
+    ('Заметка#', ('Заметка', None)),
+])
+def test_split_embed_target(target, expected):
+    assert split_embed_target(target) == expected
@@ -0,0 +1,134 @@
+"""
+Граф вставок: циклы, ненайденные вставки и однократная обработка заметок
+"""
+import os
+from collections import Counter
+
+from obsidian_markdown import parse_obsidian_markdown
+from transclusion import TransclusionGraph
+
+VAULT = os.path.abspath(os.sep + 'vault')
+
+
+def path(name):
+    return os.path.join(VAULT, f'{name}.md')
+
+
+def make_graph(notes):
+    """Граф над заметками в памяти: имя → текст"""
+    loads = Counter()
+
+    def load_parts(file_path):
+        loads[file_path] += 1
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        if notes[name] is None:
+            raise OSError('нет доступа')
+        return parse_obsidian_markdown(notes[name])
+
+    def resolve_note(name, from_path):
+        return path(name) if name in notes else None
+
+    return TransclusionGraph(load_parts, resolve_note), loads
+
+
+def render(graph, images=()):
+    embedded = Counter()
+
+    def embed_image(target, from_path):
+        embedded[(target, from_path)] += 1
+        return f'<{target}>' if target in images else ''
+
+    graph.render(embed_image)
+    return embedded
+
+
+def test_shared_embed_is_processed_once():
+    graph, loads = make_graph({
+        'A': 'A1\n\n![[B]]\n\n![[C]]',
+        'B': 'B1 ![[D]]',
+        'C': 'C1 ![[D]] ![[D]]',
+        'D': 'D1 ![[pic.png]]',
+    })
+    graph.add(path('A'))
+    embedded = render(graph, images={'pic.png'})
+
+    assert graph.order.count((path('D'), None)) == 1
+    assert graph.order.index((path('D'), None)) < graph.order.index((path('B'), None))
+    # Изображение в D обработано один раз, хотя D вставлена трижды
+    assert embedded == {('pic.png', path('D')): 1}
+    assert graph.output(path('A')).count('D1 <pic.png>') == 3
+    assert graph.diagnostics == []
+    # Заметка читается при обходе и при обработке, но не на каждую вставку
+    assert loads[path('D')] == loads[path('B')] == 2
+
+
+def test_cycle_is_reported_and_cut():
+    graph, _ = make_graph({
+        'A': 'A1 ![[B]]',
+        'B': 'B1 ![[C]]',
+        'C': 'C1 ![[A]]',
+    })
+    graph.add(path('A'))
+    render(graph)
+
+    assert graph.output(path('A')) == 'A1 \n\nB1 \n\nC1'
+    [cycle] = graph.diagnostics
+    assert cycle['type'] == 'cycle'
+    assert cycle['source'] == path('C')
+    assert cycle['target'] == 'A'
+    assert cycle['cycle'] == [path('A'), path('B'), path('C'), path('A')]
+
+
+def test_self_embed_is_a_cycle():
+    graph, _ = make_graph({'A': 'A1 ![[A]] конец'})
+    graph.add(path('A'))
+    render(graph)
+
+    assert graph.output(path('A')) == 'A1  конец'
+    assert [d['type'] for d in graph.diagnostics] == ['cycle']
+
+
+def test_missing_targets_are_reported():
+    graph, _ = make_graph({
+        'A': 'A1 ![[Нет такой]] ![[B#Нет раздела]] ![[missing.png]] ![[Broken]]',
+        'B': '# Раздел\n\nтекст',
+        'Broken': None,
+    })
+    graph.add(path('A'))
+    render(graph)
+
+    assert graph.output(path('A')) == 'A1'
+    assert sorted((d['type'], d['target']) for d in graph.diagnostics) == [
+        ('error', 'Broken'),
+        ('unresolved', 'B#Нет раздела'),
+        ('unresolved', 'missing.png'),
+        ('unresolved', 'Нет такой'),
+    ]
+
+
+def test_section_embed_inserts_only_the_section():
+    graph, _ = make_graph({
+        'A': '![[B#Второй]]',
+        'B': '# Первый\n\nраз\n\n# Второй\n\nдва ![[C]]\n\n# Третий\n\nтри',
+        'C': 'вставка',
+    })
+    graph.add(path('A'))
+    render(graph)
+
+    assert graph.output(path('A')) == '# Второй\n\nдва \n\nвставка'
+
+
+def test_iter_outputs_follows_book_order_and_releases_text():
+    graph, _ = make_graph({
+        'A': 'A1 ![[Shared]]',
+        'B': 'B1 ![[Shared]]',
+        'Shared': 'общий',
+    })
+    for name in ('B', 'A'):
+        graph.add(path(name))
+
+    outputs = list(graph.iter_outputs([path('A'), path('B')], lambda target, source: ''))
+
+    assert outputs == [(path('A'), 'A1 \n\nобщий'), (path('B'), 'B1 \n\nобщий')]
+    # Все потребители обработаны - в памяти ничего не остается
+    assert graph.outputs == {}
@@ -0,0 +1,87 @@
+"""
+Индекс хранилища: поиск вставляемых заметок и вложений
+"""
+import os
+
+from vault_index import VaultIndex
+
+
+def write(path, text='# Заметка\n'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def make_vault(root, files):
+    for rel_path in files:
+        write(os.path.join(root, *rel_path.split('/')))
+    return VaultIndex(str(root))
+
+
+def test_shortest_path_wins(tmp_path):
+    index = make_vault(tmp_path, ['A/B/Note.md', 'A/Note.md', 'C/D/E/Note.md'])
+
+    assert index.find_note('Note') == str(tmp_path / 'A' / 'Note.md')
+    assert index.find_note('Note.md') == str(tmp_path / 'A' / 'Note.md')
+
+
+def test_equal_depth_is_resolved_by_path(tmp_path):
+    index = make_vault(tmp_path, ['B/Note.md', 'A/Note.md'])
+
+    assert index.find_note('Note') == str(tmp_path / 'A' / 'Note.md')
+
+
+def test_path_qualified_name_matches_by_suffix(tmp_path):
+    index = make_vault(tmp_path, ['Note.md', 'A/B/Note.md', 'XB/Note.md'])
+
+    assert index.find_note('B/Note') == str(tmp_path / 'A' / 'B' / 'Note.md')
+    assert index.find_note('A/B/Note.md') == str(tmp_path / 'A' / 'B' / 'Note.md')
+    assert index.find_note('C/Note') is None
+
+
+def test_missing_note_and_attachment_folders(tmp_path):
+    index = make_vault(tmp_path, ['Images_Attachments/Hidden.md', 'A/Note.md'])
+
+    assert index.find_note('Other') is None
+    # Заметки из папок вложений в поиск заметок не попадают
+    assert index.find_note('Hidden') is None
+
+
+def test_new_note_is_found_after_refresh(tmp_path):
+    index = make_vault(tmp_path, ['A/Note.md'])
+    assert index.find_note('Later') is None
+
+    write(str(tmp_path / 'A' / 'Later.md'))
+    os.utime(tmp_path / 'A', ns=(0, 0))
+    index.refresh()
+
+    assert index.find_note('Later') == str(tmp_path / 'A' / 'Later.md')
+
+
+def test_nearest_attachment_wins(tmp_path):
+    index = make_vault(tmp_path, ['A/B/img.png', 'A/C/img.png', 'img.png', 'D/img.png'])
+
+    assert index.find_attachment('img.png', str(tmp_path / 'A' / 'B')) == \
+        str(tmp_path / 'A' / 'B' / 'img.png')
+    # Больше общих папок с заметкой - ближе, чем вложение в корне
+    assert index.find_attachment('img.png', str(tmp_path / 'A' / 'C' / 'Sub')) == \
+        str(tmp_path / 'A' / 'C' / 'img.png')
+    # Без общих папок побеждает самый короткий путь
+    assert index.find_attachment('img.png', str(tmp_path / 'E')) == str(tmp_path / 'img.png')
+
+
+def test_attachment_in_attachment_folder(tmp_path):
+    index = make_vault(tmp_path, ['Notes/Note.md', 'Notes/Note_Attachments/pic.jpg'])
+
+    assert index.find_attachment('pic.jpg', str(tmp_path / 'Notes')) == \
+        str(tmp_path / 'Notes' / 'Note_Attachments' / 'pic.jpg')
+
+
+def test_path_qualified_attachment_and_missing(tmp_path):
+    index = make_vault(tmp_path, ['A/img.png', 'B/img.png', 'A/Note.md'])
+
+    assert index.find_attachment('B/img.png', str(tmp_path / 'A')) == \
+        str(tmp_path / 'B' / 'img.png')
+    assert index.find_attachment('other.png', str(tmp_path)) is None
+    # Заметки не ищутся как вложения
+    assert index.find_attachment('Note.md', str(tmp_path)) is None
@@ -0,0 +1,95 @@
+"""
+Правила исключения/включения путей при сканировании хранилища
+"""
+import os
+
+import pytest
+
+from vault_rules import ScanRules
+from vault_scanner import VaultScanner
+
+
+@pytest.mark.parametrize('path, is_dir, excluded', [
+    ('Archive', True, True),
+    ('Deep/Nested/Archive', True, True),
+    # 'Archive/' относится только к папкам
+    ('Archive', False, False),
+    ('Archived', True, False),
+])
+def test_dir_only_pattern(path, is_dir, excluded):
+    assert ScanRules(['Archive/']).is_excluded(path, is_dir) is excluded
+
+
+@pytest.mark.parametrize('path, excluded', [
+    ('draft.md', True),
+    ('A/B/draft.md', True),
+    ('A/draft.md.bak', False),
+    ('A/my-draft.md', False),
+])
+def test_name_pattern_matches_at_any_depth(path, excluded):
+    assert ScanRules(['draft.md']).is_excluded(path, False) is excluded
+
+
+@pytest.mark.parametrize('path, excluded', [
+    ('Private', True),
+    ('Notes/Private', False),
+])
+def test_anchored_pattern(path, excluded):
+    assert ScanRules(['/Private']).is_excluded(path, True) is excluded
+
+
+@pytest.mark.parametrize('path, excluded', [
+    ('Notes/tmp', True),
+    ('Notes/A/B/tmp', True),
+    ('tmp', False),
+    ('Other/tmp', False),
+])
+def test_double_star(path, excluded):
+    assert ScanRules(['Notes/**/tmp']).is_excluded(path, True) is excluded
+
+
+def test_leading_and_trailing_double_star():
+    rules = ScanRules(['**/cache', 'Logs/**'])
+
+    assert rules.is_excluded('cache', True)
+    assert rules.is_excluded('A/B/cache', True)
+    assert rules.is_excluded('Logs/2024/jan.md', False)
+    assert not rules.is_excluded('Logs', True)
+
+
+@pytest.mark.parametrize('pattern, path, is_dir, excluded', [
+    ('*.tmp.md', 'x.tmp.md', False, True),
+    ('*.tmp.md', 'A/keep.tmp.md', False, False),
+    ('Archive*/', 'Archive-2020', True, True),
+    ('Archive*/', 'Archive-keep', True, False),
+])
+def test_include_overrides_exclude(pattern, path, is_dir, excluded):
+    rules = ScanRules([pattern], include=['keep.tmp.md', 'Archive-keep/'])
+
+    assert rules.is_excluded(path, is_dir) is excluded
+
+
+def test_comments_blank_lines_and_empty_rules():
+    rules = ScanRules(['# комментарий', '', '  Archive/  ', 'Archive/'])
+
+    assert rules.exclude == ['Archive/']
+    assert not ScanRules()
+    assert not ScanRules().is_excluded('anything', True)
+    assert ScanRules.from_json(rules.to_json()) == rules
+
+
+def test_scanner_skips_excluded_paths(tmp_path):
+    for rel_path in ['A/a.md', 'A/b.tmp.md', 'A/keep.tmp.md', 'Archive/old.md',
+                     'Notes/Archive/nested.md']:
+        path = tmp_path / rel_path
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_text('# Заметка\n', encoding='utf-8')
+
+    scanner = VaultScanner(str(tmp_path))
+    scanner.set_rules(ScanRules(['/Archive', '*.tmp.md'], include=['keep.tmp.md']))
+    scanner.refresh()
+
+    assert sorted(scanner.dir_paths()) == ['', 'A', 'Notes', os.path.join('Notes', 'Archive')]
+    assert sorted(f['relative_path'] for f in scanner.get_files('')) == [
+        os.path.join('A', 'a.md'), os.path.join('A', 'keep.tmp.md'),
+        os.path.join('Notes', 'Archive', 'nested.md')]
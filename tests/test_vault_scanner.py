@@ -0,0 +1,50 @@
+"""
+Сканер хранилища: символические ссылки на папки
+"""
+import os
+
+import pytest
+
+from vault_scanner import VaultScanner
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'symlink') or os.name != 'posix',
+                                reason='нужны символические ссылки')
+
+
+def write(path, text='# Заметка\n'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def test_symlinked_folder_is_scanned(tmp_path):
+    vault = tmp_path / 'vault'
+    outside = tmp_path / 'outside'
+    write(str(vault / 'A' / 'a.md'))
+    write(str(outside / 'Linked' / 'b.md'))
+    os.symlink(outside / 'Linked', vault / 'Linked')
+
+    scanner = VaultScanner(str(vault))
+    tree = scanner.build_tree()
+
+    assert [child['name'] for child in tree['children']] == ['A', 'Linked']
+    assert tree['total_files_count'] == 2
+    assert [f['name'] for f in scanner.get_files('Linked')] == ['b.md']
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_symlink_cycle_is_skipped(tmp_path, workers):
+    vault = tmp_path / 'vault'
+    write(str(vault / 'A' / 'a.md'))
+    write(str(vault / 'B' / 'b.md'))
+    # Ссылка на родителя и взаимные ссылки между папками
+    os.symlink(vault, vault / 'A' / 'up')
+    os.symlink(vault / 'B', vault / 'A' / 'to_b')
+    os.symlink(vault / 'A', vault / 'B' / 'to_a')
+
+    scanner = VaultScanner(str(vault), workers)
+    scanner.refresh()
+
+    assert sorted(scanner.dir_paths()) == ['', 'A', os.path.join('A', 'to_b'),
+                                           'B', os.path.join('B', 'to_a')]
+    assert scanner.build_tree()['total_files_count'] == 4
@@ -0,0 +1,224 @@
+"""
+Граф вставок ![[...]] между заметками
+"""
+import os
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from obsidian_markdown import SectionIndex, render_obsidian_markdown, split_embed_target
+from vault_index import IMAGE_EXTENSIONS
+
+# Состояния обхода в глубину
+_VISITING = 1
+_DONE = 2
+
+# Узел графа: (путь заметки, раздел или None для всей заметки)
+Node = Tuple[str, Optional[str]]
+
+
+def is_image_embed(target: str) -> bool:
+    return os.path.splitext(target)[1].lower() in IMAGE_EXTENSIONS
+
+
+class TransclusionGraph:
+    """Граф вставок заметок, построенный до обработки.
+
+    Узел графа - заметка целиком или ее раздел: ![[заметка#Заголовок]]
+    и ![[заметка#^id]] вставляют только нужный раздел или блок (по
+    индексу заголовков SectionIndex), как в Obsidian.
+
+    add() обходит вставки заметки (итеративно, без рекурсии) и
+    складывает узлы в топологическом порядке: вставляемые раньше
+    вставляющих. render() обрабатывает каждый узел ровно один раз,
+    подставляя уже готовый текст вставленных узлов, сколько бы раз
+    они ни встречались.
+
+    Проблемы не замалчиваются, а собираются в diagnostics:
+    'cycle' - вставка, замыкающая цикл (она пропускается),
+    'unresolved' - заметка, раздел или изображение не найдены,
+    'error' - заметку не удалось прочитать.
+    """
+
+    def __init__(self, load_parts: Callable[[str], List[str]],
+                 resolve_note: Callable[[str, str], Optional[str]],
+                 load_sections: Optional[Callable[[str], SectionIndex]] = None):
+        # load_parts(путь) - разобранная заметка (parse_obsidian_markdown),
+        # resolve_note(имя, путь вставляющей заметки) - путь заметки или None,
+        # load_sections(путь) - индекс разделов заметки
+        self.load_parts = load_parts
+        self.resolve_note = resolve_note
+        self.load_sections = load_sections or (lambda path: SectionIndex(load_parts(path)))
+        # (путь, раздел) → {'parts', 'notes': {имя: узел или None}, 'back': {имя}}.
+        # Части целой заметки не хранятся ('parts' = None), а заново берутся
+        # из load_parts при обработке, чтобы граф не держал в памяти всю книгу
+        self.nodes: Dict[Node, dict] = {}
+        self.order: List[Node] = []
+        self.outputs: Dict[Node, str] = {}
+        self.diagnostics: List[dict] = []
+        self._state: Dict[Node, int] = {}
+        # Заметки, текст которых передан в add() напрямую
+        self._parts: Dict[str, List[str]] = {}
+
+    @staticmethod
+    def label(node: Node) -> str:
+        path, ref = node
+        return path if ref is None else f'{path}#{ref}'
+
+    def _diagnostic(self, kind: str, source: Node, target: Optional[str], message: str,
+                    **extra):
+        self.diagnostics.append(dict(type=kind, source=self.label(source), target=target,
+                                     message=message, **extra))
+
+    def _node_parts(self, node: Node, source: Node, target: Optional[str]) -> List[str]:
+        """Части заметки или ее раздела (пустой текст при ошибке)"""
+        path, ref = node
+        try:
+            if ref is None:
+                return self._parts.get(path) or self.load_parts(path)
+            if path in self._parts:
+                index = SectionIndex(self._parts[path])
+            else:
+                index = self.load_sections(path)
+        except (OSError, UnicodeDecodeError) as e:
+            self._diagnostic('error', source, target, f'Ошибка чтения заметки: {e}')
+            return ['']
+
+        section = index.section(ref)
+        if section is None:
+            self._diagnostic('unresolved', source, target, f'Раздел не найден: {target}')
+            return ['']
+        return section
+
+    def _enter(self, node: Node, parts: Optional[List[str]] = None,
+               source: Optional[Node] = None, target: Optional[str] = None) -> dict:
+        """Загрузка узла и разрешение его вставок"""
+        self._state[node] = _VISITING
+        if parts is None:
+            parts = self._node_parts(node, source or node, target)
+
+        path = node[0]
+        notes = {}
+        for embed_target in parts[1::2]:
+            if embed_target in notes or is_image_embed(embed_target):
+                continue
+            name, ref = split_embed_target(embed_target)
+            resolved = self.resolve_note(name, path) if name else path
+            if resolved is None:
+                self._diagnostic('unresolved', node, embed_target,
+                                 f'Заметка не найдена: {embed_target}')
+                notes[embed_target] = None
+            else:
+                notes[embed_target] = (os.path.abspath(resolved), ref)
+
+        # Целую заметку без ошибок при обработке перечитываем из load_parts
+        keep = node[1] is not None or parts == [''] or node[0] in self._parts
+        self.nodes[node] = {'parts': parts if keep else None, 'notes': notes, 'back': set()}
+        return self.nodes[node]
+
+    def add(self, path: str, parts: Optional[List[str]] = None):
+        """Добавление заметки со всеми вставками (parts - уже разобранный текст)"""
+        root = (os.path.abspath(path), None)
+        if root in self._state:
+            return
+        if parts is not None:
+            self._parts[root[0]] = parts
+
+        node = self._enter(root, parts)
+        stack = [(root, iter(list(node['notes'].items())))]
+        while stack:
+            current, edges = stack[-1]
+            for target, child in edges:
+                if child is None:
+                    continue
+                state = self._state.get(child)
+                if state is None:
+                    child_node = self._enter(child, source=current, target=target)
+                    stack.append((child, iter(list(child_node['notes'].items()))))
+                    break
+                if state == _VISITING:
+                    # Обратная вставка: цикл от child до current
+                    chain = [n for n, _ in stack]
+                    cycle = chain[chain.index(child):] + [child]
+                    self.nodes[current]['back'].add(target)
+                    self._diagnostic('cycle', current, target,
+                                     f'Циклическая вставка: {target}',
+                                     cycle=[self.label(n) for n in cycle])
+            else:
+                stack.pop()
+                self._state[current] = _DONE
+                self.order.append(current)
+
+    def _children(self, node: Node) -> set:
+        entry = self.nodes[node]
+        return {child for target, child in entry['notes'].items()
+                if child is not None and target not in entry['back']}
+
+    def render(self, embed_image: Callable[[str, str], str]) -> Dict[Node, str]:
+        """Обработка всех добавленных узлов (каждого - один раз).
+
+        embed_image(имя, путь заметки) возвращает markdown изображения
+        или пустую строку, если изображение не найдено.
+        """
+        for node in self.order:
+            if node not in self.outputs:
+                self.outputs[node] = self._render_node(node, embed_image)
+        return self.outputs
+
+    def iter_outputs(self, paths: List[str],
+                     embed_image: Callable[[str, str], str]) -> Iterator[Tuple[str, str]]:
+        """Обработанный текст заметок paths (уже добавленных через add())
+        по одной, в порядке paths.
+
+        Узлы обрабатываются по мере надобности, а текст вставленного узла
+        освобождается, как только обработаны все его потребители, поэтому
+        в памяти одновременно находится текст одной заметки и еще нужных
+        вставок, а не всей книги.
+        """
+        roots = [(os.path.abspath(path), None) for path in paths]
+        consumers = Counter(roots)
+        for node in self.order:
+            consumers.update(self._children(node))
+
+        def release(node):
+            consumers[node] -= 1
+            if consumers[node] <= 0:
+                self.outputs.pop(node, None)
+
+        position = 0
+        for root in roots:
+            while root not in self.outputs:
+                node = self.order[position]
+                position += 1
+                if node in self.outputs:
+                    continue
+                self.outputs[node] = self._render_node(node, embed_image)
+                for child in self._children(node):
+                    release(child)
+            yield root[0], self.outputs[root]
+            release(root)
+
+    def output(self, path: str) -> str:
+        """Обработанный текст заметки, добавленной через add()"""
+        return self.outputs[(os.path.abspath(path), None)]
+
+    def _render_node(self, node: Node, embed_image: Callable[[str, str], str]) -> str:
+        entry = self.nodes[node]
+        path = node[0]
+        parts = entry['parts']
+        if parts is None:
+            parts = self._node_parts(node, node, None)
+
+        def embed(target):
+            if is_image_embed(target):
+                text = embed_image(target, path)
+                if not text:
+                    self._diagnostic('unresolved', node, target,
+                                     f'Изображение не найдено: {target}')
+                return text
+            child = entry['notes'].get(target)
+            if child is None or target in entry['back']:
+                return ''
+            # Добавляем разделитель без длинного имени
+            return f"\n\n{self.outputs[child]}\n\n"
+
+        return render_obsidian_markdown(parts, embed)
@@ -0,0 +1,134 @@
+"""
+Индекс хранилища Obsidian для быстрого поиска вставляемых заметок и вложений
+"""
+import os
+import threading
+from typing import Dict, List, Optional
+
+from vault_scanner import VaultScanner
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp']
+
+
+class VaultIndex(VaultScanner):
+    """Индекс файлов хранилища: имя заметки → пути, имя вложения → пути.
+
+    Строится поверх снимка VaultScanner один раз на проект и
+    переиспользуется деревом папок, списками файлов и всеми вставками
+    экспорта. Индексы обновляются по одной папке при каждом её
+    перечитывании. Заметки из папок вложений в поиск заметок
+    не попадают, но индексируются как вложения.
+    """
+
+    def __init__(self, base_path: str, workers: int = 1):
+        super().__init__(base_path, workers)
+        # имя файла → абсолютные пути
+        self._notes: Dict[str, List[str]] = {}
+        # расширение → имя файла → абсолютные пути
+        self._attachments: Dict[str, Dict[str, List[str]]] = {}
+
+    @staticmethod
+    def _is_note(name: str, record: dict) -> bool:
+        return name.endswith('.md') and not record['in_attachments']
+
+    def _index_dir(self, rel_dir: str, record: dict):
+        dir_path = self._abs(rel_dir)
+        for name in record['files']:
+            file_path = os.path.join(dir_path, name)
+            if self._is_note(name, record):
+                self._notes.setdefault(name, []).append(file_path)
+            else:
+                ext = os.path.splitext(name)[1].lower()
+                by_name = self._attachments.setdefault(ext, {})
+                by_name.setdefault(name, []).append(file_path)
+
+    def _unindex_dir(self, rel_dir: str, record: dict):
+        dir_path = self._abs(rel_dir)
+        for name in record['files']:
+            file_path = os.path.join(dir_path, name)
+            if self._is_note(name, record):
+                self._remove_path(self._notes, name, file_path)
+                continue
+            ext = os.path.splitext(name)[1].lower()
+            by_name = self._attachments.get(ext)
+            if by_name is not None:
+                self._remove_path(by_name, name, file_path)
+                if not by_name:
+                    del self._attachments[ext]
+
+    @staticmethod
+    def _remove_path(mapping: Dict[str, List[str]], name: str, file_path: str):
+        paths = mapping.get(name)
+        if not paths:
+            return
+        if file_path in paths:
+            paths.remove(file_path)
+        if not paths:
+            del mapping[name]
+
+    @staticmethod
+    def _filter_by_suffix(candidates: List[str], search_name: str) -> List[str]:
+        """Ссылка вида [[Папка/Заметка]] - оставляем только совпадающие пути"""
+        if not os.path.dirname(search_name):
+            return candidates
+        suffix = os.sep + search_name.lstrip(os.sep)
+        return [p for p in candidates if p.endswith(suffix)]
+
+    def find_note(self, filename: str) -> Optional[str]:
+        """Поиск markdown файла по имени (или по хвосту пути)"""
+        search_name = filename if filename.endswith('.md') else f"{filename}.md"
+        search_name = search_name.replace('/', os.sep)
+
+        with self._lock:
+            self._ensure_built()
+            candidates = list(self._notes.get(os.path.basename(search_name), ()))
+
+        candidates = self._filter_by_suffix(candidates, search_name)
+        if not candidates:
+            return None
+
+        # Как и в Obsidian, при совпадении имен выбираем самый короткий путь
+        return min(candidates, key=lambda p: (p.count(os.sep), p))
+
+    def find_attachment(self, filename: str, from_dir: str) -> Optional[str]:
+        """Поиск вложения с предпочтением ближайшего к заметке пути"""
+        search_name = filename.replace('/', os.sep)
+        name = os.path.basename(search_name)
+        ext = os.path.splitext(name)[1].lower()
+
+        with self._lock:
+            self._ensure_built()
+            candidates = list(self._attachments.get(ext, {}).get(name, ()))
+
+        candidates = self._filter_by_suffix(candidates, search_name)
+        if not candidates:
+            return None
+
+        from_parts = os.path.abspath(from_dir).split(os.sep)
+
+        def distance(path):
+            parts = os.path.dirname(path).split(os.sep)
+            common = 0
+            for a, b in zip(parts, from_parts):
+                if a != b:
+                    break
+                common += 1
+            # Больше общих папок с заметкой → ближе; затем короче путь
+            return (-common, len(parts), path)
+
+        return min(candidates, key=distance)
+
+
+_indexes: Dict[str, VaultIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vault_index(base_path: str) -> VaultIndex:
+    """Получение (или создание) индекса для папки проекта"""
+    key = os.path.abspath(base_path)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = VaultIndex(key)
+            _indexes[key] = index
+        return index
@@ -0,0 +1,107 @@
+"""
+Правила исключения/включения путей при сканировании хранилища
+"""
+import json
+import re
+from typing import Iterable, List, Optional
+
+
+def translate_pattern(pattern: str) -> str:
+    """Перевод шаблона в стиле .gitignore в регулярное выражение.
+
+    * - любые символы внутри имени, ? - один символ, ** - любое число
+    папок. Шаблон без '/' сопоставляется с именем на любой глубине,
+    шаблон с '/' (или начинающийся с '/') - с путем от корня хранилища.
+    """
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+
+    prefix = '' if anchored else '(?:.*/)?'
+    return prefix + ''.join(regex)
+
+
+def _compile(patterns: List[str], dirs: bool) -> Optional['re.Pattern']:
+    """Объединение шаблонов в одно выражение (для папок или для файлов)"""
+    parts = []
+    for pattern in patterns:
+        if pattern.endswith('/') and not dirs:
+            # Шаблон 'папка/' относится только к папкам
+            continue
+        parts.append(translate_pattern(pattern))
+    if not parts:
+        return None
+    return re.compile('(?:' + '|'.join(parts) + r')\Z', re.DOTALL)
+
+
+class ScanRules:
+    """Скомпилированные правила сканирования проекта.
+
+    exclude - шаблоны путей, которые не сканируются (исключенная папка
+    не обходится вовсе), include - шаблоны, возвращающие пути,
+    попавшие под exclude (как '!шаблон' в .gitignore). Все шаблоны
+    компилируются один раз в одно выражение для папок и одно для файлов.
+    """
+
+    def __init__(self, exclude: Iterable[str] = (), include: Iterable[str] = ()):
+        self.exclude = self._clean(exclude)
+        self.include = self._clean(include)
+        self._exclude_dirs = _compile(self.exclude, dirs=True)
+        self._exclude_files = _compile(self.exclude, dirs=False)
+        self._include_dirs = _compile(self.include, dirs=True)
+        self._include_files = _compile(self.include, dirs=False)
+
+    @staticmethod
+    def _clean(patterns: Iterable[str]) -> List[str]:
+        result = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if pattern and not pattern.startswith('#') and pattern not in result:
+                result.append(pattern)
+        return result
+
+    def __bool__(self):
+        return bool(self.exclude)
+
+    def __eq__(self, other):
+        return (isinstance(other, ScanRules) and
+                self.exclude == other.exclude and self.include == other.include)
+
+    def is_excluded(self, rel_path: str, is_dir: bool) -> bool:
+        """Исключен ли путь (относительно корня, разделитель '/')"""
+        exclude = self._exclude_dirs if is_dir else self._exclude_files
+        if exclude is None or not exclude.match(rel_path):
+            return False
+        include = self._include_dirs if is_dir else self._include_files
+        return include is None or not include.match(rel_path)
+
+    def to_dict(self) -> dict:
+        return {'exclude': self.exclude, 'include': self.include}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, value: Optional[str]) -> 'ScanRules':
+        if not value:
+            return cls()
+        data = json.loads(value)
+        return cls(data.get('exclude', []), data.get('include', []))
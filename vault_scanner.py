@@ -0,0 +1,463 @@
+"""
+Однопроходный сканер хранилища Obsidian на основе os.scandir
+"""
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from vault_rules import ScanRules
+
+# Папки вложений Obsidian: *_Attachment, *_Attachments, *Attachment
+ATTACHMENT_DIR_RE = re.compile(r'(?:Attachment|_Attachments)\Z', re.DOTALL)
+# Папки, которые не показываются в дереве и не участвуют в поиске заметок
+EXCLUDED_DIR_RE = re.compile(r'\.|.*(?:Attachment|_Attachments)\Z', re.DOTALL)
+# Markdown файлы, кроме *Attachment.md и *_Attachments.md
+NOTE_FILE_RE = re.compile(r'(?!.*(?:Attachment|_Attachments)\.md\Z).*\.md\Z', re.DOTALL)
+
+
+def is_attachment_dir(name: str) -> bool:
+    """Папки вложений Obsidian"""
+    return ATTACHMENT_DIR_RE.search(name) is not None
+
+
+def is_excluded_dir(name: str) -> bool:
+    """Папки, которые не показываются в дереве и не участвуют в поиске заметок"""
+    return EXCLUDED_DIR_RE.match(name) is not None
+
+
+def is_note_file(name: str) -> bool:
+    """Markdown файлы, которые попадают в список файлов проекта"""
+    return NOTE_FILE_RE.match(name) is not None
+
+
+class VaultScanner:
+    """Снимок структуры хранилища: папки, файлы, размеры и mtime.
+
+    Каждая папка читается одним вызовом os.scandir, размеры и mtime
+    берутся из DirEntry.stat(). Из одного снимка строятся дерево папок,
+    списки файлов и индексы для экспорта. refresh() сверяет mtime папок
+    и перечитывает только изменившиеся.
+
+    Снимок может храниться вне процесса (attach_store): при первом
+    refresh() он загружается вместо полного сканирования, а после
+    каждого refresh() сохраняются только изменившиеся папки.
+
+    При workers > 1 чтение папок и проверка их mtime выполняются в пуле
+    потоков - это ускоряет работу на iCloud/NFS, где каждый listdir/stat
+    ждет сеть. Снимок изменяется только в вызывающем потоке, а порядок
+    дерева и списков файлов от числа потоков не зависит.
+
+    Пути, исключенные правилами проекта (rules), отбрасываются прямо при
+    чтении папки: исключенные поддеревья не обходятся вовсе.
+    """
+
+    def __init__(self, base_path: str, workers: int = 1):
+        self.base_path = os.path.abspath(base_path)
+        self.workers = workers
+        self.rules = ScanRules()
+        self._lock = threading.RLock()
+        # относительный путь папки → {'mtime', 'in_attachments', 'subdirs',
+        #                             'files': {имя: (size, mtime)}}
+        self._dirs: Dict[str, dict] = {}
+        self._built = False
+        # Снимок поддерживается в актуальном состоянии наблюдателем
+        self.watched = False
+        # Увеличивается при любом изменении снимка
+        self.generation = 0
+        self._counts: Dict[str, Tuple[int, int]] = {}
+        self._counts_generation = -1
+        self._changed: set = set()
+        self._removed: set = set()
+        self._load_snapshot: Optional[Callable[[], Dict[str, dict]]] = None
+        self._save_changes: Optional[Callable[[Dict[str, dict], List[str]], None]] = None
+
+    def attach_store(self, load_snapshot: Callable[[], Dict[str, dict]],
+                     save_changes: Callable[[Dict[str, dict], List[str]], None]):
+        """Подключение постоянного хранилища снимка"""
+        with self._lock:
+            if self._load_snapshot is None:
+                self._load_snapshot = load_snapshot
+                self._save_changes = save_changes
+
+    def set_rules(self, rules: ScanRules):
+        """Смена правил сканирования: снимок строится заново"""
+        with self._lock:
+            if rules == self.rules:
+                return
+            self.rules = rules
+            if self._built:
+                self._drop_subtree('')
+                self._scan_subtree('')
+                self._persist()
+
+    def _abs(self, rel_dir: str) -> str:
+        return os.path.join(self.base_path, rel_dir) if rel_dir else self.base_path
+
+    @staticmethod
+    def _child(rel_dir: str, name: str) -> str:
+        return os.path.join(rel_dir, name) if rel_dir else name
+
+    def _ancestor_ids(self, rel_dir: str) -> set:
+        """(st_dev, st_ino) папки rel_dir и всех ее родителей до корня хранилища"""
+        ids = set()
+        while True:
+            try:
+                stat = os.stat(self._abs(rel_dir))
+                ids.add((stat.st_dev, stat.st_ino))
+            except OSError:
+                pass
+            if not rel_dir:
+                return ids
+            rel_dir = os.path.dirname(rel_dir)
+
+    def _read_dir(self, rel_dir: str, in_attachments: bool) -> Optional[dict]:
+        """Чтение одной папки без рекурсии.
+
+        Символические ссылки на папки обходятся как папки, кроме ссылок
+        на саму папку или ее родителей (цикл).
+        """
+        path = self._abs(rel_dir)
+        rules = self.rules if self.rules else None
+        prefix = rel_dir.replace(os.sep, '/') + '/' if rel_dir else ''
+        ancestors = None
+        try:
+            mtime = os.stat(path).st_mtime
+            subdirs = []
+            files = {}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        continue
+                    if rules and rules.is_excluded(prefix + entry.name, is_dir):
+                        continue
+                    if is_dir:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_symlink():
+                            if ancestors is None:
+                                ancestors = self._ancestor_ids(rel_dir)
+                            try:
+                                target = entry.stat()
+                            except OSError:
+                                continue
+                            if (target.st_dev, target.st_ino) in ancestors:
+                                continue
+                        subdirs.append(entry.name)
+                    else:
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        files[entry.name] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            return None
+        return {
+            'mtime': mtime,
+            'in_attachments': in_attachments,
+            'subdirs': sorted(subdirs),
+            'files': files
+        }
+
+    def _mark(self, rel_dir: str, removed: bool = False):
+        """Учет изменившейся папки для сохранения снимка"""
+        self.generation += 1
+        if removed:
+            self._changed.discard(rel_dir)
+            self._removed.add(rel_dir)
+        else:
+            self._removed.discard(rel_dir)
+            self._changed.add(rel_dir)
+
+    def _index_dir(self, rel_dir: str, record: dict):
+        """Хук для наследников: папка добавлена в снимок"""
+
+    def _unindex_dir(self, rel_dir: str, record: dict):
+        """Хук для наследников: папка удалена из снимка"""
+
+    def _add_dir(self, rel_dir: str, record: dict):
+        self._dirs[rel_dir] = record
+        self._index_dir(rel_dir, record)
+        self._mark(rel_dir)
+
+    def _scan_subtree(self, rel_dir: str, in_attachments: bool = False):
+        if self.workers > 1:
+            self._scan_subtree_parallel(rel_dir, in_attachments)
+            return
+
+        record = self._read_dir(rel_dir, in_attachments)
+        if record is None:
+            return
+        self._add_dir(rel_dir, record)
+        for name in record['subdirs']:
+            self._scan_subtree(self._child(rel_dir, name),
+                               in_attachments or is_attachment_dir(name))
+
+    def _scan_subtree_parallel(self, rel_dir: str, in_attachments: bool):
+        """Обход поддерева: папки читаются в пуле, снимок меняется здесь"""
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='vault-scan') as pool:
+            pending = {
+                pool.submit(self._read_dir, rel_dir, in_attachments):
+                    (rel_dir, in_attachments)
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    current, current_in_attachments = pending.pop(future)
+                    record = future.result()
+                    if record is None:
+                        continue
+                    self._add_dir(current, record)
+                    for name in record['subdirs']:
+                        child = self._child(current, name)
+                        child_in_attachments = (current_in_attachments or
+                                                is_attachment_dir(name))
+                        future = pool.submit(self._read_dir, child,
+                                             child_in_attachments)
+                        pending[future] = (child, child_in_attachments)
+
+    def _drop_subtree(self, rel_dir: str):
+        record = self._dirs.pop(rel_dir, None)
+        if record is None:
+            return
+        self._unindex_dir(rel_dir, record)
+        self._mark(rel_dir, removed=True)
+        for name in record['subdirs']:
+            self._drop_subtree(self._child(rel_dir, name))
+
+    def _rescan_dir(self, rel_dir: str):
+        old = self._dirs[rel_dir]
+        new = self._read_dir(rel_dir, old['in_attachments'])
+        if new is None:
+            self._drop_subtree(rel_dir)
+            return
+
+        self._unindex_dir(rel_dir, old)
+        self._add_dir(rel_dir, new)
+
+        old_subdirs = set(old['subdirs'])
+        new_subdirs = set(new['subdirs'])
+        for name in old_subdirs - new_subdirs:
+            self._drop_subtree(self._child(rel_dir, name))
+        for name in new_subdirs - old_subdirs:
+            self._scan_subtree(self._child(rel_dir, name),
+                               new['in_attachments'] or is_attachment_dir(name))
+
+    def _load(self) -> bool:
+        """Загрузка сохраненного снимка вместо полного сканирования"""
+        if self._load_snapshot is None:
+            return False
+        snapshot = self._load_snapshot()
+        if '' not in snapshot:
+            return False
+        self._dirs = snapshot
+        for rel_dir, record in snapshot.items():
+            self._index_dir(rel_dir, record)
+        self.generation += 1
+        return True
+
+    def _persist(self):
+        if self._save_changes is None or not (self._changed or self._removed):
+            return
+        changed = {rel_dir: self._dirs[rel_dir]
+                   for rel_dir in self._changed if rel_dir in self._dirs}
+        self._save_changes(changed, sorted(self._removed))
+        self._changed.clear()
+        self._removed.clear()
+
+    def _stat_mtime(self, rel_dir: str) -> Optional[float]:
+        try:
+            return os.stat(self._abs(rel_dir)).st_mtime
+        except OSError:
+            return None
+
+    def _check_mtimes(self):
+        """Перечитывание папок, у которых изменился mtime"""
+        rel_dirs = list(self._dirs)
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix='vault-stat') as pool:
+                mtimes = list(pool.map(self._stat_mtime, rel_dirs))
+        else:
+            mtimes = [self._stat_mtime(rel_dir) for rel_dir in rel_dirs]
+
+        for rel_dir, mtime in zip(rel_dirs, mtimes):
+            record = self._dirs.get(rel_dir)
+            if record is None:
+                # Папка удалена вместе с родителем на этом же проходе
+                continue
+            if mtime is None:
+                self._drop_subtree(rel_dir)
+            elif mtime != record['mtime']:
+                self._rescan_dir(rel_dir)
+
+    def refresh(self):
+        """Полное сканирование или проверка актуальности по mtime папок.
+
+        Пока снимок поддерживается наблюдателем (watched), повторные
+        вызовы не обращаются к диску.
+        """
+        with self._lock:
+            if not self._built:
+                self._built = True
+                if not self._load():
+                    self._scan_subtree('')
+                    self._persist()
+                    return
+
+            if not self.watched:
+                self._check_mtimes()
+            self._persist()
+
+    def poll(self):
+        """Проверка mtime папок независимо от наблюдателя"""
+        with self._lock:
+            self._ensure_built()
+            self._check_mtimes()
+            self._persist()
+
+    def apply_changes(self, rel_dirs):
+        """Перечитывание папок, о которых сообщил наблюдатель"""
+        with self._lock:
+            self._ensure_built()
+            rescanned = set()
+            # Родительские папки первыми: они находят новые и удаленные подпапки
+            for rel_dir in sorted(set(rel_dirs), key=lambda p: (p.count(os.sep), p)):
+                if rel_dir not in self._dirs:
+                    rel_dir = os.path.dirname(rel_dir) if rel_dir else None
+                if rel_dir is None or rel_dir in rescanned or rel_dir not in self._dirs:
+                    continue
+                self._rescan_dir(rel_dir)
+                rescanned.add(rel_dir)
+            self._persist()
+
+    def dir_paths(self) -> List[str]:
+        """Относительные пути всех папок снимка"""
+        with self._lock:
+            return list(self._dirs)
+
+    def _ensure_built(self):
+        if not self._built:
+            self.refresh()
+
+    def _visible_subdirs(self, record: dict) -> List[str]:
+        return [name for name in record['subdirs'] if not is_excluded_dir(name)]
+
+    def _file_counts(self) -> Dict[str, Tuple[int, int]]:
+        """Число заметок в папке и во всем поддереве (кэш на поколение снимка)"""
+        if self._counts_generation == self.generation:
+            return self._counts
+
+        counts = {}
+        # Снизу вверх: подпапки считаются раньше родителей
+        for rel_dir in sorted(self._dirs, key=lambda p: -p.count(os.sep) if p else 1):
+            record = self._dirs[rel_dir]
+            files_count = sum(1 for name in record['files'] if is_note_file(name))
+            total = files_count
+            for name in self._visible_subdirs(record):
+                total += counts.get(self._child(rel_dir, name), (0, 0))[1]
+            counts[rel_dir] = (files_count, total)
+
+        self._counts = counts
+        self._counts_generation = self.generation
+        return counts
+
+    def has_dir(self, rel_dir: str) -> bool:
+        with self._lock:
+            self._ensure_built()
+            return rel_dir in self._dirs
+
+    def build_tree(self, folder_states: Optional[dict] = None,
+                   path: str = '', depth: Optional[int] = None) -> dict:
+        """Построение дерева папок с состояниями.
+
+        path - корень поддерева, depth - сколько уровней подпапок вернуть
+        (None - все). У папок на границе глубины children пуст и
+        children_loaded = False, но total_files_count уже посчитан.
+        """
+        if folder_states is None:
+            folder_states = {}
+
+        def build(rel_dir, remaining):
+            folder_info = {
+                'name': (os.path.basename(rel_dir) if rel_dir
+                         else os.path.basename(self.base_path)),
+                'path': rel_dir,
+                'children': [],
+                'files_count': 0,
+                'total_files_count': 0,
+                'has_children': False,
+                'children_loaded': True,
+                'is_selected': False,
+                'is_expanded': False
+            }
+
+            # Применяем сохраненные состояния
+            if rel_dir in folder_states:
+                state = folder_states[rel_dir]
+                folder_info['is_selected'] = bool(state.get('is_selected', 0))
+                folder_info['is_expanded'] = bool(state.get('is_expanded', 0))
+
+            record = self._dirs.get(rel_dir)
+            if record is None:
+                return folder_info
+
+            folder_info['files_count'], folder_info['total_files_count'] = counts[rel_dir]
+
+            subdirs = self._visible_subdirs(record)
+            folder_info['has_children'] = bool(subdirs)
+            if subdirs and remaining is not None and remaining <= 0:
+                folder_info['children_loaded'] = False
+                return folder_info
+
+            for name in subdirs:
+                child_remaining = remaining - 1 if remaining is not None else None
+                folder_info['children'].append(
+                    build(self._child(rel_dir, name), child_remaining)
+                )
+
+            return folder_info
+
+        with self._lock:
+            self._ensure_built()
+            counts = self._file_counts()
+            return build(path, depth)
+
+    def get_files(self, folder_path: str) -> List[dict]:
+        """Markdown файлы папки и её подпапок"""
+        full_path = (os.path.join(self.base_path, folder_path)
+                     if not os.path.isabs(folder_path) else folder_path)
+        rel_root = os.path.relpath(full_path, self.base_path)
+        if rel_root == os.curdir:
+            rel_root = ''
+
+        files_data = []
+
+        def collect(rel_dir):
+            record = self._dirs.get(rel_dir)
+            if record is None:
+                return
+            dir_path = self._abs(rel_dir)
+            for name in sorted(record['files']):
+                if not is_note_file(name):
+                    continue
+                size, mtime = record['files'][name]
+                files_data.append({
+                    'name': name,
+                    'path': os.path.join(dir_path, name),
+                    'relative_path': self._child(rel_dir, name),
+                    'size': size,
+                    'mtime': mtime,
+                    'selected': True  # По умолчанию выбран
+                })
+            for name in self._visible_subdirs(record):
+                collect(self._child(rel_dir, name))
+
+        with self._lock:
+            self._ensure_built()
+            collect(rel_root)
+        return files_data
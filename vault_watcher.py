@@ -0,0 +1,285 @@
+"""
+Фоновый наблюдатель за хранилищем: поддерживает индекс в актуальном состоянии
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from vault_scanner import VaultScanner
+
+# Константы inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyBackend:
+    """Минимальная обертка над inotify через ctypes (только Linux)"""
+
+    name = 'inotify'
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify доступен только в Linux')
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float) -> List[Tuple[int, int, str]]:
+        """Чтение накопившихся событий: (wd, mask, имя)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class VaultWatcher:
+    """Наблюдатель за папкой проекта.
+
+    В Linux использует inotify, на остальных системах (или если inotify
+    недоступен, например исчерпан лимит watch'ей) - периодический опрос
+    mtime папок. События собираются в набор изменившихся папок и
+    применяются к индексу пачкой после паузы debounce секунд (но не
+    позже max_delay от первого события), чтобы шторм записей от
+    синхронизации Obsidian давал одно перечитывание.
+    """
+
+    def __init__(self, index: VaultScanner, debounce: float = 0.5,
+                 max_delay: float = 5.0, poll_interval: float = 2.0,
+                 use_inotify: bool = True):
+        self.index = index
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+
+        self.backend_name = None
+        self._backend: Optional[InotifyBackend] = None
+        self._watches: Dict[int, str] = {}
+        self._watched_dirs: Dict[str, int] = {}
+
+        self._pending: set = set()
+        self._first_event: Optional[float] = None
+        self._last_event: Optional[float] = None
+        self._events_total = 0
+        self._batches_applied = 0
+        self._last_apply_seconds = 0.0
+        self._last_lag = 0.0
+
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Запуск наблюдателя в фоновом потоке"""
+        if self._thread is not None:
+            return
+        self.index.refresh()
+
+        if self.use_inotify:
+            try:
+                self._backend = InotifyBackend()
+                self._sync_watches()
+                self.backend_name = InotifyBackend.name
+            except OSError as e:
+                print(f"inotify недоступен, используется опрос: {e}")
+                self._close_backend()
+        if self._backend is None:
+            self.backend_name = 'polling'
+
+        self.index.watched = True
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='vault-watcher', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Остановка наблюдателя"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.index.watched = False
+        self._close_backend()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self) -> dict:
+        """Состояние наблюдателя: задержка и глубина очереди"""
+        with self._stats_lock:
+            now = time.monotonic()
+            lag = now - self._first_event if self._first_event else 0.0
+            return {
+                'running': self.is_running(),
+                'backend': self.backend_name,
+                'queue_depth': len(self._pending),
+                'lag': round(lag, 3),
+                'last_lag': round(self._last_lag, 3),
+                'last_apply_seconds': round(self._last_apply_seconds, 3),
+                'events_total': self._events_total,
+                'batches_applied': self._batches_applied,
+                'watched_dirs': len(self._watched_dirs)
+            }
+
+    def _close_backend(self):
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+        self._watches.clear()
+        self._watched_dirs.clear()
+
+    def _sync_watches(self):
+        """Watch на каждую папку снимка; лишние снимаются"""
+        dirs = set(self.index.dir_paths())
+        for rel_dir in list(self._watched_dirs):
+            if rel_dir not in dirs:
+                wd = self._watched_dirs.pop(rel_dir)
+                self._watches.pop(wd, None)
+                self._backend.rm_watch(wd)
+        for rel_dir in dirs:
+            if rel_dir in self._watched_dirs:
+                continue
+            path = (os.path.join(self.index.base_path, rel_dir)
+                    if rel_dir else self.index.base_path)
+            try:
+                wd = self._backend.add_watch(path)
+            except FileNotFoundError:
+                continue
+            self._watches[wd] = rel_dir
+            self._watched_dirs[rel_dir] = wd
+
+    def _queue(self, rel_dirs):
+        with self._stats_lock:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_event = now
+            self._last_event = now
+            self._pending.update(rel_dirs)
+            self._events_total += len(rel_dirs)
+
+    def _apply_if_quiet(self):
+        with self._stats_lock:
+            if not self._pending:
+                return
+            now = time.monotonic()
+            if (now - self._last_event < self.debounce and
+                    now - self._first_event < self.max_delay):
+                return
+            pending = self._pending
+            first_event = self._first_event
+            self._pending = set()
+            self._first_event = None
+            self._last_event = None
+
+        started = time.monotonic()
+        self.index.apply_changes(pending)
+        if self._backend is not None:
+            try:
+                self._sync_watches()
+            except OSError as e:
+                # Обычно исчерпан лимит inotify - переходим на опрос
+                print(f"inotify: {e}; наблюдатель переходит на опрос")
+                self._close_backend()
+                self.backend_name = 'polling'
+
+        finished = time.monotonic()
+        with self._stats_lock:
+            self._batches_applied += 1
+            self._last_apply_seconds = finished - started
+            self._last_lag = finished - first_event
+
+    def _handle_events(self, events):
+        changed = []
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # События потеряны - перечитываем все изменившиеся по mtime
+                self.index.poll()
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                self._watched_dirs.pop(rel_dir, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.append(os.path.dirname(rel_dir) if rel_dir else '')
+            else:
+                changed.append(rel_dir)
+        if changed:
+            self._queue(changed)
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while not self._stop.is_set():
+            try:
+                if self._backend is not None:
+                    timeout = self.debounce / 2 if self._pending else 1.0
+                    self._handle_events(self._backend.read_events(timeout))
+                else:
+                    self._stop.wait(min(self.poll_interval, 0.5))
+                    if time.monotonic() >= next_poll:
+                        started = time.monotonic()
+                        self.index.poll()
+                        with self._stats_lock:
+                            self._last_apply_seconds = time.monotonic() - started
+                            self._batches_applied += 1
+                        next_poll = time.monotonic() + self.poll_interval
+                self._apply_if_quiet()
+            except Exception as e:
+                print(f"Ошибка наблюдателя хранилища: {e}")
+                self._stop.wait(1.0)